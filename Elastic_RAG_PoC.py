@@ -4,6 +4,8 @@ from components.elasticsearch_connection import es_connection_config_widget, con
 from components.state import saved_state_widget, load_state
 from components.search_results import search_results_widget
 from components.elasticsearch import index_selector_widget, search
+from components.multi_query import default_max_variants
+from components.diversity import default_lambda as default_diversity_lambda, default_over_fetch, default_parent_field
 from components.llm import llm_config_widget, llm_chat_widget
 from components.llm_functions import function_select_widget
 import streamlit as st
@@ -13,6 +15,7 @@ from tools import loggeres
 import ecs_logging
 import logging
 import sys
+import os
 import elasticapm
 
 session_state = st.session_state
@@ -47,11 +50,27 @@ def setup_logging():
         return
     logs_index_name = session_state.get("logs_index_name")
     event_dataset_logs = session_state.get("event_dataset_logs", "ldemo-logs")
-    handler = loggeres.ElasticHandler(logging.INFO,eslogger,logs_index_name)
+    # The handler ships logs in batches from a background thread and is shared between reruns
+    handler = loggeres.get_elastic_handler(
+        logging.INFO,
+        eslogger,
+        logs_index_name,
+        client_key=session_state.get("monitoring_es_client_key"),
+        batch_size=int(os.getenv("LOGS_BATCH_SIZE", "500")),
+        flush_interval=float(os.getenv("LOGS_FLUSH_INTERVAL", "2")),
+        max_queue_size=int(os.getenv("LOGS_MAX_QUEUE_SIZE", "10000")),
+        overflow_policy=os.getenv("LOGS_OVERFLOW_POLICY", "drop")
+    )
     handler.setFormatter(ecs_logging.StdlibFormatter())
     logger = logging.getLogger("app")
     logger.setLevel(logging.INFO)
+    for existing_handler in list(logger.handlers):
+        if isinstance(existing_handler, loggeres.ElasticHandler) and existing_handler is not handler:
+            logger.removeHandler(existing_handler)
     logger.addHandler(handler)
+    for existing_filter in list(logger.filters):
+        if isinstance(existing_filter, loggeres.SystemLogFilter):
+            logger.removeFilter(existing_filter)
     logger.addFilter(loggeres.SystemLogFilter(event_dataset_logs)) # We always need to add this filter to add the event.dataset field
     session_state["logger_client"] = logger
 
@@ -177,6 +196,7 @@ def main():
         doc_format_expander = st.expander("Document Display Format")
         with doc_format_expander:
             doc_md_template = st.text_area("Document Display Template", value=session_state.get("doc_md_template",default_md_template), key="doc_md_template")
+            st.number_input("Results per Page", key="results_page_size", min_value=1, value=session_state.get("results_page_size", 20))
         with st.expander("Search Function"):
             index_pattern_col, num_results_col = st.columns([4,1])
             with index_pattern_col:
@@ -184,6 +204,29 @@ def main():
             with num_results_col:
                 num_results = st.number_input("Number of Results", key="num_results", value=session_state.get("num_results", 10))
             st.write("Define your query. Tip: Try Playground in Kibana")
+            st.checkbox("Only fetch displayed fields", key="source_filtering", value=session_state.get("source_filtering", True), help="Request only the source fields used by the display template and the enabled LLM functions")
+            st.checkbox("Use stored search template", key="use_stored_template", value=session_state.get("use_stored_template", False), help="Register the query as a mustache search template in the cluster and search by template id")
+            multi_query_enabled = st.checkbox("Search query variants", key="multi_query_enabled", value=session_state.get("multi_query_enabled", False), help="Search variants of the query, written by the LLM or derived from the query, in one multi search request and fuse the results with reciprocal rank fusion")
+            if multi_query_enabled:
+                variants_col, knn_field_col, knn_model_col = st.columns([1, 2, 2])
+                with variants_col:
+                    st.number_input("Variants", key="multi_query_max_variants", min_value=1, max_value=10, value=session_state.get("multi_query_max_variants", default_max_variants))
+                with knn_field_col:
+                    st.text_input("kNN vector field", key="multi_query_knn_field", value=session_state.get("multi_query_knn_field", ""), help="Adds a kNN search on this dense vector field to the fused results")
+                with knn_model_col:
+                    st.text_input("kNN embedding model id", key="multi_query_knn_model_id", value=session_state.get("multi_query_knn_model_id", ""), help="Model deployed in the cluster that embeds the query for the kNN search")
+            diversity_enabled = st.checkbox("Diversify results", key="diversity_enabled", value=session_state.get("diversity_enabled", False), help="Fetch more hits and re-rank them with maximal marginal relevance, keeping one hit per parent document")
+            if diversity_enabled:
+                lambda_col, over_fetch_col = st.columns([3, 1])
+                with lambda_col:
+                    st.slider("Relevance vs diversity", key="diversity_lambda", min_value=0.0, max_value=1.0, step=0.05, value=session_state.get("diversity_lambda", default_diversity_lambda), help="1 ranks by relevance only, lower values favour hits unlike the ones already picked")
+                with over_fetch_col:
+                    st.number_input("Over-fetch", key="diversity_over_fetch", min_value=1, max_value=10, value=session_state.get("diversity_over_fetch", default_over_fetch))
+                parent_col, vector_col = st.columns(2)
+                with parent_col:
+                    st.text_input("Parent document field", key="diversity_parent_field", value=session_state.get("diversity_parent_field", default_parent_field), help="Hits with the same value are chunks of one document, empty to keep them all")
+                with vector_col:
+                    st.text_input("Dense vector field", key="diversity_vector_field", value=session_state.get("diversity_vector_field", ""), help="Similarity of the hits, MinHash signatures of the text are used when empty")
             search_body_editor = code_editor(
                 session_state.get("search_body", default_query_body),
                 lang="json",
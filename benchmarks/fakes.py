@@ -0,0 +1,323 @@
+# fakes.py
+
+import json
+import math
+import random
+import time
+from types import SimpleNamespace
+
+####################################################################################################
+# In-process fakes of the Elasticsearch and OpenAI clients
+####################################################################################################
+
+# The fakes answer the calls the app makes with generated data after a configurable latency, so the
+# hot paths can be measured without a cluster or an LLM endpoint. Indices created through the fake
+# Elasticsearch client also store the documents written to them, which is enough to test the
+# ingestion and the semantic cache without a cluster.
+
+words = ["elastic", "search", "vector", "index", "cluster", "shard", "query", "document", "retrieval",
+         "ranking", "semantic", "keyword", "latency", "throughput", "cache", "node", "mapping", "field"]
+
+
+def make_corpus(n_docs: int = 1000, text_words: int = 300, seed: int = 42) -> list:
+    # Returns search hits with a title, url, nested metadata and a text body
+    rng = random.Random(seed)
+    hits = []
+    for number in range(n_docs):
+        hits.append({
+            "_index": "bench-index",
+            "_id": str(number),
+            "_score": 1.0 / (number + 1),
+            "_source": {
+                "title": f"Document {number} about {rng.choice(words)}",
+                "url": f"https://example.com/docs/{number}",
+                "meta": {"author": f"author-{number % 17}", "year": 2000 + number % 25},
+                "text": " ".join(rng.choice(words) for _ in range(text_words)),
+            },
+        })
+    return hits
+
+
+def sleep_ms(latency_ms: float):
+    if latency_ms:
+        time.sleep(latency_ms / 1000)
+
+
+class FakeResponse(dict):
+    # Response body that also has the body attribute of the client's ObjectApiResponse
+    @property
+    def body(self) -> dict:
+        return self
+
+
+class FakeElasticsearch:
+    """
+    Fake of the Elasticsearch client methods used by the app.
+
+    Searches without a query return the corpus. Indices created with indices.create keep the documents
+    indexed into them, and answer term, knn and scroll searches over those documents.
+
+    Parameters:
+    - corpus (list): The hits returned by searches.
+    - latency_ms (float): Latency added to every request.
+    - reject (callable): Called with the bulk action and its source, a truthy result fails the item with
+      that error and status 400.
+    """
+
+    def __init__(self, corpus: list = None, latency_ms: float = 0, reject: callable = None):
+        self.corpus = corpus if corpus is not None else make_corpus()
+        self.by_id = {hit["_id"]: hit for hit in self.corpus}
+        self.latency_ms = latency_ms
+        self.reject = reject
+        self.calls = {}
+        self.documents = {} # index -> {_id: _source}
+        self._next_id = 0
+        self.indices = SimpleNamespace(
+            exists=lambda index, **kwargs: self._call("indices.exists", index == "bench-index" or index in self.documents),
+            create=self._create_index,
+            refresh=lambda index=None, **kwargs: self._call("indices.refresh", {"_shards": {"failed": 0}}),
+            get_settings=lambda index, **kwargs: self._call("indices.get_settings", {index: {"settings": {"index": {"number_of_replicas": "1", "refresh_interval": "1s"}}}}),
+            put_settings=lambda index, settings, **kwargs: self._call("indices.put_settings", {"acknowledged": True}),
+            get_field_mapping=lambda index, fields, **kwargs: self._call("indices.get_field_mapping", {index: {"mappings": {fields: {"full_name": fields, "mapping": {fields: {"type": "keyword"}}}}}}),
+            get_alias=lambda index, **kwargs: self._call("indices.get_alias", {"bench-index": {"aliases": {}}}),
+        )
+        self.cat = SimpleNamespace(
+            indices=lambda **kwargs: self._call("cat.indices", [{"index": "bench-index", "docs.count": str(len(self.corpus)), "store.size": "1048576"}]),
+        )
+        # The bulk helpers serialize the actions with the serializer of the transport
+        serializer = SimpleNamespace(dumps=lambda data: json.dumps(data).encode())
+        self.transport = SimpleNamespace(serializers=SimpleNamespace(get_serializer=lambda mimetype: serializer))
+
+    def _call(self, name: str, result):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        sleep_ms(self.latency_ms)
+        return result
+
+    def _create_index(self, index: str, **kwargs):
+        self.documents.setdefault(index, {})
+        return self._call("indices.create", {"acknowledged": True, "index": index})
+
+    def _new_id(self) -> str:
+        self._next_id += 1
+        return f"fake-{self._next_id}"
+
+    def options(self, **kwargs):
+        return self
+
+    def ping(self, **kwargs):
+        return self._call("ping", True)
+
+    def info(self, **kwargs):
+        return self._call("info", {"version": {"number": "8.14.0"}})
+
+    def _hits(self, size: int, source_includes: list = None, offset: int = 0) -> list:
+        hits = self.corpus[offset:offset + size]
+        if source_includes:
+            hits = [dict(hit, _source={key: hit["_source"][key.split(".")[0]] for key in source_includes if key.split(".")[0] in hit["_source"]}) for hit in hits]
+        else:
+            hits = [dict(hit) for hit in hits]
+        return hits
+
+    def _matches(self, source: dict, query: dict) -> bool:
+        # Supports the match_all, term and bool filter queries the app sends to stored documents
+        if not query or "match_all" in query:
+            return True
+        if "term" in query:
+            (field, value), = query["term"].items()
+            return source.get(field.removesuffix(".keyword")) == value
+        if "bool" in query:
+            return all(self._matches(source, clause) for clause in query["bool"].get("filter", []))
+        raise NotImplementedError(f"Query not supported by the fake: {query}")
+
+    def _stored_hits(self, index: str, query: dict, source) -> list:
+        hits = []
+        for doc_id, doc in self.documents[index].items():
+            if self._matches(doc, query):
+                hits.append({"_index": index, "_id": doc_id, "_score": 1.0, "_source": self._select(doc, source)})
+        return hits
+
+    def _select(self, doc: dict, source):
+        if source is False:
+            return None
+        if isinstance(source, list):
+            return {key: doc[key] for key in source if key in doc}
+        return dict(doc)
+
+    def _knn(self, index: str, knn: dict, source) -> list:
+        # Exact cosine over the stored vectors, scored as a cosine dense_vector: (1 + cosine) / 2
+        hits = []
+        for doc_id, doc in self.documents[index].items():
+            if not all(self._matches(doc, clause) for clause in knn.get("filter", [])):
+                continue
+            cosine = cosine_similarity(knn["query_vector"], doc[knn["field"]])
+            if cosine < knn.get("similarity", -1):
+                continue
+            hits.append({"_index": index, "_id": doc_id, "_score": (1 + cosine) / 2, "_source": self._select(doc, source)})
+        hits.sort(key=lambda hit: -hit["_score"])
+        return hits[:knn.get("k", 10)]
+
+    def search(self, index: str = None, body: dict = None, size: int = None, **kwargs):
+        if index in self.documents:
+            source = kwargs.get("source", kwargs.get("_source"))
+            if "knn" in kwargs:
+                hits = self._knn(index, kwargs["knn"], source)
+            else:
+                hits = self._stored_hits(index, kwargs.get("query"), source)[:size or 10]
+            response = {"hits": {"hits": hits}}
+            if "scroll" in kwargs:
+                # Every hit fits in the first page, the scroll only returns an empty one
+                response.update(_scroll_id="fake-scroll", _shards={"total": 1, "successful": 1, "skipped": 0, "failed": 0})
+            return self._call("search", FakeResponse(response))
+        body = body or {}
+        # Serializing the body is part of the cost of a real request
+        json.dumps(body)
+        size = body.get("size", size or 10)
+        source = body.get("_source")
+        includes = source.get("includes") if isinstance(source, dict) else None
+        return self._call("search", {"hits": {"hits": self._hits(size, includes)}})
+
+    def scroll(self, scroll_id: str = None, **kwargs):
+        return self._call("scroll", FakeResponse({"_scroll_id": scroll_id, "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0}, "hits": {"hits": []}}))
+
+    def clear_scroll(self, scroll_id: str = None, **kwargs):
+        return self._call("clear_scroll", {"succeeded": True})
+
+    def msearch(self, searches: list = None, index: str = None, **kwargs):
+        # The searches overlap, each starts one document further into the corpus
+        json.dumps(searches)
+        responses = []
+        for position, body in enumerate((searches or [])[1::2]):
+            source = body.get("_source")
+            includes = source.get("includes") if isinstance(source, dict) else None
+            responses.append({"hits": {"hits": self._hits(body.get("size", 10), includes, offset=position)}})
+        return self._call("msearch", {"responses": responses})
+
+    def search_template(self, index: str = None, id: str = None, params: dict = None, **kwargs):
+        params = params or {}
+        includes = params.get("source", {}).get("includes")
+        return self._call("search_template", {"hits": {"hits": self._hits(params.get("size", 10), None if includes == ["*"] else includes)}})
+
+    def put_script(self, **kwargs):
+        return self._call("put_script", {"acknowledged": True})
+
+    def get(self, index: str, id: str, **kwargs):
+        return self._call("get", {"_index": index, "_id": id, "found": True, "_source": self.by_id[id]["_source"]})
+
+    def mget(self, docs: list = None, index: str = None, ids: list = None, **kwargs):
+        if docs is None:
+            docs = [{"_index": index, "_id": doc_id} for doc_id in ids]
+        found = []
+        for doc in docs:
+            doc_index = doc.get("_index", index)
+            if doc_index in self.documents:
+                source = self.documents[doc_index].get(doc["_id"])
+            else:
+                hit = self.by_id.get(doc["_id"])
+                source = hit["_source"] if hit else None
+            found.append(dict(doc, found=source is not None, _source=source))
+        return self._call("mget", {"docs": found})
+
+    def bulk(self, operations: list = None, index: str = None, **kwargs):
+        # The helpers send serialized lines, the log handler sends dicts
+        operations = [json.loads(line) if isinstance(line, (bytes, str)) else line for line in operations or []]
+        items = []
+        errors = False
+        position = 0
+        while position < len(operations):
+            (op_type, action), = operations[position].items()
+            position += 1
+            source = None
+            if op_type != "delete":
+                source = operations[position]
+                position += 1
+            items.append({op_type: self._bulk_item(op_type, action, source, index)})
+            errors = errors or "error" in items[-1][op_type]
+        return self._call("bulk", FakeResponse({"errors": errors, "items": items}))
+
+    def _bulk_item(self, op_type: str, action: dict, source: dict, index: str) -> dict:
+        index = action.get("_index", index)
+        doc_id = action.get("_id")
+        error = self.reject(op_type, action, source) if self.reject else None
+        if error:
+            return {"_index": index, "_id": doc_id, "status": 400, "error": error}
+        # Documents are only kept for indices created through the fake
+        stored = self.documents.get(index)
+        if op_type == "delete":
+            found = stored is not None and stored.pop(doc_id, None) is not None
+            return {"_index": index, "_id": doc_id, "status": 200 if found else 404, "result": "deleted" if found else "not_found"}
+        doc_id = doc_id or self._new_id()
+        if stored is not None:
+            stored[doc_id] = source
+        return {"_index": index, "_id": doc_id, "status": 201, "result": "created"}
+
+    def index(self, index: str, document, id: str = None, **kwargs):
+        doc_id = id or self._new_id()
+        if index in self.documents:
+            self.documents[index][doc_id] = document
+        return self._call("index", {"_index": index, "_id": doc_id, "result": "created"})
+
+
+def cosine_similarity(a: list, b: list) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class FakeOpenAI:
+    """
+    Fake of the OpenAI chat completions client.
+
+    The first completion of a chat asks for the tool calls given in tool_calls, once the tool results
+    are in the messages it answers with reply_words words. Streaming sends one token per chunk.
+
+    Parameters:
+    - latency_ms (float): Latency before the first token.
+    - token_latency_ms (float): Latency between streamed tokens.
+    - tool_calls (list): (name, arguments) of the tool calls requested by the first completion.
+    """
+
+    def __init__(self, latency_ms: float = 0, token_latency_ms: float = 0, tool_calls: list = None, reply_words: int = 100):
+        self.latency_ms = latency_ms
+        self.token_latency_ms = token_latency_ms
+        self.tool_calls = tool_calls or []
+        self.reply_words = reply_words
+        self.completions = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.models = SimpleNamespace(list=lambda: [])
+
+    def with_options(self, **kwargs):
+        return self
+
+    def create(self, model: str = None, messages: list = None, stream: bool = False, tools: list = None, **kwargs):
+        self.completions += 1
+        sleep_ms(self.latency_ms)
+        # Serializing the messages is part of the cost of a real request
+        json.dumps(messages, default=str)
+        call_tools = bool(tools) and self.tool_calls and not any(message["role"] == "tool" for message in messages)
+        if call_tools:
+            tool_calls = [
+                SimpleNamespace(id=f"call_{number}", type="function", function=SimpleNamespace(name=name, arguments=json.dumps(arguments)))
+                for number, (name, arguments) in enumerate(self.tool_calls)
+            ]
+            content = None
+            finish_reason = "tool_calls"
+        else:
+            tool_calls = None
+            content = " ".join(words[number % len(words)] for number in range(self.reply_words))
+            finish_reason = "stop"
+        if not stream:
+            message = SimpleNamespace(content=content, tool_calls=tool_calls, function_call=None)
+            return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason=finish_reason)])
+        return self._stream(content, tool_calls, finish_reason)
+
+    def _stream(self, content: str, tool_calls: list, finish_reason: str):
+        def chunk(delta, finish=None):
+            return SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=finish)])
+        if tool_calls:
+            for index, tool_call in enumerate(tool_calls):
+                yield chunk(SimpleNamespace(content=None, tool_calls=[SimpleNamespace(index=index, id=tool_call.id, function=tool_call.function)]))
+        else:
+            for token in content.split(" "):
+                sleep_ms(self.token_latency_ms)
+                yield chunk(SimpleNamespace(content=token + " ", tool_calls=None))
+        yield chunk(SimpleNamespace(content=None, tool_calls=None), finish_reason)
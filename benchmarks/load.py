@@ -0,0 +1,399 @@
+# load.py
+#
+# Multi-session load generator for Elastic_RAG_PoC.py.
+#
+# The app runs in a real `streamlit run` server connected to local stub Elasticsearch and Azure OpenAI
+# servers. Every simulated user is a headless websocket session speaking the Streamlit protocol, the
+# users run search and chat flows concurrently. The tool reports the rerun latency percentiles by
+# interaction, the cluster and LLM calls per interaction and the growth of the server RSS per session.
+#
+# AppTest can't be used for this: every AppTest run replaces the process wide Streamlit runtime, so
+# sessions in one process can't run concurrently.
+#
+# Run from the repository root:
+#   python -m benchmarks.load --users 20 --interactions 10
+#   python -m benchmarks.load --users 50 --es-latency-ms 5 --llm-latency-ms 300 --save /tmp/load.json
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(repo_root)
+if repo_root not in sys.path:
+    sys.path.insert(0, repo_root)
+
+from tornado.websocket import websocket_connect
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from benchmarks.fakes import make_corpus, words
+from benchmarks.stub_servers import start_es_stub, start_llm_stub
+from benchmarks.run import percentile, git_commit
+
+app_script = "Elastic_RAG_PoC.py"
+
+
+def process_rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+####################################################################################################
+# Streamlit Server
+####################################################################################################
+
+def free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_app_server(env: dict, port: int, verbose: bool = False, timeout: float = 60) -> subprocess.Popen:
+    """
+    Starts the app in a headless Streamlit server and waits until it is healthy.
+    """
+    output = None if verbose else subprocess.DEVNULL
+    server = subprocess.Popen(
+        [sys.executable, "-m", "streamlit", "run", app_script,
+         "--server.headless", "true",
+         "--server.port", str(port),
+         "--server.address", "127.0.0.1",
+         "--server.runOnSave", "false",
+         "--browser.gatherUsageStats", "false"],
+        env=env, stdout=output, stderr=output
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"The Streamlit server exited with {server.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1) as response:
+                if response.status == 200:
+                    return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise TimeoutError("The Streamlit server did not start")
+
+
+class AppSession:
+    """
+    A headless browser session of the app.
+
+    Widgets are found in the deltas of the last run by their key, interactions send the changed widget
+    states with a rerun request and wait until the script has finished.
+    """
+
+    def __init__(self, url: str, timeout: float):
+        self._url = url
+        self._timeout = timeout
+        self._connection = None
+        self.widgets = {}
+        self.exceptions = []
+
+    async def connect(self):
+        self._connection = await websocket_connect(self._url, subprotocols=["streamlit"], max_message_size=64 * 2 ** 20)
+
+    async def rerun(self, widget_states: list = None) -> float:
+        """
+        Reruns the script with the given widget states and returns the seconds until it finished.
+        """
+        message = BackMsg()
+        message.rerun_script.query_string = ""
+        message.rerun_script.page_script_hash = ""
+        for state in widget_states or []:
+            message.rerun_script.widget_states.widgets.append(state)
+        start = time.perf_counter()
+        await self._connection.write_message(message.SerializeToString(), binary=True)
+        self.widgets = {}
+        await asyncio.wait_for(self._read_until_finished(), self._timeout)
+        return time.perf_counter() - start
+
+    async def _read_until_finished(self):
+        while True:
+            data = await self._connection.read_message()
+            if data is None:
+                raise ConnectionError("The server closed the session")
+            message = ForwardMsg()
+            message.ParseFromString(data)
+            kind = message.WhichOneof("type")
+            if kind == "delta" and message.delta.WhichOneof("type") == "new_element":
+                self._collect(message.delta.new_element)
+            elif kind == "script_finished":
+                if message.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    return
+
+    def _collect(self, element):
+        element_type = element.WhichOneof("type")
+        if element_type == "exception":
+            self.exceptions.append(element.exception.message)
+            return
+        widget = getattr(element, element_type)
+        widget_id = getattr(widget, "id", None)
+        if widget_id:
+            # Widget ids end with the user key when one is given
+            self.widgets[widget_id.rsplit("-", 1)[-1]] = widget_id
+            label = getattr(widget, "label", None)
+            if label:
+                self.widgets.setdefault(f"{element_type}:{label}", widget_id)
+
+    def widget_id(self, key: str) -> str:
+        widget_id = self.widgets.get(key)
+        if widget_id is None:
+            raise LookupError(f"No widget {key} rendered")
+        return widget_id
+
+    async def close(self):
+        if self._connection is not None:
+            self._connection.close()
+
+
+def text_state(widget_id: str, value: str):
+    message = BackMsg()
+    state = message.rerun_script.widget_states.widgets.add()
+    state.id = widget_id
+    state.string_value = value
+    return state
+
+
+def trigger_state(widget_id: str):
+    message = BackMsg()
+    state = message.rerun_script.widget_states.widgets.add()
+    state.id = widget_id
+    state.trigger_value = True
+    return state
+
+
+def chat_state(widget_id: str, value: str):
+    message = BackMsg()
+    state = message.rerun_script.widget_states.widgets.add()
+    state.id = widget_id
+    state.string_trigger_value.data = value
+    return state
+
+
+####################################################################################################
+# Simulated Users
+####################################################################################################
+
+class LoadStats:
+    """
+    Rerun latencies and the stub calls made by every interaction, grouped by interaction type.
+
+    Stub calls are counted process wide, each interaction is attributed the calls made while it ran.
+    With concurrent users the calls of overlapping interactions are spread between them, the totals
+    stay exact.
+    """
+
+    def __init__(self, es_stub, llm_stub):
+        self.es_stub = es_stub
+        self.llm_stub = llm_stub
+        self.latencies = {}
+        self.es_calls = {}
+        self.llm_calls = {}
+        self.errors = []
+
+    async def measure(self, interaction: str, session: AppSession, widget_states: callable = None):
+        es_before = self.es_stub.total_calls()
+        llm_before = self.llm_stub.total_calls()
+        exceptions = len(session.exceptions)
+        try:
+            seconds = await session.rerun(widget_states() if widget_states else None)
+        except Exception as e:
+            self.errors.append(f"{interaction}: {type(e).__name__} {e}")
+            return
+        for exception in session.exceptions[exceptions:]:
+            self.errors.append(f"{interaction}: {exception}")
+        self.latencies.setdefault(interaction, []).append(seconds)
+        self.es_calls.setdefault(interaction, []).append(self.es_stub.total_calls() - es_before)
+        self.llm_calls.setdefault(interaction, []).append(self.llm_stub.total_calls() - llm_before)
+
+
+def random_query(rng: random.Random) -> str:
+    return " ".join(rng.choice(words) for _ in range(3))
+
+
+async def simulate_user(user: int, settings: dict, stats: LoadStats, sessions: list):
+    """
+    Opens the app, then runs a mix of searches and chat questions.
+    """
+    rng = random.Random(settings["seed"] + user)
+    session = AppSession(settings["url"], settings["timeout"])
+    # Sessions stay open until the end so their memory is counted
+    sessions.append(session)
+    try:
+        await session.connect()
+    except Exception as e:
+        stats.errors.append(f"connect: {e}")
+        return
+    await stats.measure("load", session)
+    for _ in range(settings["interactions"]):
+        await asyncio.sleep(rng.uniform(0, settings["think_time"]))
+        if not session.widgets:
+            break
+        if rng.random() < settings["chat_ratio"]:
+            question = f"What is {random_query(rng)}?"
+            await stats.measure("chat", session, lambda: [chat_state(session.widget_id("chat_input"), question)])
+        else:
+            # The search callback reads the query box as it was when the button was rendered,
+            # so the query is typed in one rerun and searched in the next
+            query = random_query(rng)
+            await stats.measure("search_input", session, lambda: [text_state(session.widget_id("search_query_box"), query)])
+            await stats.measure("search", session, lambda: [trigger_state(session.widget_id("button:Search"))])
+
+
+async def run_users(settings: dict, stats: LoadStats, users: int, concurrency: int) -> list:
+    sessions = []
+    semaphore = asyncio.Semaphore(concurrency or users)
+
+    async def limited(user: int):
+        async with semaphore:
+            await simulate_user(user, settings, stats, sessions)
+
+    await asyncio.gather(*[limited(user) for user in range(users)])
+    return sessions
+
+
+####################################################################################################
+# Report
+####################################################################################################
+
+def summarize(stats: LoadStats, rss_start: int, rss_end: int, users: int, seconds: float) -> dict:
+    interactions = {}
+    for interaction, latencies in stats.latencies.items():
+        interactions[interaction] = {
+            "count": len(latencies),
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p90_ms": percentile(latencies, 0.90) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": max(latencies) * 1000,
+            "es_calls_per_interaction": sum(stats.es_calls[interaction]) / len(latencies),
+            "llm_calls_per_interaction": sum(stats.llm_calls[interaction]) / len(latencies),
+        }
+    return {
+        "users": users,
+        "seconds": seconds,
+        "interactions": interactions,
+        "rss_start_mb": rss_start / 2 ** 20,
+        "rss_end_mb": rss_end / 2 ** 20,
+        "rss_per_session_kb": (rss_end - rss_start) / users / 1024 if users else 0,
+        "es_calls": stats.es_stub.calls(),
+        "llm_calls": stats.llm_stub.calls(),
+        "errors": stats.errors[:20],
+        "error_count": len(stats.errors),
+    }
+
+
+def print_report(report: dict):
+    print(f"{report['users']} users in {report['seconds']:.1f}s")
+    print(f"{'interaction':<16}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'es calls':>10}{'llm calls':>11}")
+    for name, result in report["interactions"].items():
+        print(f"{name:<16}{result['count']:>8}{result['p50_ms']:>10.1f}{result['p90_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['max_ms']:>10.1f}"
+              f"{result['es_calls_per_interaction']:>10.2f}{result['llm_calls_per_interaction']:>11.2f}")
+    print(f"Server RSS {report['rss_start_mb']:.1f} MB -> {report['rss_end_mb']:.1f} MB, {report['rss_per_session_kb']:.0f} KB per session")
+    print(f"Elasticsearch calls: {report['es_calls']}")
+    print(f"LLM calls: {report['llm_calls']}")
+    if report["error_count"]:
+        print(f"{report['error_count']} errors, e.g.:")
+        for error in report["errors"][:5]:
+            print(f"  {error}")
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Simulates concurrent users of the app against stub Elasticsearch and LLM servers")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=None, help="Users running at the same time, defaults to all of them")
+    parser.add_argument("--interactions", type=int, default=5, help="Searches and chat questions per user")
+    parser.add_argument("--chat-ratio", type=float, default=0.5, help="Fraction of the interactions that are chat questions")
+    parser.add_argument("--think-time", type=float, default=0.5, help="Maximum seconds a user waits between interactions")
+    parser.add_argument("--es-latency-ms", type=float, default=0)
+    parser.add_argument("--llm-latency-ms", type=float, default=0)
+    parser.add_argument("--llm-token-latency-ms", type=float, default=0)
+    parser.add_argument("--docs", type=int, default=1000, help="Documents in the stub index")
+    parser.add_argument("--monitoring", action="store_true", help="Ship the audit logs to the stub cluster as a monitoring cluster")
+    parser.add_argument("--port", type=int, default=None, help="Port of the Streamlit server, a free one by default")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds a rerun may take")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the Streamlit server")
+    parser.add_argument("--save", help="Write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    es_stub = start_es_stub(make_corpus(args.docs), latency_ms=args.es_latency_ms)
+    llm_stub = start_llm_stub(
+        latency_ms=args.llm_latency_ms,
+        token_latency_ms=args.llm_token_latency_ms,
+        tool_calls=[("search", {"query_text": "vector search"})]
+    )
+
+    # The app reads its connection defaults from the environment, which wins over a .env file
+    env = dict(os.environ, **{
+        "ELASTICSEARCH_URL": es_stub.url,
+        "ELASTICSEARCH_API_KEY": "load-test",
+        "LLM_TYPE": "azure",
+        "AZURE_OPENAI_KEY": "load-test",
+        "AZURE_OPENAI_ENDPOINT": llm_stub.url,
+        "AZURE_OPENAI_DEPLOYMENT_NAME": "load-test",
+        "ELASTIC_APM_ENABLED": "false",
+    })
+    if args.monitoring:
+        env.update({"MONITORING_ELASTICSEARCH_URL": es_stub.url, "MONITORING_API_KEY": "load-test", "LOGS_INDEX_NAME": "logs-load-test"})
+
+    port = args.port or free_port()
+    server = start_app_server(env, port, verbose=args.verbose, timeout=args.timeout)
+    settings = {
+        "url": f"ws://127.0.0.1:{port}/_stcore/stream",
+        "interactions": args.interactions,
+        "chat_ratio": args.chat_ratio,
+        "think_time": args.think_time,
+        "timeout": args.timeout,
+        "seed": args.seed,
+    }
+    stats = LoadStats(es_stub, llm_stub)
+
+    async def run() -> tuple:
+        # Warm up the server so imports and pooled clients are not counted as per session growth
+        warmup = AppSession(settings["url"], args.timeout)
+        await warmup.connect()
+        await warmup.rerun()
+        await warmup.close()
+        rss_start = process_rss_bytes(server.pid)
+        start = time.perf_counter()
+        sessions = await run_users(settings, stats, args.users, args.concurrency)
+        seconds = time.perf_counter() - start
+        rss_end = process_rss_bytes(server.pid)
+        for session in sessions:
+            await session.close()
+        return rss_start, rss_end, seconds
+
+    try:
+        rss_start, rss_end, seconds = asyncio.run(run())
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+        es_stub.stop()
+        llm_stub.stop()
+
+    report = summarize(stats, rss_start, rss_end, args.users, seconds)
+    print_report(report)
+
+    if args.save:
+        report.update({
+            "commit": git_commit(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "settings": vars(args),
+        })
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved the report to {args.save}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+# run.py
+#
+# Microbenchmarks of the search, rendering, chat and logging hot paths against in-process fakes.
+#
+# Run from the repository root:
+#   python -m benchmarks.run                                # run everything
+#   python -m benchmarks.run --filter search --es-latency-ms 5
+#   python -m benchmarks.run --save benchmarks/results/main.json
+#   python -m benchmarks.run --compare benchmarks/results/main.json
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+from fnmatch import fnmatch
+
+# The components read their templates relative to the repository root
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(repo_root)
+if repo_root not in sys.path:
+    sys.path.insert(0, repo_root)
+
+import streamlit as st
+from benchmarks.fakes import FakeElasticsearch, FakeOpenAI, make_corpus
+
+# Outside of `streamlit run` the session state is a plain in-memory state, the components use it as is
+session_state = st.session_state
+
+from components import elasticsearch as es_component
+from components.search_results import render_document, search_results_widget, default_md_template
+from components.llm import llm_chat
+from components.llm_functions import get_enabled_functions
+from components.llm_context import reset_context
+from llm_functions.get_content import get_content
+from tools.loggeres import ElasticHandler
+
+# Without an APM transaction every label call logs a warning
+logging.getLogger("elasticapm").setLevel(logging.ERROR)
+
+####################################################################################################
+# Benchmark Registry
+####################################################################################################
+
+benchmarks = {}
+
+
+def benchmark(name: str, iterations: int = None):
+    """
+    Registers a benchmark. The decorated function gets the settings and returns the operation to time,
+    a callable without arguments. It may return (operation, teardown).
+    """
+    def register(setup):
+        benchmarks[name] = {"setup": setup, "iterations": iterations}
+        return setup
+    return register
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_benchmark(name: str, settings: dict) -> dict:
+    entry = benchmarks[name]
+    iterations = entry["iterations"] or settings["iterations"]
+    if settings["es_latency_ms"] or settings["llm_latency_ms"]:
+        # Keep runs with network latency short
+        iterations = min(iterations, settings["latency_iterations"])
+    prepared = entry["setup"](settings)
+    operation, teardown = prepared if isinstance(prepared, tuple) else (prepared, None)
+    try:
+        for _ in range(min(settings["warmup"], iterations)):
+            operation()
+        samples = []
+        start = time.perf_counter()
+        for _ in range(iterations):
+            op_start = time.perf_counter_ns()
+            operation()
+            samples.append(time.perf_counter_ns() - op_start)
+        total = time.perf_counter() - start
+    finally:
+        if teardown:
+            teardown()
+    return {
+        "iterations": iterations,
+        "ops_per_sec": iterations / total if total else 0,
+        "mean_ms": statistics.fmean(samples) / 1e6,
+        "p50_ms": percentile(samples, 0.50) / 1e6,
+        "p99_ms": percentile(samples, 0.99) / 1e6,
+    }
+
+
+####################################################################################################
+# Session Setup
+####################################################################################################
+
+def reset_session(settings: dict, **overrides):
+    """
+    Puts the session state into the state of a connected app with fake clients.
+    """
+    for key in list(session_state.keys()):
+        del session_state[key]
+    es_client = FakeElasticsearch(settings["corpus"], latency_ms=settings["es_latency_ms"])
+    logger = logging.getLogger("benchmarks.audit")
+    logger.propagate = False
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+    with open("default_query_body.json") as f:
+        search_body = f.read()
+    session_state.update({
+        "es_client": es_client,
+        "es_client_key": ("benchmark", id(es_client)),
+        "index_name": "bench-index",
+        "search_body": search_body,
+        "num_results": settings["num_results"],
+        "doc_md_template": default_md_template,
+        "source_filtering": True,
+        "use_stored_template": False,
+        "logger_client": logger,
+        "messages": [],
+        "system_prompt": "You are a helpful assistant answering questions about the documents in the index.",
+        "azure_openai_deployment_name": "benchmark",
+        "semantic_cache_enabled": False,
+    })
+    session_state["llm_functions"] = get_enabled_functions()
+    session_state.update(overrides)
+    reset_context()
+    return es_client
+
+
+def set_search_cache_ttl(ttl: float) -> float:
+    # The search result cache is process wide, benchmarks turn it off unless they measure it
+    previous = es_component.search_result_cache.ttl
+    es_component.search_result_cache.clear()
+    es_component.search_result_cache.ttl = ttl
+    return previous
+
+
+def without_search_cache(operation):
+    previous = set_search_cache_ttl(0)
+    return operation, lambda: set_search_cache_ttl(previous)
+
+
+_devnull = open(os.devnull, "w")
+
+def silenced(operation):
+    # The components print diagnostics on every call, which would dominate the timings
+    def run():
+        with redirect_stdout(_devnull):
+            return operation()
+    return run
+
+
+####################################################################################################
+# Search
+####################################################################################################
+
+@benchmark("search.inline_template")
+def bench_search_inline(settings: dict):
+    reset_session(settings)
+    queries = [f"query number {number}" for number in range(100)]
+    counter = iter(range(10 ** 9))
+    return without_search_cache(silenced(lambda: es_component.get_elasticsearch_results(queries[next(counter) % 100])))
+
+
+@benchmark("search.stored_template")
+def bench_search_stored(settings: dict):
+    reset_session(settings, use_stored_template=True)
+    counter = iter(range(10 ** 9))
+    return without_search_cache(silenced(lambda: es_component.get_elasticsearch_results(f"query number {next(counter) % 100}")))
+
+
+@benchmark("search.full_source")
+def bench_search_full_source(settings: dict):
+    reset_session(settings, source_filtering=False)
+    counter = iter(range(10 ** 9))
+    return without_search_cache(silenced(lambda: es_component.get_elasticsearch_results(f"query number {next(counter) % 100}")))
+
+
+@benchmark("search.multi_query")
+def bench_search_multi_query(settings: dict):
+    # Rule based variants of a question in one _msearch, fused client side
+    reset_session(settings, multi_query_enabled=True)
+    counter = iter(range(10 ** 9))
+    return without_search_cache(silenced(lambda: es_component.get_multi_query_results(f"how does query number {next(counter) % 100} compare to ranking and recall")))
+
+
+@benchmark("search.diversity")
+def bench_search_diversity(settings: dict):
+    # Over-fetch and MMR re-ranking with MinHash signatures of the text
+    reset_session(settings, diversity_enabled=True)
+    counter = iter(range(10 ** 9))
+    return without_search_cache(silenced(lambda: es_component.get_elasticsearch_results(f"query number {next(counter) % 100}")))
+
+
+@benchmark("search.cache_hit")
+def bench_search_cache_hit(settings: dict):
+    reset_session(settings)
+    previous = set_search_cache_ttl(300)
+    run = silenced(lambda: es_component.get_elasticsearch_results("cached query"))
+    run()
+    return run, lambda: set_search_cache_ttl(previous)
+
+
+####################################################################################################
+# Rendering
+####################################################################################################
+
+@benchmark("render.render_document")
+def bench_render_document(settings: dict):
+    hits = settings["corpus"][:settings["num_results"]]
+    template = "## {title}\n\nBy {meta.author} ({meta.year})\n\n[{url}]({url})"
+
+    def render():
+        for hit in hits:
+            render_document(hit, template)
+    return render
+
+
+@benchmark("render.results_widget")
+def bench_results_widget(settings: dict):
+    reset_session(settings)
+    hits = settings["corpus"][:settings["num_results"]]
+    container = st.container()
+    return lambda: search_results_widget(container, hits, default_md_template)
+
+
+####################################################################################################
+# Chat
+####################################################################################################
+
+def chat_operation(settings: dict, streaming: bool, llm_async: bool = False):
+    es_client = reset_session(settings, llm_streaming=streaming, llm_async=llm_async)
+    titles = [hit["_source"]["title"] for hit in settings["corpus"][:3]]
+    llm_client = FakeOpenAI(
+        latency_ms=settings["llm_latency_ms"],
+        tool_calls=[("search", {"query_text": "vector search"}), ("get_content", {"titles": titles})]
+    )
+    session_state["llm_client"] = llm_client
+    container = st.container()
+
+    def chat():
+        # One question answered after a round of tool calls
+        session_state["messages"] = [{"role": "user", "content": "How does vector search rank documents?"}]
+        session_state["document_cache"] = {}
+        session_state["title_cache"] = {}
+        llm_chat(container)
+    return without_search_cache(silenced(chat))
+
+
+@benchmark("chat.tool_round")
+def bench_chat(settings: dict):
+    return chat_operation(settings, streaming=False)
+
+
+@benchmark("chat.tool_round_streaming")
+def bench_chat_streaming(settings: dict):
+    return chat_operation(settings, streaming=True)
+
+
+@benchmark("chat.tool_round_async")
+def bench_chat_async(settings: dict):
+    # The turn on the event loop, the fake clients run in worker threads
+    return chat_operation(settings, streaming=False, llm_async=True)
+
+
+####################################################################################################
+# get_content
+####################################################################################################
+
+@benchmark("get_content.result_set")
+def bench_get_content_result_set(settings: dict):
+    # Titles from the last search, the partial sources are fetched with one _mget
+    reset_session(settings)
+    hits = [dict(hit, _partial_source=True) for hit in settings["corpus"][:settings["num_results"]]]
+    es_component.set_search_results(hits)
+    titles = [hit["_source"]["title"] for hit in hits[:5]]
+
+    def lookup():
+        session_state["document_cache"] = {}
+        get_content(titles=titles)
+    return lookup
+
+
+@benchmark("get_content.fetch_by_title")
+def bench_get_content_fetch(settings: dict):
+    # Titles that are not in the last result set are found with one search
+    reset_session(settings)
+    es_component.set_search_results([])
+    titles = [hit["_source"]["title"] for hit in settings["corpus"][:5]]
+
+    def lookup():
+        session_state["title_cache"] = {}
+        session_state["document_cache"] = {}
+        get_content(titles=titles)
+    return lookup
+
+
+####################################################################################################
+# Logging
+####################################################################################################
+
+@benchmark("logging.elastic_handler_emit", iterations=20000)
+def bench_elastic_handler(settings: dict):
+    es_client = FakeElasticsearch([], latency_ms=settings["es_latency_ms"])
+    handler = ElasticHandler(logging.INFO, es_client, "bench-logs", max_queue_size=100000)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger = logging.getLogger("benchmarks.elastic_handler")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    def teardown():
+        logger.removeHandler(handler)
+        handler.close()
+        stats = handler.stats()
+        print(f"  elastic handler: {stats['shipped']} shipped, {stats['dropped']} dropped, {stats['failed']} failed in {es_client.calls.get('bulk', 0)} bulk requests")
+    return lambda: logger.info("User alice asked a question", extra={"query": "vector search"}), teardown
+
+
+####################################################################################################
+# Baselines
+####################################################################################################
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def print_results(results: dict, baseline: dict = None):
+    print(f"{'benchmark':<32}{'ops/sec':>12}{'p50 ms':>10}{'p99 ms':>10}" + (f"{'vs baseline':>14}" if baseline else ""))
+    for name, result in results.items():
+        line = f"{name:<32}{result['ops_per_sec']:>12,.1f}{result['p50_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+        if baseline:
+            previous = baseline["results"].get(name)
+            if previous and previous["ops_per_sec"]:
+                change = (result["ops_per_sec"] / previous["ops_per_sec"] - 1) * 100
+                line += f"{change:>+13.1f}%"
+            else:
+                line += f"{'new':>14}"
+        print(line)
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the RAG UI hot paths against fake clients")
+    parser.add_argument("--filter", default="*", help="Glob of the benchmarks to run, e.g. 'search.*'")
+    parser.add_argument("--list", action="store_true", help="List the benchmarks and exit")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--latency-iterations", type=int, default=50, help="Iterations when a latency is simulated")
+    parser.add_argument("--es-latency-ms", type=float, default=0, help="Latency of every Elasticsearch request")
+    parser.add_argument("--llm-latency-ms", type=float, default=0, help="Latency of every LLM completion")
+    parser.add_argument("--num-results", type=int, default=20)
+    parser.add_argument("--docs", type=int, default=1000, help="Documents in the fake index")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare with the results in this JSON file")
+    args = parser.parse_args(argv)
+
+    pattern = args.filter if any(char in args.filter for char in "*?[") else f"*{args.filter}*"
+    names = [name for name in benchmarks if fnmatch(name, pattern)]
+    if args.list:
+        print("\n".join(names))
+        return
+
+    settings = {
+        "iterations": args.iterations,
+        "warmup": args.warmup,
+        "latency_iterations": args.latency_iterations,
+        "es_latency_ms": args.es_latency_ms,
+        "llm_latency_ms": args.llm_latency_ms,
+        "num_results": args.num_results,
+        "docs": args.docs,
+    }
+    settings["corpus"] = make_corpus(args.docs)
+
+    results = {}
+    for name in names:
+        results[name] = run_benchmark(name, settings)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.compare} (commit {baseline.get('commit')})")
+    print_results(results, baseline)
+
+    if args.save:
+        report = {
+            "commit": git_commit(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "settings": {key: value for key, value in settings.items() if key != "corpus"},
+            "results": results,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved the results to {args.save}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# stub_servers.py
+
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+from benchmarks.fakes import FakeElasticsearch, FakeOpenAI
+
+####################################################################################################
+# Local HTTP stubs of Elasticsearch and Azure OpenAI
+####################################################################################################
+
+# The stubs serve the fakes over HTTP so the real clients, with their connection pools and
+# serialization, are exercised by the app. Every request is counted by route.
+
+
+class StubServer:
+    """
+    Runs a request handler on a local port in a background thread.
+
+    Parameters:
+    - handler (callable): Called with (method, path, query, body) and returns (status, headers, body).
+      The body may be bytes or an iterator of bytes for a streamed response.
+    """
+
+    def __init__(self, name: str, handler: callable, host: str = "127.0.0.1", port: int = 0):
+        self.name = name
+        self._handler = handler
+        self._calls = {}
+        self._calls_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._request_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"stub-{name}", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def calls(self) -> dict:
+        with self._calls_lock:
+            return dict(self._calls)
+
+    def total_calls(self) -> int:
+        with self._calls_lock:
+            return sum(self._calls.values())
+
+    def _count(self, route: str):
+        with self._calls_lock:
+            self._calls[route] = self._calls.get(route, 0) + 1
+
+    def _request_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _handle(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                raw_body = self.rfile.read(length) if length else b""
+                route, (status, headers, body) = stub._handler(self.command, url.path, parse_qs(url.query), raw_body)
+                stub._count(route)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if isinstance(body, bytes):
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    if self.command != "HEAD":
+                        self.wfile.write(body)
+                    return
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for part in body:
+                    self.wfile.write(f"{len(part):x}\r\n".encode() + part + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+            do_GET = do_POST = do_PUT = do_HEAD = do_DELETE = _handle
+
+        return Handler
+
+
+def json_response(body, status: int = 200, headers: dict = None) -> tuple:
+    return status, dict({"Content-Type": "application/json"}, **(headers or {})), json.dumps(body).encode()
+
+
+####################################################################################################
+# Elasticsearch
+####################################################################################################
+
+# The client refuses to talk to a server without the product header
+es_headers = {"X-Elastic-Product": "Elasticsearch"}
+
+
+def parse_ndjson(raw_body: bytes) -> list:
+    return [json.loads(line) for line in raw_body.splitlines() if line.strip()]
+
+
+def es_handler(fake: FakeElasticsearch) -> callable:
+    """
+    Returns a handler answering the Elasticsearch APIs used by the app from a FakeElasticsearch.
+    """
+    def handle(method: str, path: str, query: dict, raw_body: bytes) -> tuple:
+        parts = [part for part in path.split("/") if part]
+        body = json.loads(raw_body) if raw_body and not path.endswith(("_bulk", "_msearch")) else {}
+        if not parts:
+            if method == "HEAD":
+                return "ping", (200, es_headers, b"")
+            return "info", json_response(fake.info(), headers=es_headers)
+        if parts[-1] == "_search":
+            index = parts[0] if len(parts) > 1 else None
+            return "search", json_response(fake.search(index=index, body=body), headers=es_headers)
+        if parts[-2:] == ["_search", "template"]:
+            return "search_template", json_response(fake.search_template(id=body.get("id"), params=body.get("params")), headers=es_headers)
+        if parts[0] == "_scripts":
+            return "put_script", json_response(fake.put_script(id=parts[1], script=body.get("script")), headers=es_headers)
+        if parts[-1] == "_msearch":
+            return "msearch", json_response(fake.msearch(searches=parse_ndjson(raw_body)), headers=es_headers)
+        if parts[-1] == "_mget":
+            index = parts[0] if len(parts) > 1 else None
+            return "mget", json_response(fake.mget(docs=body.get("docs"), index=index, ids=body.get("ids")), headers=es_headers)
+        if parts[-1] == "_bulk":
+            return "bulk", json_response(fake.bulk(operations=parse_ndjson(raw_body)), headers=es_headers)
+        if parts[:2] == ["_cat", "indices"]:
+            return "cat.indices", json_response(fake.cat.indices(), headers=es_headers)
+        if parts[-1] == "_doc" or (len(parts) > 1 and parts[-2] == "_doc"):
+            return "index", json_response(fake.index(index=parts[0], document=body), headers=es_headers)
+        if len(parts) == 1 and method == "HEAD":
+            return "indices.exists", (200 if fake.indices.exists(index=parts[0]) else 404, es_headers, b"")
+        return f"{method} {path}", json_response({"acknowledged": True}, headers=es_headers)
+    return handle
+
+
+def start_es_stub(corpus: list = None, latency_ms: float = 0, port: int = 0) -> StubServer:
+    return StubServer("elasticsearch", es_handler(FakeElasticsearch(corpus, latency_ms=latency_ms)), port=port).start()
+
+
+####################################################################################################
+# Azure OpenAI
+####################################################################################################
+
+def to_json(value):
+    # The fake returns namespaces shaped like the client objects
+    if isinstance(value, SimpleNamespace):
+        return {key: to_json(item) for key, item in vars(value).items()}
+    if isinstance(value, list):
+        return [to_json(item) for item in value]
+    return value
+
+
+_deployment_pattern = re.compile(r"^/openai/deployments/(?P<deployment>[^/]+)/chat/completions$")
+
+
+def llm_handler(fake: FakeOpenAI) -> callable:
+    """
+    Returns a handler answering Azure OpenAI chat completions from a FakeOpenAI.
+    """
+    def handle(method: str, path: str, query: dict, raw_body: bytes) -> tuple:
+        if path.endswith("/models"):
+            return "models.list", json_response({"object": "list", "data": []})
+        match = _deployment_pattern.match(path)
+        if not match:
+            return f"{method} {path}", json_response({"error": {"message": f"Unknown path {path}"}}, status=404)
+        request = json.loads(raw_body)
+        envelope = {"id": "chatcmpl-stub", "created": int(time.time()), "model": match.group("deployment")}
+        result = fake.create(model=match.group("deployment"), messages=request["messages"], stream=request.get("stream", False), tools=request.get("tools"))
+        if not request.get("stream"):
+            response = to_json(result)
+            for index, choice in enumerate(response["choices"]):
+                choice["index"] = index
+                choice["message"]["role"] = "assistant"
+                for tool_call in choice["message"]["tool_calls"] or []:
+                    tool_call["type"] = "function"
+            return "chat.completions", json_response(dict(envelope, object="chat.completion", choices=response["choices"]))
+
+        def events():
+            for chunk in result:
+                data = dict(envelope, object="chat.completion.chunk", choices=[dict(choice, index=0) for choice in to_json(chunk)["choices"]])
+                for choice in data["choices"]:
+                    for tool_call in choice["delta"].get("tool_calls") or []:
+                        tool_call["type"] = "function"
+                yield f"data: {json.dumps(data)}\n\n".encode()
+            yield b"data: [DONE]\n\n"
+        return "chat.completions.stream", (200, {"Content-Type": "text/event-stream"}, events())
+    return handle
+
+
+def start_llm_stub(latency_ms: float = 0, token_latency_ms: float = 0, tool_calls: list = None, port: int = 0) -> StubServer:
+    return StubServer("llm", llm_handler(FakeOpenAI(latency_ms=latency_ms, token_latency_ms=token_latency_ms, tool_calls=tool_calls)), port=port).start()
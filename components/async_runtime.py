@@ -0,0 +1,178 @@
+# async_runtime.py
+
+import asyncio
+import atexit
+import contextvars
+import hashlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from components.session import session_state, capture_state, use_state
+from components.elasticsearch_connection import es_client_key, es_connections_per_node, async_executor_workers
+from components.registry import BoundedRegistry
+from components.traffic_replay import get_traffic_store
+
+try:
+    from elasticsearch import AsyncElasticsearch
+    import aiohttp  # AsyncElasticsearch needs it for its HTTP connections
+except ImportError:
+    AsyncElasticsearch = None
+
+try:
+    from openai import AsyncAzureOpenAI
+except ImportError:
+    AsyncAzureOpenAI = None
+
+####################################################################################################
+# Event Loop
+####################################################################################################
+
+# The async pipeline runs on one event loop per process, in a background thread. The Streamlit script
+# and the HTTP API stay synchronous and call into it through run_sync, which blocks the calling
+# thread while the coroutine overlaps its I/O on the loop. The blocking calls of every session go
+# through asyncio.to_thread, so the loop gets its own executor of ASYNC_EXECUTOR_WORKERS threads
+# instead of the small default one, which would queue the turns of concurrent sessions.
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the process wide event loop, starting its thread on first use.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(ThreadPoolExecutor(max_workers=async_executor_workers, thread_name_prefix="async-runtime-worker"))
+            threading.Thread(target=loop.run_forever, name="async-runtime", daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+def run_sync(function: callable, *args, on_event: callable = None, **kwargs):
+    """
+    Runs the coroutine function on the event loop and returns its result.
+
+    The coroutine runs with the session state and the context variables (e.g. the APM transaction)
+    of the caller. When on_event is given, the function is passed an on_event callback whose events
+    are delivered to on_event in the calling thread, so they can update the Streamlit UI.
+
+    The coroutine writes a Streamlit session state without its lock (see capture_state), so on_event
+    must render from the event data only and not read or write the session state meanwhile.
+
+    Parameters:
+    - function (callable): The coroutine function.
+    - on_event (callable): Receives the events of the function, called in the calling thread.
+    """
+    loop = get_event_loop()
+    state = capture_state()
+    context = contextvars.copy_context()
+    events = queue.Queue()
+    done = object()
+    task = None
+
+    if on_event is not None:
+        kwargs["on_event"] = lambda event, data=None: events.put((event, data))
+
+    async def run():
+        with use_state(state):
+            return await function(*args, **kwargs)
+
+    def start():
+        nonlocal task
+        task = loop.create_task(run(), context=context)
+        task.add_done_callback(lambda task: events.put(done))
+
+    loop.call_soon_threadsafe(start)
+    try:
+        while True:
+            item = events.get()
+            if item is done:
+                break
+            if on_event is not None:
+                on_event(*item)
+    except BaseException:
+        # e.g. Streamlit stopping the script for a rerun, the turn is abandoned
+        loop.call_soon_threadsafe(lambda: task is not None and task.cancel())
+        raise
+    return task.result()
+
+
+####################################################################################################
+# Async Clients
+####################################################################################################
+
+# Async clients are bound to the loop, so they are pooled per process like the sync clients but only
+# used from coroutines running on it. None is returned when the async client cannot be used, the
+# callers then run the sync client in a worker thread. Recording and replaying traffic works on the
+# sync clients, so TRAFFIC_MODE also selects them.
+def close_async_client(client):
+    # Evicted clients are closed on the loop they belong to
+    if _loop is not None and _loop.is_running():
+        asyncio.run_coroutine_threadsafe(_close_clients([client]), _loop)
+
+
+_async_client_registry = BoundedRegistry("async client", close_async_client)
+
+
+def traffic_mode() -> bool:
+    return get_traffic_store() is not None
+
+
+def get_async_es_client():
+    """
+    Returns the shared AsyncElasticsearch client for the credentials of the session, or None.
+    """
+    cloud_id = session_state.get("cloud_id")
+    elasticsearch_url = session_state.get("elasticsearch_url")
+    if AsyncElasticsearch is None or traffic_mode() or (not cloud_id and not elasticsearch_url):
+        return None
+    api_key = session_state.get("api_key")
+    key = ("elasticsearch",) + es_client_key(cloud_id, elasticsearch_url, api_key)
+
+    def create():
+        print(f"Creating pooled async Elasticsearch client for {key[2]}")
+        if cloud_id:
+            return AsyncElasticsearch(cloud_id=cloud_id, api_key=api_key, connections_per_node=es_connections_per_node)
+        return AsyncElasticsearch(hosts=[elasticsearch_url], api_key=api_key, connections_per_node=es_connections_per_node)
+
+    return _async_client_registry.get(key, create)
+
+
+def get_async_llm_client():
+    """
+    Returns the shared async Azure OpenAI client for the settings of the session, or None.
+    """
+    azure_openai_endpoint = session_state.get("azure_openai_endpoint")
+    if AsyncAzureOpenAI is None or traffic_mode() or session_state.get("llm_type") != "azure" or not azure_openai_endpoint:
+        return None
+    azure_openai_key = session_state.get("azure_openai_key")
+    api_key_hash = hashlib.sha256(azure_openai_key.encode()).hexdigest() if azure_openai_key else None
+    key = ("azure", azure_openai_endpoint, api_key_hash)
+    return _async_client_registry.get(key, lambda: AsyncAzureOpenAI(
+        api_key=azure_openai_key,
+        api_version="2024-02-01",
+        azure_endpoint=azure_openai_endpoint
+    ))
+
+
+async def _close_clients(clients: list):
+    for client in clients:
+        try:
+            await client.close()
+        except Exception as e:
+            print(e)
+
+
+def close_async_clients():
+    # Close every pooled async client on the loop, used at process shutdown
+    clients = _async_client_registry.take_all()
+    if not clients or _loop is None or not _loop.is_running():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(_close_clients(clients), _loop).result(timeout=5)
+    except Exception as e:
+        print(e)
+
+atexit.register(close_async_clients)
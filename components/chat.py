@@ -0,0 +1,499 @@
+# chat.py
+
+import asyncio
+import contextvars
+import os
+import json
+import threading
+import time
+import elasticapm
+from concurrent.futures import ThreadPoolExecutor
+from elasticapm.traces import execution_context
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from components.session import session_state, capture_state, use_state
+from components.semantic_cache import get_semantic_cache, store_answer, record_cache_hit, default_seed_threshold, default_return_threshold
+from components.llm_context import build_context, fit_tool_results
+from components.async_runtime import get_async_llm_client
+
+####################################################################################################
+# Chat Turn
+####################################################################################################
+
+# One chat turn without any UI: the completion loop with its tool calls, the semantic cache and the
+# audit log. Progress is reported through an on_event callback so the Streamlit view and the HTTP
+# API can present it their own way. The events are:
+# - "completion_start": a completion was requested.
+# - "content": the content received so far (streaming only).
+# - "completion_end": the final content of the completion, empty when it only called tools.
+# - "tool_call": a tool call with its name and parsed arguments, before it runs.
+
+
+def no_events(event: str, data=None):
+    pass
+
+
+def stream_completion(llm_client, messages: list, tools: list, on_event: callable = no_events) -> tuple:
+    """
+    Runs a streaming chat completion, reporting the content as it arrives.
+
+    Tool call deltas are assembled by their index so the caller can run the calls as with a non
+    streaming completion.
+
+    Returns:
+        tuple: finish_reason, content, tool_calls (list of {"id", "name", "arguments"}) and the
+        perf_counter time of the first token (or None if nothing was received).
+    """
+    stream = llm_client.chat.completions.create(
+                    model=session_state.get("azure_openai_deployment_name"),
+                    messages=messages,
+                    stream=True,
+                    **tools_arguments(tools)
+                )
+    content = ""
+    tool_calls = {}
+    finish_reason = None
+    first_token = None
+    for chunk in stream:
+        piece, chunk_finish_reason, received = read_chunk(chunk, tool_calls)
+        if received and first_token is None:
+            first_token = time.perf_counter()
+        if piece:
+            content += piece
+            on_event("content", content)
+        finish_reason = chunk_finish_reason or finish_reason
+    return finish_reason, content, [tool_calls[index] for index in sorted(tool_calls)], first_token
+
+
+def read_chunk(chunk, tool_calls: dict) -> tuple:
+    """
+    Adds the tool call deltas of a streamed chunk to tool_calls, keyed by their index.
+
+    Returns:
+        tuple: The content of the chunk, its finish_reason and whether it carried a token.
+    """
+    # Azure sends chunks without choices, e.g. for the content filter results
+    if not chunk.choices:
+        return None, None, False
+    choice = chunk.choices[0]
+    delta = choice.delta
+    received = False
+    content = None
+    if delta is not None:
+        if delta.tool_calls:
+            received = True
+            for tool_call_delta in delta.tool_calls:
+                tool_call = tool_calls.setdefault(tool_call_delta.index, {"id": "", "name": "", "arguments": ""})
+                if tool_call_delta.id:
+                    tool_call["id"] = tool_call_delta.id
+                if tool_call_delta.function is not None:
+                    if tool_call_delta.function.name:
+                        tool_call["name"] += tool_call_delta.function.name
+                    if tool_call_delta.function.arguments:
+                        tool_call["arguments"] += tool_call_delta.function.arguments
+        if delta.content:
+            received = True
+            content = delta.content
+    return content, choice.finish_reason, received
+
+
+def complete(llm_client, messages: list, tools: list) -> tuple:
+    # Non streaming completion with the same result as stream_completion
+    response = llm_client.chat.completions.create(
+                    model=session_state.get("azure_openai_deployment_name"),
+                    messages=messages,
+                    stream=False,
+                    **tools_arguments(tools)
+                )
+    return read_completion(response)
+
+
+def read_completion(response) -> tuple:
+    choice = response.choices[0]
+    tool_calls = []
+    for tool_call in choice.message.tool_calls or []:
+        tool_calls.append({"id": tool_call.id, "name": tool_call.function.name, "arguments": tool_call.function.arguments})
+    return choice.finish_reason, choice.message.content, tool_calls
+
+
+def tools_arguments(tools: list) -> dict:
+    # The API rejects an empty tools list
+    if not tools:
+        return {}
+    return {"tools": tools}
+
+
+def call_function(function: callable, tool_call: dict):
+    # Errors are returned to the LLM as the result of the call
+    if function is None:
+        return f"Unknown function {tool_call['name']}"
+    try:
+        return function(**tool_call["parsed_arguments"])
+    except Exception as e:
+        print(f"Error calling {tool_call['name']}: {e}")
+        return f"Error: {e}"
+
+
+# Tool calls of one turn run concurrently on a bounded pool shared by all sessions
+tool_call_workers = int(os.getenv("LLM_TOOL_CALL_WORKERS", "8"))
+_tool_call_executor = ThreadPoolExecutor(max_workers=tool_call_workers, thread_name_prefix="llm-tool-call")
+
+def run_tool_calls(tool_calls: list, function_functions: dict) -> list:
+    """
+    Runs the tool calls of one turn concurrently.
+
+    Each call runs in its own APM span with the context of the caller, i.e. the Streamlit script
+    context or the active headless session, so the functions can use the session state. The state
+    is captured in the caller's thread: in a widget callback the script thread holds the lock of
+    st.session_state until the calls return, so the workers must not go through it.
+
+    Returns:
+        list: The results in the same order as the tool calls.
+    """
+    script_run_ctx = get_script_run_ctx()
+    state = capture_state()
+    transaction = execution_context.get_transaction()
+    parent_span = execution_context.get_span()
+
+    def run(tool_call: dict):
+        if script_run_ctx is not None:
+            add_script_run_ctx(threading.current_thread(), script_run_ctx)
+        # A single call runs in the caller's thread, so the APM context of the thread is restored afterwards
+        previous_transaction = execution_context.get_transaction()
+        previous_span = execution_context.get_span()
+        execution_context.set_transaction(transaction)
+        execution_context.set_span(parent_span)
+        try:
+            with use_state(state), elasticapm.capture_span(f"tool_call {tool_call['name']}", span_type="llm_function", labels={"tool_call_id": tool_call["id"]}):
+                return call_function(function_functions.get(tool_call["name"]), tool_call)
+        finally:
+            execution_context.set_transaction(previous_transaction)
+            execution_context.set_span(previous_span)
+
+    if len(tool_calls) == 1:
+        return [run(tool_calls[0])]
+    futures = [_tool_call_executor.submit(contextvars.copy_context().run, run, tool_call) for tool_call in tool_calls]
+    return [future.result() for future in futures]
+
+
+def lookup_cached_answer(history: list) -> tuple:
+    """
+    Looks up a standalone question in the semantic answer cache.
+
+    Follow up questions depend on the conversation so they always go to the LLM.
+
+    Returns:
+        tuple: The semantic cache (or None), the cached entry (or None) and whether it is returned as is.
+    """
+    semantic_cache = get_semantic_cache()
+    cached_entry = None
+    if semantic_cache is not None and len(history) == 1:
+        try:
+            cached_entry = semantic_cache.lookup(history[-1]["content"], session_state.get("semantic_cache_seed_threshold", default_seed_threshold))
+        except Exception as e:
+            print(f"Error looking up the semantic cache: {e}")
+    cache_hit = cached_entry is not None and cached_entry["similarity"] >= session_state.get("semantic_cache_return_threshold", default_return_threshold)
+    return semantic_cache, cached_entry, cache_hit
+
+
+def label_cached_answer(semantic_cache, cached_entry: dict, cache_hit: bool):
+    if cached_entry is not None:
+        elasticapm.label(semantic_cache="hit" if cache_hit else "seed", semantic_cache_similarity=round(cached_entry["similarity"], 4))
+    elif semantic_cache is not None:
+        elasticapm.label(semantic_cache="miss")
+
+
+def seed_messages(messages: list, cached_entry: dict):
+    # A similar but not close enough answer is given to the LLM as a hint
+    messages[0] = dict(messages[0], content=messages[0]["content"] + f"\n\nA previous answer to the similar question \"{cached_entry['query']}\" was:\n{cached_entry['reply']}")
+
+
+def parse_tool_calls(tool_calls: list, on_event: callable):
+    print(f"LLM Tool Calls: {len(tool_calls)}")
+    for tool_call in tool_calls:
+        function_args = tool_call["arguments"]
+        if isinstance(function_args, str):
+            function_args = json.loads(function_args) if function_args else {}
+        tool_call["parsed_arguments"] = function_args
+        print(tool_call["name"])
+        print(function_args)
+        on_event("tool_call", {"name": tool_call["name"], "arguments": function_args})
+
+
+def append_tool_messages(messages: list, content: str, tool_calls: list, results: list):
+    messages.append(
+        {
+            "role": "assistant",
+            "content": content or None,
+            "tool_calls": [
+                {
+                    "id": tool_call["id"],
+                    "type": "function",
+                    "function": {
+                        "name": tool_call["name"],
+                        "arguments": json.dumps(tool_call["parsed_arguments"]),
+                    },
+                }
+                for tool_call in tool_calls
+            ],
+        }
+    )
+    for tool_call, result in zip(tool_calls, results):
+        messages.append(
+            {
+                "role": "tool",
+                "tool_call_id": tool_call["id"],
+                "content": json.dumps({"result": result}, default=str)
+            }
+        )
+
+
+def label_generation(chat_start: float, time_to_first_token: float, streaming: bool, last_message: str):
+    if time_to_first_token is not None:
+        elasticapm.label(llm_time_to_first_token_ms=round(time_to_first_token * 1000))
+    elasticapm.label(llm_generation_ms=round((time.perf_counter() - chat_start) * 1000), llm_streaming=streaming)
+    elasticapm.label(es_query=last_message)
+
+
+def turn_audit_state() -> dict:
+    # The session values finish_turn needs, read before the turn returns to the script
+    return {
+        "user_name": session_state.get("user_name", "alice"),
+        "search_results": session_state.get("search_results"),
+        "logger": session_state.get("logger_client"),
+    }
+
+
+def finish_turn(last_message: str, response: str, semantic_cache, cached_entry: dict, cache_hit: bool, standalone: bool, user_name: str, search_results: list, logger):
+    """
+    Writes the audit log and stores a new standalone answer in the semantic cache.
+
+    It can run after the turn has returned, so it does not use the session state: the caller passes
+    the values of turn_audit_state.
+    """
+    audit_message = f'User {user_name} asked {last_message} and received {response}'
+    audit_context = {'user.full_name': user_name}
+    audit_context['reply'] = response
+    audit_context['query'] = last_message
+    audit_context['doc_references'] = []
+    if cache_hit:
+        audit_context['doc_references'] = list(cached_entry.get("doc_references") or [])
+    elif search_results is not None:
+        for result in search_results:
+            audit_context['doc_references'].append(result["_source"]["title"])
+    audit_context['semantic_cache_hit'] = cache_hit
+    if logger is not None:
+        logger.info(audit_message,extra=audit_context)
+    if semantic_cache is not None and not cache_hit and standalone and response:
+        store_answer(semantic_cache, last_message, response, audit_context['doc_references'], user_name)
+
+
+@elasticapm.capture_span("llm_chat")
+def chat_turn(on_event: callable = no_events) -> str:
+    """
+    Answers the last message of the session's chat history.
+
+    Returns:
+        str: The reply, which the caller adds to the history.
+    """
+    llm_client = session_state.get("llm_client")
+
+    system_prompt = session_state.get("system_prompt")
+
+    history = session_state["messages"]
+
+    # The newest turns within the token budget, older turns are folded into a running summary
+    messages = build_context(llm_client, system_prompt, history)
+    last_message = history[-1]["content"]
+
+    llm_funct = session_state.get("llm_functions") or []
+
+    tools = []
+    function_functions = {}
+
+    # The registry entries already hold the tool payloads and callables
+    for function in llm_funct:
+        tools.append(function["tool"])
+        function_functions[function["definition"]["name"]] = function["function"]
+
+    streaming = session_state.get("llm_streaming", True)
+    chat_start = time.perf_counter()
+    time_to_first_token = None
+
+    # Standalone questions are looked up in the semantic answer cache before calling the LLM
+    semantic_cache, cached_entry, cache_hit = lookup_cached_answer(history)
+    label_cached_answer(semantic_cache, cached_entry, cache_hit)
+    if cache_hit:
+        response = cached_entry["reply"]
+        record_cache_hit(semantic_cache, cached_entry["_id"])
+        on_event("completion_start")
+        on_event("completion_end", response)
+    elif cached_entry is not None:
+        seed_messages(messages, cached_entry)
+
+    user_reply = cache_hit
+    while user_reply == False:
+        on_event("completion_start")
+        if streaming:
+            finish_reason, content, tool_calls, first_token = stream_completion(llm_client, fit_tool_results(messages), tools, on_event)
+            if time_to_first_token is None and first_token is not None:
+                time_to_first_token = first_token - chat_start
+        else:
+            finish_reason, content, tool_calls = complete(llm_client, fit_tool_results(messages), tools)
+        on_event("completion_end", content or "")
+        if tool_calls:
+            parse_tool_calls(tool_calls, on_event)
+            results = run_tool_calls(tool_calls, function_functions)
+            append_tool_messages(messages, content, tool_calls, results)
+        else:
+            user_reply = True
+            response = content
+
+    label_generation(chat_start, time_to_first_token, streaming, last_message)
+    finish_turn(last_message, response, semantic_cache, cached_entry, cache_hit, len(history) == 1, **turn_audit_state())
+
+    return response
+
+
+####################################################################################################
+# Async Chat Turn
+####################################################################################################
+
+# The same turn as a coroutine for components.async_runtime. Independent I/O overlaps: the context
+# is built while the semantic cache is looked up, the tool calls of a completion run together and
+# the audit log is written while the reply is returned. Functions with an async variant run on the
+# loop, the others and the sync only steps (context summary, semantic cache) in worker threads.
+
+async def async_stream_completion(llm_client, messages: list, tools: list, on_event: callable = no_events) -> tuple:
+    # stream_completion with an async client
+    stream = await llm_client.chat.completions.create(
+                    model=session_state.get("azure_openai_deployment_name"),
+                    messages=messages,
+                    stream=True,
+                    **tools_arguments(tools)
+                )
+    content = ""
+    tool_calls = {}
+    finish_reason = None
+    first_token = None
+    async for chunk in stream:
+        piece, chunk_finish_reason, received = read_chunk(chunk, tool_calls)
+        if received and first_token is None:
+            first_token = time.perf_counter()
+        if piece:
+            content += piece
+            on_event("content", content)
+        finish_reason = chunk_finish_reason or finish_reason
+    return finish_reason, content, [tool_calls[index] for index in sorted(tool_calls)], first_token
+
+
+async def async_complete(llm_client, messages: list, tools: list) -> tuple:
+    response = await llm_client.chat.completions.create(
+                    model=session_state.get("azure_openai_deployment_name"),
+                    messages=messages,
+                    stream=False,
+                    **tools_arguments(tools)
+                )
+    return read_completion(response)
+
+
+async def async_run_tool_calls(tool_calls: list, functions: dict) -> list:
+    """
+    Runs the tool calls of one turn concurrently on the event loop.
+
+    Returns:
+        list: The results in the same order as the tool calls.
+    """
+    async def run(tool_call: dict):
+        with elasticapm.capture_span(f"tool_call {tool_call['name']}", span_type="llm_function", labels={"tool_call_id": tool_call["id"]}):
+            function = functions.get(tool_call["name"])
+            if function is None or function["async_function"] is None:
+                return await asyncio.to_thread(call_function, function and function["function"], tool_call)
+            try:
+                return await function["async_function"](**tool_call["parsed_arguments"])
+            except Exception as e:
+                print(f"Error calling {tool_call['name']}: {e}")
+                return f"Error: {e}"
+
+    return await asyncio.gather(*(run(tool_call) for tool_call in tool_calls))
+
+
+@elasticapm.async_capture_span("llm_chat")
+async def async_chat_turn(on_event: callable = no_events) -> str:
+    """
+    Answers the last message of the session's chat history, like chat_turn.
+
+    The pooled async LLM client is used when there is one for the session's settings, the session's
+    sync client in a worker thread otherwise.
+
+    Returns:
+        str: The reply, which the caller adds to the history.
+    """
+    llm_client = session_state.get("llm_client")
+    async_llm_client = get_async_llm_client()
+
+    history = session_state["messages"]
+    last_message = history[-1]["content"]
+
+    tools = []
+    functions = {}
+    for function in session_state.get("llm_functions") or []:
+        tools.append(function["tool"])
+        functions[function["definition"]["name"]] = function
+
+    streaming = session_state.get("llm_streaming", True)
+    chat_start = time.perf_counter()
+    time_to_first_token = None
+
+    (messages, (semantic_cache, cached_entry, cache_hit)) = await asyncio.gather(
+        asyncio.to_thread(build_context, llm_client, session_state.get("system_prompt"), history),
+        asyncio.to_thread(lookup_cached_answer, history)
+    )
+    label_cached_answer(semantic_cache, cached_entry, cache_hit)
+    if cache_hit:
+        response = cached_entry["reply"]
+        record_cache_hit(semantic_cache, cached_entry["_id"])
+        on_event("completion_start")
+        on_event("completion_end", response)
+    elif cached_entry is not None:
+        seed_messages(messages, cached_entry)
+
+    user_reply = cache_hit
+    while user_reply == False:
+        on_event("completion_start")
+        if streaming:
+            if async_llm_client is not None:
+                finish_reason, content, tool_calls, first_token = await async_stream_completion(async_llm_client, fit_tool_results(messages), tools, on_event)
+            else:
+                finish_reason, content, tool_calls, first_token = await asyncio.to_thread(stream_completion, llm_client, fit_tool_results(messages), tools, on_event)
+            if time_to_first_token is None and first_token is not None:
+                time_to_first_token = first_token - chat_start
+        elif async_llm_client is not None:
+            finish_reason, content, tool_calls = await async_complete(async_llm_client, fit_tool_results(messages), tools)
+        else:
+            finish_reason, content, tool_calls = await asyncio.to_thread(complete, llm_client, fit_tool_results(messages), tools)
+        on_event("completion_end", content or "")
+        if tool_calls:
+            parse_tool_calls(tool_calls, on_event)
+            results = await async_run_tool_calls(tool_calls, functions)
+            append_tool_messages(messages, content, tool_calls, results)
+        else:
+            user_reply = True
+            response = content
+
+    label_generation(chat_start, time_to_first_token, streaming, last_message)
+    # The log handler and the cache write may block, the turn is done once they are started. The
+    # session state is read now, the script owns it again once the turn has returned
+    finishing = asyncio.create_task(asyncio.to_thread(finish_turn, last_message, response, semantic_cache, cached_entry, cache_hit, len(history) == 1, **turn_audit_state()))
+    _background_tasks.add(finishing)
+    finishing.add_done_callback(finished_background_task)
+
+    return response
+
+
+# Keeps a reference to the tasks left running after a turn until they finish
+_background_tasks = set()
+
+def finished_background_task(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Error finishing the chat turn: {task.exception()}")
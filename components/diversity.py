@@ -0,0 +1,193 @@
+# diversity.py
+
+import os
+import zlib
+from itertools import chain
+import numpy as np
+from components.session import session_state
+
+####################################################################################################
+# Diversity Re-ranking
+####################################################################################################
+
+# Chunked corpora return several near identical hits of the same document. With diversity_enabled
+# the search over-fetches and re-ranks the hits with maximal marginal relevance: each pick is the hit
+# with the best trade-off between its relevance and its similarity to the hits already picked, and
+# at most diversity_max_per_parent hits of one parent document are kept. Similarity comes from a
+# stored dense vector field, or from MinHash signatures of the text shingles when there is none.
+default_lambda = float(os.getenv("DIVERSITY_LAMBDA", "0.7"))
+default_over_fetch = int(os.getenv("DIVERSITY_OVER_FETCH", "3"))
+default_parent_field = os.getenv("DIVERSITY_PARENT_FIELD", "title")
+default_text_field = os.getenv("DIVERSITY_TEXT_FIELD", "text")
+
+minhash_permutations = 64
+shingle_size = 3
+_random = np.random.default_rng(1)
+# Multiply-shift hash functions, the high 32 bits of (a * x + b) mod 2^64 with a odd
+_hash_a = _random.integers(0, 1 << 63, size=minhash_permutations, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+_hash_b = _random.integers(0, 1 << 63, size=minhash_permutations, dtype=np.uint64)
+
+
+def diversity_settings() -> dict:
+    """
+    Returns the diversity settings of the session, or None when re-ranking is off.
+    """
+    if not session_state.get("diversity_enabled", False):
+        return None
+    return {
+        "lambda": float(session_state.get("diversity_lambda", default_lambda)),
+        "over_fetch": max(1, int(session_state.get("diversity_over_fetch", default_over_fetch))),
+        "parent_field": session_state.get("diversity_parent_field", default_parent_field) or None,
+        "max_per_parent": max(1, int(session_state.get("diversity_max_per_parent", 1))),
+        "vector_field": session_state.get("diversity_vector_field") or None,
+        "text_field": session_state.get("diversity_text_field", default_text_field),
+    }
+
+
+def source_fields(settings: dict) -> list:
+    # Source fields the re-ranking reads from the hits
+    fields = [settings["vector_field"] or settings["text_field"]]
+    if settings["parent_field"]:
+        fields.append(settings["parent_field"])
+    return fields
+
+
+def source_value(source: dict, field: str):
+    # Value of a field of a source, dotted names are looked up in nested objects
+    value = source
+    for part in field.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def minhash_signatures(texts: list) -> tuple:
+    """
+    Returns the MinHash signatures of the word shingles of texts, computed for all texts at once.
+
+    Texts shorter than a shingle are represented by their words.
+
+    Returns:
+        tuple: The signatures, one row per text, and a mask of the texts that had any shingle.
+    """
+    if not texts:
+        return np.zeros((0, minhash_permutations), dtype=np.uint64), np.zeros(0, dtype=bool)
+    # Whitespace separated words, splitting is much cheaper than a word pattern
+    tokens = [(text or "").lower().split() for text in texts]
+    lengths = np.array([len(text_tokens) for text_tokens in tokens], dtype=np.int64)
+    # Every distinct word is hashed once
+    flat = list(chain.from_iterable(tokens))
+    word_hashes = {word: zlib.crc32(word.encode()) for word in dict.fromkeys(flat)}
+    hashes = np.fromiter(map(word_hashes.__getitem__, flat), dtype=np.uint64, count=len(flat))
+    text_index = np.repeat(np.arange(len(texts)), lengths)
+
+    # Hash of each run of shingle_size words, runs crossing into the next text are dropped
+    n_runs = max(len(hashes) - shingle_size + 1, 0)
+    combined = hashes[:n_runs].copy()
+    for offset in range(1, shingle_size):
+        combined = (combined * np.uint64(1000003)) ^ hashes[offset:offset + n_runs]
+    within = text_index[:n_runs] == text_index[shingle_size - 1:shingle_size - 1 + n_runs]
+    shingle_hashes = combined[within] & np.uint64(0xFFFFFFFF)
+    shingle_texts = text_index[:n_runs][within]
+    short = lengths[text_index] < shingle_size
+    shingle_hashes = np.concatenate([shingle_hashes, hashes[short]])
+    shingle_texts = np.concatenate([shingle_texts, text_index[short]])
+
+    # Distinct shingles sorted by text, texts without any get a placeholder so no segment is empty
+    present = np.bincount(shingle_texts, minlength=len(texts)) > 0
+    shingle_hashes = np.concatenate([shingle_hashes, np.zeros(int((~present).sum()), dtype=np.uint64)])
+    shingle_texts = np.concatenate([shingle_texts, np.flatnonzero(~present)])
+    keys = np.sort((shingle_texts.astype(np.uint64) << np.uint64(32)) | shingle_hashes)
+    keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+    starts = np.searchsorted(keys >> np.uint64(32), np.arange(len(texts), dtype=np.uint64))
+    # One row per hash function, computed in place over all shingles
+    permuted = np.multiply(_hash_a[:, None], (keys & np.uint64(0xFFFFFFFF))[None, :])
+    permuted += _hash_b[:, None]
+    permuted >>= np.uint64(32)
+    signatures = np.minimum.reduceat(permuted, starts, axis=1).T
+    return signatures, present
+
+
+def minhash_similarity(texts: list) -> np.ndarray:
+    # Estimated Jaccard similarity of the shingles of every pair of texts
+    signatures, present = minhash_signatures(texts)
+    similarity = (signatures[:, None, :] == signatures[None, :, :]).mean(axis=2)
+    similarity[~present, :] = 0
+    similarity[:, ~present] = 0
+    return similarity
+
+
+def cosine_similarity(vectors: list) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = matrix / np.where(norms > 0, norms, 1)
+    return matrix @ matrix.T
+
+
+def maximal_marginal_relevance(relevance: np.ndarray, similarity: np.ndarray, k: int, lambda_: float = default_lambda, groups: np.ndarray = None, max_per_group: int = 1) -> list:
+    """
+    Selects k items greedily by maximal marginal relevance.
+
+    Parameters:
+    - relevance (np.ndarray): Relevance of each item, in [0, 1].
+    - similarity (np.ndarray): Pairwise similarity of the items.
+    - k (int): Number of items to select.
+    - lambda_ (float): Weight of the relevance, 1 ranks by relevance only.
+    - groups (np.ndarray): Group code of each item, at most max_per_group items of a group are selected.
+    - max_per_group (int): Maximum number of items selected from one group.
+
+    Returns:
+        list: The indices of the selected items, in selection order.
+    """
+    n = len(relevance)
+    available = np.ones(n, dtype=bool)
+    max_similarity = np.zeros(n)
+    group_counts = np.zeros(int(groups.max()) + 1 if groups is not None and n else 0, dtype=np.int64)
+    selected = []
+    while len(selected) < k and available.any():
+        scores = np.where(available, lambda_ * relevance - (1 - lambda_) * max_similarity, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+        if groups is not None:
+            group_counts[groups[best]] += 1
+            if group_counts[groups[best]] >= max_per_group:
+                available &= groups != groups[best]
+    return selected
+
+
+def diversify(hits: list, k: int, settings: dict) -> list:
+    """
+    Re-ranks over-fetched hits with maximal marginal relevance and returns at most k of them.
+
+    Fewer than k hits are returned when the hits come from fewer parent documents. The hits are
+    not modified.
+
+    Parameters:
+    - hits (list): The hits, best first.
+    - k (int): Number of hits to return.
+    - settings (dict): The settings of diversity_settings().
+    """
+    if len(hits) <= 1:
+        return hits[:k]
+    sources = [hit.get("_source") or {} for hit in hits]
+    scores = np.array([hit.get("_score") or 0 for hit in hits], dtype=np.float64)
+    spread = scores.max() - scores.min()
+    relevance = (scores - scores.min()) / spread if spread > 0 else np.ones(len(hits))
+
+    vectors = [source_value(source, settings["vector_field"]) for source in sources] if settings["vector_field"] else None
+    if vectors is not None and all(isinstance(vector, list) and vector for vector in vectors) and len({len(vector) for vector in vectors}) == 1:
+        similarity = cosine_similarity(vectors)
+    else:
+        similarity = minhash_similarity([str(source_value(source, settings["text_field"]) or "") for source in sources])
+
+    groups = None
+    if settings["parent_field"]:
+        codes = {}
+        # Hits without a parent are groups of their own
+        groups = np.array([codes.setdefault(str(parent) if parent is not None else ("hit", position), len(codes))
+                           for position, parent in enumerate(source_value(source, settings["parent_field"]) for source in sources)])
+    selected = maximal_marginal_relevance(relevance, similarity, k, settings["lambda"], groups, settings["max_per_parent"])
+    return [hits[position] for position in selected]
@@ -0,0 +1,401 @@
+import csv
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from html.parser import HTMLParser
+
+####################################################################################################
+# Document Parsing and Chunking
+####################################################################################################
+
+# Uploaded files are spooled to disk and split into byte ranges. Worker processes memory map the file,
+# parse their range and chunk the text, and the chunks are yielded in file order with a bounded
+# number of ranges in flight so memory stays flat whatever the size of the file.
+# This module is imported by the worker processes so it must not import streamlit.
+default_workers = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))
+range_bytes = int(os.getenv("INGEST_RANGE_BYTES", str(4 * 1024 * 1024)))
+pdf_pages_per_task = 20
+
+
+####################################################################################################
+# Chunkers
+####################################################################################################
+
+_sentence_pattern = re.compile(r"(?<=[.!?])\s+")
+_heading_pattern = re.compile(r"^(#{1,6})\s+(.*)$", re.MULTILINE)
+
+
+def fixed_size_chunks(text: str, size: int, overlap: int) -> list:
+    """
+    Splits text into chunks of size characters, each overlapping the previous one by overlap characters.
+    """
+    if len(text) <= size:
+        return [text]
+    step = max(1, size - overlap)
+    chunks = []
+    for start in range(0, len(text), step):
+        chunks.append(text[start:start + size])
+        if start + size >= len(text):
+            break
+    return chunks
+
+def sentence_chunks(text: str, size: int, overlap: int) -> list:
+    """
+    Packs whole sentences into chunks of up to size characters. The last sentences of a chunk, up to
+    overlap characters, are repeated at the start of the next one.
+    """
+    sentences = [sentence for sentence in _sentence_pattern.split(text) if sentence.strip()]
+    chunks = []
+    current = []
+    length = 0
+    for sentence in sentences:
+        if current and length + len(sentence) + 1 > size:
+            chunks.append(" ".join(current))
+            carried = []
+            carried_length = 0
+            for previous in reversed(current):
+                if carried_length + len(previous) + 1 > overlap:
+                    break
+                carried.insert(0, previous)
+                carried_length += len(previous) + 1
+            current = carried
+            length = carried_length
+        if len(sentence) > size:
+            # A sentence longer than a chunk is split on its own
+            chunks.extend(fixed_size_chunks(sentence, size, overlap))
+            current = []
+            length = 0
+            continue
+        current.append(sentence)
+        length += len(sentence) + 1
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def heading_chunks(text: str, size: int, overlap: int) -> list:
+    """
+    Splits text into sections at markdown headings and chunks each section by sentences. Returns
+    (section, chunk) tuples so the heading can be stored with the chunk.
+    """
+    sections = []
+    position = 0
+    heading = None
+    for match in _heading_pattern.finditer(text):
+        if match.start() > position:
+            sections.append((heading, text[position:match.start()]))
+        heading = match.group(2).strip()
+        position = match.end()
+    sections.append((heading, text[position:]))
+    chunks = []
+    for heading, section_text in sections:
+        if section_text.strip():
+            chunks.extend((heading, chunk) for chunk in sentence_chunks(section_text.strip(), size, overlap))
+    return chunks
+
+chunkers = {
+    "fixed": fixed_size_chunks,
+    "sentence": sentence_chunks,
+    "heading": heading_chunks,
+}
+
+def chunk_document(document: dict, chunker: str, size: int, overlap: int) -> list:
+    # Returns one document per chunk of the text field, numbered from 0
+    text = document.get("text")
+    if not isinstance(text, str) or not text:
+        return [dict(document, chunk=0)]
+    chunk_documents = []
+    for number, chunk in enumerate(chunkers[chunker](text, size, overlap)):
+        if isinstance(chunk, tuple):
+            section, chunk = chunk
+            chunk_documents.append(dict(document, text=chunk, section=section, chunk=number))
+        else:
+            chunk_documents.append(dict(document, text=chunk, chunk=number))
+    return chunk_documents
+
+
+####################################################################################################
+# Parsers
+####################################################################################################
+
+class _HtmlText(HTMLParser):
+    # Collects the text of an HTML page, headings are written as markdown headings
+    skipped_tags = {"script", "style", "head"}
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.parts = []
+        self.title = None
+        self._skip = 0
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skipped_tags:
+            self._skip += 1
+        if tag == "title":
+            self._in_title = True
+        if re.fullmatch(r"h[1-6]", tag):
+            self.parts.append("\n\n" + "#" * int(tag[1]) + " ")
+        elif tag in ("p", "div", "br", "li", "tr"):
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.skipped_tags and self._skip:
+            self._skip -= 1
+        if tag == "title":
+            self._in_title = False
+        if re.fullmatch(r"h[1-6]", tag):
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title = (self.title or "") + data.strip()
+        elif not self._skip:
+            self.parts.append(data)
+
+    def text(self) -> str:
+        return re.sub(r"\n{3,}", "\n\n", "".join(self.parts)).strip()
+
+
+@contextmanager
+def mapped_file(path: str):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+def parse_ndjson(data: bytes) -> list:
+    return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+def parse_csv(data: bytes, header: list) -> list:
+    reader = csv.DictReader(io.StringIO(data.decode("utf-8", errors="replace"), newline=""), fieldnames=header)
+    return list(reader)
+
+def parse_html(data: bytes, file_name: str) -> list:
+    parser = _HtmlText()
+    parser.feed(data.decode("utf-8", errors="replace"))
+    return [{"title": parser.title or file_name, "text": parser.text()}]
+
+def parse_pdf(path: str, file_name: str, first_page: int, last_page: int) -> list:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise ValueError("Parsing PDF files requires the pypdf package")
+    reader = PdfReader(path)
+    pages = [reader.pages[number].extract_text() or "" for number in range(first_page, min(last_page, len(reader.pages)))]
+    return [{"title": file_name, "text": "\n\n".join(pages), "pages": [first_page + 1, min(last_page, len(reader.pages))]}]
+
+
+def process_task(task: dict) -> list:
+    """
+    Parses and chunks one byte range (or page range for PDFs) of a spooled file. Runs in a worker process.
+    """
+    kind = task["kind"]
+    file_name = task["file_name"]
+    if kind == "pdf":
+        documents = parse_pdf(task["path"], file_name, task["start"], task["end"])
+    else:
+        with mapped_file(task["path"]) as mapped:
+            data = mapped[task["start"]:task["end"]]
+        if kind == "ndjson":
+            documents = parse_ndjson(data)
+        elif kind == "csv":
+            documents = parse_csv(data, task["header"])
+        elif kind == "json":
+            content = json.loads(data) if data else []
+            documents = content if isinstance(content, list) else [content]
+        elif kind == "html":
+            documents = parse_html(data, file_name)
+        else:
+            documents = [{"title": file_name, "text": data.decode("utf-8", errors="replace")}]
+    chunks = []
+    for document in documents:
+        if not document.get("title"):
+            # Titled by content rather than position, so records keep their title (and the chunks
+            # their content hash) when other records are added or removed
+            document = dict(document, title=f"{file_name} #{record_key(document)}")
+        document = dict(document, source_file=file_name)
+        chunks.extend(chunk_document(document, task["chunker"], task["size"], task["overlap"]))
+    return chunks
+
+def record_key(document: dict) -> str:
+    return hashlib.sha1(json.dumps(document, sort_keys=True, default=str).encode()).hexdigest()[:10]
+
+
+####################################################################################################
+# Planning and Execution
+####################################################################################################
+
+parsers = {
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+    ".csv": "csv",
+    ".json": "json",
+    ".html": "html",
+    ".htm": "html",
+    ".pdf": "pdf",
+}
+
+def line_ranges(path: str, start: int = 0):
+    """
+    Yields (start, end) byte ranges of about range_bytes that end on a line boundary.
+    """
+    with mapped_file(path) as mapped:
+        size = len(mapped)
+        while start < size:
+            end = min(size, start + range_bytes)
+            if end < size:
+                newline = mapped.find(b"\n", end)
+                end = size if newline == -1 else newline + 1
+            yield start, end
+            start = end
+
+def csv_record_end(mapped, position: int, quotes: int = 0) -> int:
+    """
+    Returns the end of the CSV record running through position, the offset after its line break.
+
+    A line break only ends a record outside of a quoted field, i.e. after an even number of quote
+    characters since the start of the record. Escaped quotes are doubled so they keep the count even.
+
+    Parameters:
+    - quotes (int): Number of quote characters between the start of the record and position.
+    """
+    size = len(mapped)
+    while position < size:
+        newline = mapped.find(b"\n", position)
+        if newline == -1:
+            return size
+        quotes += mapped[position:newline].count(b'"')
+        position = newline + 1
+        if quotes % 2 == 0:
+            return position
+    return size
+
+def csv_ranges(path: str, start: int = 0):
+    """
+    Yields (start, end) byte ranges of about range_bytes that end on a CSV record boundary.
+    """
+    with mapped_file(path) as mapped:
+        size = len(mapped)
+        while start < size:
+            position = min(size, start + range_bytes)
+            end = csv_record_end(mapped, position, mapped[start:position].count(b'"'))
+            yield start, end
+            start = end
+
+def plan_tasks(path: str, file_name: str, chunker: str, size: int, overlap: int):
+    """
+    Yields the tasks for a spooled file. NDJSON and text files are split into line aligned byte ranges,
+    CSV files into record aligned ones, PDFs into page ranges, other files are processed whole.
+    """
+    kind = parsers.get(os.path.splitext(file_name)[1].lower(), "text")
+    base = {"path": path, "file_name": file_name, "kind": kind, "chunker": chunker, "size": size, "overlap": overlap}
+    if kind == "pdf":
+        try:
+            from pypdf import PdfReader
+            n_pages = len(PdfReader(path).pages)
+        except ImportError:
+            raise ValueError("Parsing PDF files requires the pypdf package")
+        for first_page in range(0, n_pages, pdf_pages_per_task):
+            yield dict(base, start=first_page, end=first_page + pdf_pages_per_task, total=n_pages)
+    elif kind in ("ndjson", "csv", "text"):
+        header = None
+        ranges = line_ranges(path)
+        if kind == "csv":
+            # Quoted fields can hold line breaks, so the header and the ranges end on record boundaries
+            with mapped_file(path) as mapped:
+                header_end = csv_record_end(mapped, 0)
+                header = next(csv.reader(io.StringIO(mapped[:header_end].decode("utf-8-sig", errors="replace"), newline="")), [])
+            ranges = csv_ranges(path, header_end)
+        for start, end in ranges:
+            yield dict(base, start=start, end=end, header=header, total=os.path.getsize(path))
+    else:
+        yield dict(base, start=0, end=os.path.getsize(path), total=os.path.getsize(path))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_process_pool(workers: int) -> ProcessPoolExecutor:
+    # The pool is shared by every upload, spawn avoids forking the threads of the Streamlit server
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+@contextmanager
+def spooled_file(file, file_name: str):
+    """
+    Yields a path to the content of an uploaded file, copying it to a temporary file in blocks.
+    """
+    suffix = os.path.splitext(file_name)[1]
+    temp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix, prefix="upload-")
+    try:
+        with temp:
+            file.seek(0)
+            shutil.copyfileobj(file, temp, length=1024 * 1024)
+        yield temp.name
+    finally:
+        os.remove(temp.name)
+
+def process_file(file, file_name: str, chunker: str = "fixed", size: int = 2000, overlap: int = 200, workers: int = None, progress: dict = None):
+    """
+    Yields the chunks of an uploaded file in file order.
+
+    Parameters:
+    - file: The uploaded file object.
+    - file_name (str): Name of the file, its extension selects the parser.
+    - chunker (str): One of "fixed", "sentence" or "heading".
+    - size (int): Maximum chunk size in characters.
+    - overlap (int): Overlap between consecutive chunks in characters.
+    - workers (int): Number of worker processes, 0 processes the file on the calling thread.
+    - progress (dict): Updated with the fraction of the file processed so far.
+    """
+    if chunker not in chunkers:
+        raise ValueError(f"Unknown chunker {chunker}")
+    workers = default_workers if workers is None else workers
+    with spooled_file(file, file_name) as path:
+        tasks = plan_tasks(path, file_name, chunker, size, overlap)
+        # A text file is one document, its chunks are numbered across the ranges
+        renumber = parsers.get(os.path.splitext(file_name)[1].lower(), "text") in ("text", "pdf")
+        number = 0
+        if workers == 0 or os.path.getsize(path) <= range_bytes:
+            results = ((task, process_task(task)) for task in tasks)
+        else:
+            results = _ordered_results(get_process_pool(workers), tasks, max_in_flight=workers * 2)
+        for task, chunks in results:
+            for chunk in chunks:
+                if renumber:
+                    chunk["chunk"] = number
+                    number += 1
+                yield chunk
+            if progress is not None:
+                progress["fraction"] = min(1.0, task["end"] / max(1, task["total"]))
+
+def _ordered_results(pool: ProcessPoolExecutor, tasks, max_in_flight: int):
+    # Keeps at most max_in_flight tasks submitted and yields their results in submission order
+    in_flight = deque()
+    try:
+        for task in tasks:
+            in_flight.append((task, pool.submit(process_task, task)))
+            if len(in_flight) >= max_in_flight:
+                task, future = in_flight.popleft()
+                yield task, future.result()
+        while in_flight:
+            task, future = in_flight.popleft()
+            yield task, future.result()
+    finally:
+        for task, future in in_flight:
+            future.cancel()
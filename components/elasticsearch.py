@@ -1,22 +1,157 @@
 import streamlit as st
+from components.session import session_state
+import elasticsearch
+import elasticapm
+import asyncio
 import json
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from fnmatch import fnmatch
+from functools import lru_cache
+from string import Formatter
+from components.async_runtime import get_async_es_client
+from components.registry import BoundedRegistry
+from components.diversity import diversity_settings, diversify, source_fields as diversity_source_fields
+from components.multi_query import query_variants, reciprocal_rank_fusion, default_max_variants, default_rank_window, default_rank_constant
 
-session_state = st.session_state
+####################################################################################################
+# Index Catalog
+####################################################################################################
 
-def get_indexes(index_pattern : str = "*") -> list:
+class IndexCatalog:
+    """
+    Cached list of the indices of a cluster with their document count and store size.
+
+    The catalog is loaded with _cat/indices and refreshed by a background thread, index patterns are
+    resolved locally so typing in the pattern box never calls the cluster.
+    """
+
+    def __init__(self, es_client: elasticsearch.Elasticsearch, refresh_interval: float = 60):
+        self._es_client = es_client
+        self._refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._indices = {}
+        self._last_refresh = None
+        self._last_error = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="index-catalog", daemon=True)
+
+    def start(self):
+        self.refresh()
+        self._thread.start()
+        return self
+
+    def refresh(self):
+        try:
+            rows = self._es_client.cat.indices(format="json", h="index,docs.count,store.size", bytes="b", expand_wildcards="open")
+        except Exception as e:
+            print(f"Error refreshing the index catalog: {e}")
+            with self._lock:
+                self._last_error = str(e)
+            return
+        indices = {}
+        for row in rows:
+            name = row["index"]
+            if name.startswith("."):
+                continue # Exclude system indices
+            indices[name] = {
+                "docs_count": int(row.get("docs.count") or 0),
+                "store_size": int(row.get("store.size") or 0)
+            }
+        with self._lock:
+            self._indices = indices
+            self._last_refresh = time.time()
+            self._last_error = None
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def request_refresh(self):
+        # Refresh in the background, e.g. after an index has been created
+        self._wake.set()
+
+    def resolve(self, index_pattern: str = "*") -> list:
+        """
+        Returns the names of the indices matching a comma separated pattern, - excludes matches.
+        """
+        with self._lock:
+            names = list(self._indices.keys())
+        patterns = [pattern.strip() for pattern in (index_pattern or "*").split(",") if pattern.strip()]
+        included = [pattern for pattern in patterns if not pattern.startswith("-")]
+        excluded = [pattern[1:] for pattern in patterns if pattern.startswith("-")]
+        matches = []
+        for name in names:
+            if any(fnmatch(name, pattern) for pattern in included) and not any(fnmatch(name, pattern) for pattern in excluded):
+                matches.append(name)
+        return sorted(matches)
+
+    def metadata(self, index_name: str) -> dict:
+        with self._lock:
+            return self._indices.get(index_name)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self._refresh_interval)
+            self._wake.clear()
+            if self._stopped.is_set():
+                return
+            self.refresh()
+
+
+index_catalog_refresh_interval = float(os.getenv("INDEX_CATALOG_REFRESH_INTERVAL", "60"))
+# Catalogs are bounded like the clients they use, idle ones stop their refresh thread
+_index_catalogs = BoundedRegistry("index catalog", IndexCatalog.stop)
+
+def get_index_catalog(prefix: str = "") -> IndexCatalog:
+    """
+    Returns the index catalog of the session's cluster, shared with every session using the same cluster.
+
+    Widgets whose keys are prefixed without a connection of their own use the session's main connection.
+    """
+    if session_state.get(prefix+"es_client") is None:
+        prefix = ""
+    es_client = session_state.get(prefix+"es_client")
+    if es_client is None:
+        return None
+    key = session_state.get(prefix+"es_client_key")
+    created = []
+
+    def create() -> IndexCatalog:
+        created.append(True)
+        return IndexCatalog(es_client, index_catalog_refresh_interval)
+
+    catalog = _index_catalogs.get(key, create)
+    # The first load calls the cluster, so it runs outside of the registry lock
+    if created:
+        catalog.start()
+    return catalog
+
+def get_indexes(index_pattern : str = "*", prefix: str = "") -> list:
     """
     Gets the indexes in the Elasticsearch cluster.
 
+    Parameters:
+    - index_pattern (str): Pattern the index names must match.
+    - prefix (str): Prefix of the session state keys for the connection.
+
     Returns:
         list: A list of indexes in the Elasticsearch cluster.
     """
-    es_client = session_state.get("es_client")
-    index_pattern=index_pattern+",-.*" # Exclude system indices
-    try:
-        indices = es_client.indices.get_alias(index=index_pattern)  
-    except Exception as e:
-        indices = []
-    return indices
+    catalog = get_index_catalog(prefix)
+    if catalog is None:
+        return []
+    return catalog.resolve(index_pattern)
+
+def format_size(size: int) -> str:
+    for unit in ["b", "kb", "mb", "gb", "tb"]:
+        if size < 1024 or unit == "tb":
+            return f"{size:.0f}{unit}" if unit == "b" else f"{size:.1f}{unit}"
+        size = size / 1024
 
 def index_selector_widget(container: st.container, prefix: str = ''):
     """
@@ -29,46 +164,697 @@ def index_selector_widget(container: st.container, prefix: str = ''):
     Returns:
 
     """
+    catalog = get_index_catalog(prefix)
+
+    def format_index(index_name: str) -> str:
+        metadata = catalog.metadata(index_name) if catalog else None
+        if metadata is None:
+            return index_name
+        return f"{index_name} ({metadata['docs_count']:,} docs, {format_size(metadata['store_size'])})"
+
     with container:
         col1 , col2 = st.columns(2)
         with col1:
             index_pattern=st.text_input("Search Index Pattern", key=prefix+"index_pattern", value=session_state.get("index_pattern", "*"))
         with col2:
-            index_name = st.selectbox("Selecr Index Name", options=get_indexes(index_pattern), key=prefix+"index_name")
+            index_name = st.selectbox("Selecr Index Name", options=get_indexes(index_pattern, prefix), key=prefix+"index_name", format_func=format_index)
     return index_name
 
 
-def get_elasticsearch_results(query):
-    es_client = session_state.get("es_client")
-    es_query  = session_state.get("search_body", "*")
+####################################################################################################
+# Query Templates
+####################################################################################################
+
+query_placeholder = "{query}"
+
+
+class CompiledQueryTemplate:
+    """
+    A search body parsed once with the paths of every string containing the {query} placeholder.
+
+    fill() copies only the containers on the path to a placeholder, the rest of the structure is
+    shared with the template, so the body is never re-parsed and the query never needs escaping.
+    """
+
+    def __init__(self, search_body: str):
+        self.search_body = search_body
+        self.template = json.loads(search_body)
+        self.paths = []
+        self._find_placeholders(self.template, ())
+
+    def _find_placeholders(self, node, path: tuple):
+        if isinstance(node, dict):
+            items = node.items()
+        elif isinstance(node, list):
+            items = enumerate(node)
+        else:
+            if isinstance(node, str) and query_placeholder in node:
+                self.paths.append(path)
+            return
+        for key, value in items:
+            self._find_placeholders(value, path + (key,))
+
+    def fill(self, query: str) -> dict:
+        body = dict(self.template)
+        for path in self.paths:
+            node = body
+            source = self.template
+            for key in path[:-1]:
+                source = source[key]
+                # Copy the container unless an earlier path already did
+                if node[key] is source:
+                    node[key] = dict(source) if isinstance(source, dict) else list(source)
+                node = node[key]
+            leaf = path[-1]
+            node[leaf] = node[leaf].replace(query_placeholder, query)
+        return body
+
+    def mustache_source(self) -> str:
+        # Source for a stored mustache template, the values are JSON escaped by Elasticsearch
+        body = dict(self.template)
+        body["size"] = "{{size}}"
+        if "_source" not in body:
+            body["_source"] = "{{source}}"
+        source = json.dumps(body)
+        source = source.replace(query_placeholder, "{{query}}")
+        source = source.replace('"{{source}}"', "{{#toJson}}source{{/toJson}}")
+        return source.replace('"{{size}}"', "{{size}}")
+
+    @property
+    def template_id(self) -> str:
+        return "rag-ui-" + hashlib.sha1(self.mustache_source().encode()).hexdigest()[:16]
+
+
+@lru_cache(maxsize=64)
+def compile_query_template(search_body: str) -> CompiledQueryTemplate:
+    """
+    Returns the compiled template for a search body, cached until the body changes.
+    """
+    return CompiledQueryTemplate(search_body)
+
+
+# Stored templates already registered, per client
+_registered_templates = set()
+_registered_templates_lock = threading.Lock()
+
+def register_search_template(es_client, compiled: CompiledQueryTemplate, force: bool = False) -> str:
+    """
+    Stores the compiled template as a mustache search template in the cluster.
+
+    Returns:
+        str: The id of the stored template.
+    """
+    key = (id(es_client), compiled.template_id)
+    with _registered_templates_lock:
+        registered = key in _registered_templates
+    if force or not registered:
+        es_client.put_script(id=compiled.template_id, script={"lang": "mustache", "source": compiled.mustache_source()})
+        with _registered_templates_lock:
+            _registered_templates.add(key)
+    return compiled.template_id
+
+
+def stored_template_search(es_client, index_pattern: str, compiled: CompiledQueryTemplate, query: str, size: int, source_includes: list = None) -> dict:
+    # Runs the search through the stored template, registering it again if the cluster lost it
+    template_id = register_search_template(es_client, compiled)
+    params = {"query": query, "size": size, "source": {"includes": source_includes or ["*"]}}
+    try:
+        return es_client.search_template(index=index_pattern, id=template_id, params=params, filter_path=hits_filter_path)
+    except elasticsearch.NotFoundError:
+        register_search_template(es_client, compiled, force=True)
+        return es_client.search_template(index=index_pattern, id=template_id, params=params, filter_path=hits_filter_path)
+
+
+####################################################################################################
+# Source Filtering
+####################################################################################################
+
+# Only the hit metadata and source are read from the response
+hits_filter_path = "hits.hits._id,hits.hits._index,hits.hits._score,hits.hits._source"
+
+@lru_cache(maxsize=64)
+def template_fields(md_template: str) -> frozenset:
+    """
+    Returns the source fields, including dotted nested fields, referenced by a display template.
+    """
+    fields = set()
+    if not md_template:
+        return frozenset(fields)
+    try:
+        parsed = list(Formatter().parse(md_template))
+    except ValueError as e:
+        print(f"Could not parse the display template: {e}")
+        return frozenset(fields)
+    for literal_text, field_name, format_spec, conversion in parsed:
+        if field_name:
+            fields.add(field_name.split("[")[0])
+    return frozenset(fields)
+
+def get_source_includes() -> list:
+    """
+    Returns the source fields needed by the display template and the enabled LLM functions.
+
+    Returns None when source filtering is disabled, in which case the full source is fetched.
+    """
+    if not session_state.get("source_filtering", True):
+        return None
+    fields = set(template_fields(session_state.get("doc_md_template", "")))
+    for function in session_state.get("llm_functions") or []:
+        fields.update(function.get("source_fields", []))
+    # The chat audit log references documents by title
+    fields.add("title")
+    settings = diversity_settings()
+    if settings is not None:
+        fields.update(diversity_source_fields(settings))
+    return sorted(fields)
+
+####################################################################################################
+# Document Lookup
+####################################################################################################
+
+def build_result_index(hits: list) -> dict:
+    """
+    Indexes a result set by title and by _id so documents can be looked up without a scan.
+    """
+    by_title = {}
+    by_id = {}
+    for hit in hits:
+        by_id[hit["_id"]] = hit
+        title = hit.get("_source", {}).get("title")
+        if title is not None and title not in by_title:
+            by_title[title] = hit
+    return {"by_title": by_title, "by_id": by_id}
+
+def set_search_results(hits: list):
+    # Stores a result set in the session together with its lookup index, shown from its first page
+    session_state["search_results"] = hits
+    session_state["search_results_index"] = build_result_index(hits)
+    session_state["search_results_page"] = 0
+
+def get_search_results_index() -> dict:
+    index = session_state.get("search_results_index")
+    if index is None:
+        index = build_result_index(session_state.get("search_results") or [])
+        session_state["search_results_index"] = index
+    return index
+
+# Documents and titles fetched for a session are kept in per session LRU caches of at most
+# session_document_cache_size entries each, so a long session does not keep every source it read
+session_document_cache_size = int(os.getenv("SESSION_DOCUMENT_CACHE_SIZE", "256"))
+
+def session_cache(name: str) -> OrderedDict:
+    # Returns the session's LRU cache stored under name
+    cache = session_state.get(name)
+    if not isinstance(cache, OrderedDict):
+        cache = OrderedDict()
+        session_state[name] = cache
+    return cache
+
+def cache_lookup(cache: OrderedDict, key):
+    # Returns the cached value and marks it as recently used
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+def cache_store(cache: OrderedDict, key, value):
+    # Stores a value and drops the least recently used entries over session_document_cache_size
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > session_document_cache_size:
+        cache.popitem(last=False)
+
+def get_document_sources(hits: list, prefix: str = "") -> list:
+    """
+    Returns the full sources of hits, fetching the ones that only have some fields with a single _mget.
+
+    Fetched documents are kept in the session so each one is only read once, per cluster.
+    """
+    client_key = session_state.get(prefix+"es_client_key")
+    documents = session_cache("document_cache")
+    found = {}
+    missing = []
+    for hit in hits:
+        if not hit.get("_partial_source"):
+            continue
+        key = (client_key, hit["_index"], hit["_id"])
+        source = cache_lookup(documents, key)
+        if source is not None:
+            found[key] = source
+        elif key not in missing:
+            missing.append(key)
+    if missing:
+        es_client = session_state.get(prefix+"es_client")
+        response = es_client.mget(docs=[{"_index": index, "_id": doc_id} for _, index, doc_id in missing])
+        for doc in response["docs"]:
+            if doc.get("found"):
+                key = (client_key, doc["_index"], doc["_id"])
+                found[key] = doc["_source"]
+                cache_store(documents, key, doc["_source"])
+    sources = []
+    for hit in hits:
+        if hit.get("_partial_source"):
+            sources.append(found.get((client_key, hit["_index"], hit["_id"])))
+        else:
+            sources.append(hit["_source"])
+    return sources
+
+def get_document_source(hit: dict, prefix: str = "") -> dict:
+    """
+    Returns the full source of a hit, fetching it when the search only returned some fields.
+    """
+    return get_document_sources([hit], prefix)[0]
+
+def fetch_documents_by_title(titles: list, prefix: str = "") -> dict:
+    """
+    Finds documents that are not in the current result set by their exact title with one query.
+
+    Returns:
+        dict: The hits found, keyed by title. Hits are cached in the session per cluster and index pattern.
+    """
+    index_pattern = session_state.get(prefix+"index_name", "*")
+    scope = (session_state.get(prefix+"es_client_key"), index_pattern)
+    title_cache = session_cache("title_cache")
+    found = {}
+    for title in titles:
+        hit = cache_lookup(title_cache, (scope, title))
+        if hit is not None:
+            found[title] = hit
+    missing = [title for title in titles if title not in found]
+    if missing:
+        es_client = session_state.get(prefix+"es_client")
+        body = {
+            "query": {
+                "bool": {
+                    "should": [{"match_phrase": {"title": title}} for title in missing],
+                    "minimum_should_match": 1
+                }
+            },
+            "size": len(missing) * 5
+        }
+        result = es_client.search(index=index_pattern, body=body, filter_path=hits_filter_path)
+        for hit in getattr(result, "body", result).get("hits", {}).get("hits", []):
+            # match_phrase can match longer titles, only exact titles are kept
+            title = hit["_source"].get("title")
+            if title in missing and title not in found:
+                found[title] = hit
+                cache_store(title_cache, (scope, title), hit)
+    return {title: found[title] for title in titles if title in found}
+
+
+####################################################################################################
+# Search Result Cache
+####################################################################################################
+
+class SearchResultCache:
+    """
+    Process wide LRU cache of search hits shared by every session.
+
+    Entries expire after ttl seconds and the cache is bounded by both the number of entries and the
+    approximate size of the cached hits. Cached hits are shared, callers must not modify them.
+    """
+
+    def __init__(self, max_entries: int = 512, max_bytes: int = 64 * 1024 * 1024, ttl: float = 300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            hits, size, expires = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return hits
+
+    def put(self, key: tuple, hits: list):
+        size = len(json.dumps(hits, default=str))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (hits, size, time.monotonic() + self.ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, cluster_key: tuple = None, index_name: str = None):
+        """
+        Removes the cached results of a cluster that could include documents from index_name.
+
+        Index patterns are matched locally, so writes through an alias should invalidate the alias
+        name or pass no index_name to clear every entry of the cluster.
+        """
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if cluster_key is not None and key[0] != cluster_key:
+                    continue
+                if index_name is not None and not any(fnmatch(index_name, pattern) for pattern in key[1].split(",")):
+                    continue
+                self._remove(key)
+                self._stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        return stats
+
+    def _remove(self, key: tuple):
+        hits, size, expires = self._entries.pop(key)
+        self._bytes -= size
+
+
+search_result_cache = SearchResultCache(
+    max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "512")),
+    max_bytes=int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    ttl=float(os.getenv("SEARCH_CACHE_TTL", "300"))
+)
+
+def invalidate_search_cache(index_name: str = None, prefix: str = ""):
+    # Call after writing to an index so no session is served stale results
+    search_result_cache.invalidate(session_state.get(prefix+"es_client_key"), index_name)
+
+def label_search_cache(cache_result: str):
+    stats = search_result_cache.stats()
+    elasticapm.label(
+        search_cache=cache_result,
+        search_cache_hits=stats["hits"],
+        search_cache_misses=stats["misses"],
+        search_cache_evictions=stats["evictions"],
+        search_cache_entries=stats["entries"]
+    )
+
+
+def prepare_search(query) -> dict:
+    """
+    Plans the search of a query with the settings of the session and looks it up in the cache.
+
+    Returns:
+        dict: The plan, with the cached hits under "hits" or None when the search must run.
+    """
+    search_body = session_state.get("search_body", "*")
+    size = session_state.get("num_results", 10)
+    index_pattern = session_state.get("index_name", "*")
+    use_stored_template = session_state.get("use_stored_template", False)
+
+    source_includes = get_source_includes()
+    diversity = diversity_settings()
+    # The re-ranking picks the results from more hits
+    fetch_size = size * diversity["over_fetch"] if diversity is not None else size
 
     if query is None or query == "" or query == "*":
         es_query = {
             "query": {
                 "match_all": {}
-            }
+            },
+            "size": fetch_size
         }
+        compiled = None
     else:
-        es_query = es_query.replace("{query}", query)
-        es_query = json.loads(es_query)
-    es_query["size"] = session_state.get("num_results", 10)
-    index_pattern = session_state.get("index_name", "*")
+        compiled = compile_query_template(search_body)
+        if use_stored_template:
+            es_query = None
+        else:
+            es_query = compiled.fill(query)
+            es_query["size"] = fetch_size
+    if es_query is None:
+        query_key = (compiled.template_id, query)
+    else:
+        if source_includes is not None and "_source" not in es_query:
+            es_query["_source"] = {"includes": source_includes}
+        query_key = json.dumps(es_query, sort_keys=True)
+
+    plan = {
+        "query": query,
+        "es_query": es_query,
+        "compiled": compiled,
+        "index_pattern": index_pattern,
+        "size": size,
+        "fetch_size": fetch_size,
+        "source_includes": source_includes,
+        "diversity": diversity,
+        "cache_key": (session_state.get("es_client_key"), str(index_pattern), query_key, size, tuple(source_includes or ()), json.dumps(diversity, sort_keys=True)),
+        "hits": None,
+    }
+    if search_result_cache.enabled:
+        hits = search_result_cache.get(plan["cache_key"])
+        if hits is not None:
+            label_search_cache("hit")
+            plan["hits"] = hits
+    return plan
+
+def finish_search(plan: dict, result) -> list:
+    # Extracts the hits of a search response and caches them
+    # filter_path drops the hits key entirely when nothing matched
+    hits = getattr(result, "body", result).get("hits", {}).get("hits", [])
+    if plan["source_includes"] is not None:
+        for hit in hits:
+            hit["_partial_source"] = True
+    if plan["diversity"] is not None:
+        hits = diversify_hits(hits, plan["size"], plan["diversity"])
+    if search_result_cache.enabled:
+        search_result_cache.put(plan["cache_key"], hits)
+        label_search_cache("miss")
+    return hits
+
+def get_elasticsearch_results(query):
+    plan = prepare_search(query)
+    if plan["hits"] is not None:
+        return plan["hits"]
+
+    es_client = session_state.get("es_client")
     print("Querying Elasticsearch")
-    #print(query)
-    #print(es_query)
-    #print(index_pattern)
-    result = es_client.search(index=index_pattern, body=es_query)
-    #print(result)
-    return result["hits"]["hits"]
-
-def search(query):
+    if plan["es_query"] is None:
+        result = stored_template_search(es_client, plan["index_pattern"], plan["compiled"], query, plan["fetch_size"], plan["source_includes"])
+    else:
+        result = es_client.search(index=plan["index_pattern"], body=plan["es_query"], filter_path=hits_filter_path)
+    return finish_search(plan, result)
+
+def diversify_hits(hits: list, size: int, settings: dict) -> list:
+    # Re-ranks over-fetched hits, a vector field only fetched for the re-ranking is dropped again
+    hits = diversify(hits, size, settings)
+    field = settings["vector_field"]
+    if field and field not in template_fields(session_state.get("doc_md_template", "")):
+        hits = [dict(hit, _source={key: value for key, value in hit["_source"].items() if key != field}) if field in (hit.get("_source") or {}) else hit for hit in hits]
+    return hits
+
+def search(query, variants: list = None):
     apm_client = session_state.get("apm_client")
     if apm_client:
         apm_client.begin_transaction(transaction_type="script")
-    results = get_elasticsearch_results(query)
+    if session_state.get("multi_query_enabled", False):
+        results = get_multi_query_results(query, variants)
+    else:
+        results = get_elasticsearch_results(query)
     n_results = len(results)
     print(f"Found {n_results} results")
-    session_state["search_results"] = results
+    set_search_results(results)
     if apm_client:
         apm_client.end_transaction(name="manual_search", result="success")
-    return results
\ No newline at end of file
+    return results
+
+
+####################################################################################################
+# Multi Query Search
+####################################################################################################
+
+# With multi_query_enabled a query is searched as several variants in a single _msearch request,
+# optionally together with a kNN search on multi_query_knn_field, and the ranked lists are fused
+# with reciprocal rank fusion. The variants always use the inline search body.
+msearch_filter_path = ",".join("responses." + path for path in hits_filter_path.split(",")) + ",responses.error"
+
+def prepare_multi_query_search(query: str, variants: list = None) -> dict:
+    """
+    Plans the _msearch of the variants of a query and looks it up in the cache, like prepare_search.
+
+    Parameters:
+    - query (str): The query.
+    - variants (list): Variants written by the LLM, the rule based variants are used when there are none.
+    """
+    size = session_state.get("num_results", 10)
+    index_pattern = session_state.get("index_name", "*")
+    source_includes = get_source_includes()
+    diversity = diversity_settings()
+    fetch_size = size * diversity["over_fetch"] if diversity is not None else size
+    window = max(fetch_size, session_state.get("multi_query_rank_window", default_rank_window))
+    variants = query_variants(query, variants, session_state.get("multi_query_max_variants", default_max_variants))
+    compiled = compile_query_template(session_state.get("search_body", "*"))
+
+    bodies = []
+    for variant in variants:
+        body = compiled.fill(variant)
+        body["size"] = window
+        bodies.append(body)
+    knn_field = session_state.get("multi_query_knn_field")
+    knn_model_id = session_state.get("multi_query_knn_model_id")
+    if knn_field and knn_model_id:
+        bodies.append({
+            "knn": {
+                "field": knn_field,
+                "k": window,
+                "num_candidates": max(100, 2 * window),
+                "query_vector_builder": {"text_embedding": {"model_id": knn_model_id, "model_text": query}}
+            },
+            "size": window
+        })
+    searches = []
+    for body in bodies:
+        if source_includes is not None and "_source" not in body:
+            body["_source"] = {"includes": source_includes}
+        searches.extend([{"index": index_pattern}, body])
+
+    plan = {
+        "query": query,
+        "variants": variants,
+        "searches": searches,
+        "size": size,
+        "fetch_size": fetch_size,
+        "source_includes": source_includes,
+        "diversity": diversity,
+        "cache_key": (session_state.get("es_client_key"), str(index_pattern), json.dumps(searches, sort_keys=True), size, tuple(source_includes or ()), json.dumps(diversity, sort_keys=True)),
+        "hits": None,
+    }
+    elasticapm.label(multi_query_variants=len(variants))
+    if search_result_cache.enabled:
+        hits = search_result_cache.get(plan["cache_key"])
+        if hits is not None:
+            label_search_cache("hit")
+            plan["hits"] = hits
+    return plan
+
+def finish_multi_query_search(plan: dict, result) -> list:
+    # Fuses the ranked lists of an _msearch response and caches the fused hits
+    responses = getattr(result, "body", result).get("responses", [])
+    errors = [response["error"] for response in responses if "error" in response]
+    if errors and len(errors) == len(responses):
+        raise RuntimeError(f"Multi query search failed: {errors[0]}")
+    for error in errors:
+        print(f"Error in a multi query search: {error}")
+    ranked_lists = []
+    hits_by_key = {}
+    for response in responses:
+        keys = []
+        for hit in response.get("hits", {}).get("hits", []):
+            key = (hit["_index"], hit["_id"])
+            hits_by_key.setdefault(key, hit)
+            keys.append(key)
+        ranked_lists.append(keys)
+    fused = reciprocal_rank_fusion(ranked_lists, session_state.get("multi_query_rank_constant", default_rank_constant))
+    hits = []
+    for key, score in fused[:plan["fetch_size"]]:
+        hit = dict(hits_by_key[key], _score=score)
+        if plan["source_includes"] is not None:
+            hit["_partial_source"] = True
+        hits.append(hit)
+    if plan["diversity"] is not None:
+        hits = diversify_hits(hits, plan["size"], plan["diversity"])
+    if search_result_cache.enabled:
+        search_result_cache.put(plan["cache_key"], hits)
+        label_search_cache("miss")
+    return hits
+
+def get_multi_query_results(query, variants: list = None) -> list:
+    # Browsing everything has nothing to expand
+    if query is None or query == "" or query == "*":
+        return get_elasticsearch_results(query)
+    plan = prepare_multi_query_search(query, variants)
+    if plan["hits"] is not None:
+        return plan["hits"]
+
+    es_client = session_state.get("es_client")
+    print(f"Querying Elasticsearch with {len(plan['searches']) // 2} searches")
+    result = es_client.msearch(searches=plan["searches"], filter_path=msearch_filter_path)
+    return finish_multi_query_search(plan, result)
+
+
+####################################################################################################
+# Async Search
+####################################################################################################
+
+# The same search for the async pipeline. It uses the pooled AsyncElasticsearch client of the
+# session's credentials, or runs the sync search in a worker thread when there is none.
+
+async def async_register_search_template(es_client, compiled: CompiledQueryTemplate, force: bool = False) -> str:
+    key = (id(es_client), compiled.template_id)
+    with _registered_templates_lock:
+        registered = key in _registered_templates
+    if force or not registered:
+        await es_client.put_script(id=compiled.template_id, script={"lang": "mustache", "source": compiled.mustache_source()})
+        with _registered_templates_lock:
+            _registered_templates.add(key)
+    return compiled.template_id
+
+
+async def async_stored_template_search(es_client, index_pattern: str, compiled: CompiledQueryTemplate, query: str, size: int, source_includes: list = None) -> dict:
+    template_id = await async_register_search_template(es_client, compiled)
+    params = {"query": query, "size": size, "source": {"includes": source_includes or ["*"]}}
+    try:
+        return await es_client.search_template(index=index_pattern, id=template_id, params=params, filter_path=hits_filter_path)
+    except elasticsearch.NotFoundError:
+        await async_register_search_template(es_client, compiled, force=True)
+        return await es_client.search_template(index=index_pattern, id=template_id, params=params, filter_path=hits_filter_path)
+
+
+async def async_get_elasticsearch_results(query):
+    es_client = get_async_es_client()
+    if es_client is None:
+        return await asyncio.to_thread(get_elasticsearch_results, query)
+    plan = prepare_search(query)
+    if plan["hits"] is not None:
+        return plan["hits"]
+
+    print("Querying Elasticsearch")
+    if plan["es_query"] is None:
+        result = await async_stored_template_search(es_client, plan["index_pattern"], plan["compiled"], query, plan["fetch_size"], plan["source_includes"])
+    else:
+        result = await es_client.search(index=plan["index_pattern"], body=plan["es_query"], filter_path=hits_filter_path)
+    return finish_search(plan, result)
+
+async def async_get_multi_query_results(query, variants: list = None) -> list:
+    es_client = get_async_es_client()
+    if es_client is None:
+        return await asyncio.to_thread(get_multi_query_results, query, variants)
+    if query is None or query == "" or query == "*":
+        return await async_get_elasticsearch_results(query)
+    plan = prepare_multi_query_search(query, variants)
+    if plan["hits"] is not None:
+        return plan["hits"]
+
+    print(f"Querying Elasticsearch with {len(plan['searches']) // 2} searches")
+    result = await es_client.msearch(searches=plan["searches"], filter_path=msearch_filter_path)
+    return finish_multi_query_search(plan, result)
+
+async def async_search(query, variants: list = None):
+    if session_state.get("multi_query_enabled", False):
+        results = await async_get_multi_query_results(query, variants)
+    else:
+        results = await async_get_elasticsearch_results(query)
+    print(f"Found {len(results)} results")
+    set_search_results(results)
+    return results
@@ -2,7 +2,12 @@
 
 import streamlit as st
 import os
+import atexit
+import hashlib
 import elasticsearch
+from components.health_monitor import get_health_monitor, stop_health_monitor
+from components.registry import BoundedRegistry
+from components.traffic_replay import es_client_options
 
 ####################################################################################################
 # Elasticsearch Connection Configuration
@@ -53,52 +58,155 @@ def initialise_es():
         if "api_key" not in session_state:
             session_state["api_key"] = api_key_default
 
-def get_es_client(force_update: bool = False, prefix : str ="") -> elasticsearch.Elasticsearch:
+####################################################################################################
+# Process wide client registry
+####################################################################################################
+
+# Streamlit reruns the script for every interaction of every session, so clients are pooled at the
+# process level and shared by every session using the same credentials. The pool is bounded, a client
+# no session has used for a while is closed together with its health monitor.
+es_connections_per_node = int(os.getenv("ES_CONNECTIONS_PER_NODE", "10"))
+# Worker threads of the async runtime for the blocking calls of async turns (sync client fallbacks,
+# context building, audit logging), shared by every session of the process
+async_executor_workers = int(os.getenv("ASYNC_EXECUTOR_WORKERS", "64"))
+
+
+def es_client_key(cloud_id: str, elasticsearch_url: str, api_key: str) -> tuple:
+    """
+    Returns the registry key for a set of credentials.
+
+    The API key is hashed so that it is never held as part of the key.
+    """
+    api_key_hash = hashlib.sha256(api_key.encode()).hexdigest() if api_key else None
+    if cloud_id:
+        return ("cloud_id", cloud_id, api_key_hash)
+    return ("url", elasticsearch_url, api_key_hash)
+
+
+def close_es_client(entry: tuple):
+    key, es_client = entry
+    stop_health_monitor(("elasticsearch",) + key)
+    es_client.close()
+
+
+_es_client_registry = BoundedRegistry("Elasticsearch client", close_es_client)
+
+
+def get_pooled_es_client(cloud_id: str, elasticsearch_url: str, api_key: str, connections_per_node: int = None) -> elasticsearch.Elasticsearch:
+    """
+    Returns the shared Elasticsearch client for the given credentials, creating it on first use.
+
+    Parameters:
+    - cloud_id (str): Elastic Cloud ID, takes precedence over the URL.
+    - elasticsearch_url (str): Elasticsearch URL used when no Cloud ID is set.
+    - api_key (str): API key for the cluster.
+    - connections_per_node (int): Size of the keep-alive pool per node, defaults to ES_CONNECTIONS_PER_NODE.
+
+    Returns:
+        elasticsearch.Elasticsearch: An Elasticsearch client instance or None if no endpoint is configured.
+    """
+    if not cloud_id and not elasticsearch_url:
+        return None
+    key = es_client_key(cloud_id, elasticsearch_url, api_key)
+
+    def create() -> tuple:
+        print(f"Creating pooled Elasticsearch client for {key[1]}")
+        if cloud_id:
+            es_client = elasticsearch.Elasticsearch(
+                cloud_id=cloud_id,
+                api_key=api_key,
+                connections_per_node=connections_per_node or es_connections_per_node,
+                **es_client_options()
+            )
+        else:
+            es_client = elasticsearch.Elasticsearch(
+                hosts=[elasticsearch_url],
+                api_key=api_key,
+                connections_per_node=connections_per_node or es_connections_per_node,
+                **es_client_options()
+            )
+        return key, es_client
+
+    return _es_client_registry.get(key, create)[1]
+
+
+def close_pooled_es_clients():
+    # Close every pooled client, used at process shutdown
+    _es_client_registry.clear()
+
+atexit.register(close_pooled_es_clients)
+
+
+def get_es_client(prefix : str ="") -> elasticsearch.Elasticsearch:
     """
     Returns an Elasticsearch client instance.
 
-    If an Elasticsearch client instance already exists and is reachable, it will be returned.
-    Otherwise, a new Elasticsearch client instance will be created based on the session state.
+    Clients come from the process wide registry so sessions with the same credentials share one
+    connection pool. The client is looked up on every call, which marks it as in use and replaces
+    a client the registry has closed in the meantime.
 
     Returns:
         elasticsearch.Elasticsearch: An Elasticsearch client instance.
     """
-    es_client = session_state.get(prefix+"es_client")
-    if es_client and es_client.ping() and not force_update:
-        return es_client
     cloud_id = session_state.get(prefix+"cloud_id")
     elasticsearch_url = session_state.get(prefix+"elasticsearch_url")
     api_key = session_state.get(prefix+"api_key")
-    if cloud_id:
-        es_client = elasticsearch.Elasticsearch(
-            cloud_id=cloud_id,
-            api_key=api_key
-        )
-    else:
-        es_client = elasticsearch.Elasticsearch(
-            hosts=[elasticsearch_url],
-            api_key=api_key
-        )
+    key = es_client_key(cloud_id, elasticsearch_url, api_key)
+    es_client = get_pooled_es_client(cloud_id, elasticsearch_url, api_key)
+    session_state[prefix+"es_client_key"] = key
     return es_client
 
-def check_elasticsearch_connection(prefix : str = "") -> tuple[bool, elasticsearch.Elasticsearch]:
+def get_es_health_monitor(es_client: elasticsearch.Elasticsearch, key: tuple, name: str = "elasticsearch"):
+    # Returns the background health monitor for a pooled client
+    def check():
+        es_client.options(request_timeout=5).info()
+    return get_health_monitor(("elasticsearch",) + key, name, check)
+
+def check_elasticsearch_connection(prefix : str = "", refresh : bool = False) -> tuple[bool, elasticsearch.Elasticsearch]:
     """
     Checks the connection to the Elasticsearch cluster.
 
+    The status comes from the background health monitor of the pooled client so no request is
+    made to the cluster while rendering. The snapshot is stored in the session state under
+    prefix+"es_health". Until the first check of a new monitor has run the status is "unknown",
+    the client is kept in the session meanwhile so the page can already use it.
+
+    Parameters:
+    - prefix (str): Prefix of the session state keys for the connection.
+    - refresh (bool): Ask the monitor to run a check straight away.
     """
     try:
-        es_client = get_es_client(force_update=True, prefix=prefix)
-        if es_client is None:
-            return False, None
-        connected=es_client.ping()
+        es_client = get_es_client(prefix=prefix)
     except Exception as e:
+        es_client = None
+        session_state[prefix+"es_health"] = {"status": "down", "connected": False, "last_error": str(e)}
+    if es_client is None:
+        session_state[prefix+"connected"] = False
+        session_state[prefix+"es_client"] = None
         return False, None
-    if connected:
+    monitor = get_es_health_monitor(es_client, session_state[prefix+"es_client_key"], name=prefix+"elasticsearch")
+    if refresh:
+        monitor.check_now()
+    health = monitor.snapshot()
+    session_state[prefix+"es_health"] = health
+    connected = health["connected"]
+    if connected or health["status"] == "unknown":
         session_state[prefix+"es_client"] = es_client
-        session_state[prefix+"connected"] = True
+        session_state[prefix+"connected"] = connected
     else:
         session_state[prefix+"connected"] = False
         session_state[prefix+"es_client"] = None
+    return connected, es_client
+
+def health_message(health: dict) -> str:
+    # Formats a health snapshot for display
+    if health is None:
+        return "No connection configured"
+    if health.get("status") == "ok":
+        return f"Latency {health['latency_ms']:.0f} ms"
+    if health.get("status") == "unknown":
+        return "Checking connection ..."
+    return f"Error: {health.get('last_error')}"
 
 
 def es_connection_config_widget(container: st.container):
@@ -110,7 +218,7 @@ def es_connection_config_widget(container: st.container):
     check_elasticsearch_connection()
     
     def save_settings(conatiner : st.container):
-        check_elasticsearch_connection() 
+        check_elasticsearch_connection(refresh=True)
         with container:
             st.write("Updating connection settings")
 
@@ -134,17 +242,14 @@ def connection_status_widget(status : st.empty):
     # Connection Status Widget
     status.empty()
     connected = session_state.get("connected", False)
+    health = session_state.get("es_health")
     if connected:
-        status.success("Connected to Elastic")
+        status.success(f"Connected to Elastic  \n{health_message(health)}")
+    elif health and health.get("status") == "unknown":
+        status.info(health_message(health))
     else:
         status.empty()
-        status.error("Not connected to Elastic")
-        #Try to call elasticsearch and capture the exception and output the reason to status_updates
-        try:
-            es_client = get_es_client()
-            es_client.info()
-        except Exception as e:
-            status.error(f"Not connected  \nError: {e}") 
+        status.error(f"Not connected  \n{health_message(health)}")
 
 def initialise_monitoring(force : bool = False):
 
@@ -179,7 +284,7 @@ def initialise_monitoring(force : bool = False):
     if "event_dataset_logs" not in session_state or force:
         session_state["event_dataset_logs"] = event_dataset_logs_default
     
-    es_logging_client = check_elasticsearch_connection(prefix="monitoring_")
+    es_logging_client = check_elasticsearch_connection(prefix="monitoring_", refresh=force)
 
 
     
@@ -217,12 +322,10 @@ def monitoring_connection_config_widget(container: st.container):
         with reset_col:
             st.button("Reset", on_click=initialise_monitoring, args=[True], key="reset_monitoring_settings_button")
         if session_state["monitoring_connected"]:
-            st.success("Connected to Monitoring Cluster")
+            st.success(f"Connected to Monitoring Cluster  \n{health_message(session_state.get('monitoring_es_health'))}")
+        elif (session_state.get("monitoring_es_health") or {}).get("status") == "unknown":
+            st.info(health_message(session_state.get("monitoring_es_health")))
         else:
             st.error("Not connected to Monitoring Cluster")
-            try:
-                es_client = get_es_client(prefix="monitoring_")
-                es_client.info()
-            except Exception as e:
-                st.error(f"Not connected  \nError: {e}")
+            st.error(f"Not connected  \n{health_message(session_state.get('monitoring_es_health'))}")
     
\ No newline at end of file
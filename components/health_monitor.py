@@ -0,0 +1,122 @@
+# health_monitor.py
+
+import atexit
+import threading
+import time
+from components.registry import BoundedRegistry
+
+####################################################################################################
+# Background Connection Health Monitor
+####################################################################################################
+
+# Widgets read a cached snapshot of the connection health instead of calling the cluster while
+# rendering. One monitor thread runs per pooled client and backs off while the endpoint is down.
+default_check_interval = 30
+default_max_backoff = 300
+
+
+class HealthMonitor:
+    """
+    Periodically runs a health check in a background thread and publishes the result.
+
+    Parameters:
+    - name (str): Name of the monitored connection, used for the thread name and logging.
+    - check (callable): Function performing the check. It should raise on failure.
+    - interval (float): Seconds between checks while the connection is healthy.
+    - max_backoff (float): Upper bound in seconds for the delay between checks while it is failing.
+    """
+
+    def __init__(self, name: str, check: callable, interval: float = default_check_interval, max_backoff: float = default_max_backoff):
+        self.name = name
+        self._check = check
+        self._interval = interval
+        self._max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._status = {
+            "status": "unknown",
+            "connected": False,
+            "latency_ms": None,
+            "last_error": None,
+            "last_checked": None,
+            "consecutive_failures": 0
+        }
+        self._thread = threading.Thread(target=self._run, name=f"health-{name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def check_now(self):
+        # Wake the thread so the next check runs immediately
+        self._wake.set()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._status)
+
+    def next_delay(self) -> float:
+        failures = self._status["consecutive_failures"]
+        if failures == 0:
+            return self._interval
+        return min(self._interval * 2 ** (failures - 1), self._max_backoff)
+
+    def run_check(self):
+        start = time.perf_counter()
+        try:
+            self._check()
+            error = None
+        except Exception as e:
+            error = str(e)
+        latency_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._status["last_checked"] = time.time()
+            self._status["latency_ms"] = latency_ms
+            if error is None:
+                self._status["status"] = "ok"
+                self._status["connected"] = True
+                self._status["last_error"] = None
+                self._status["consecutive_failures"] = 0
+            else:
+                self._status["status"] = "down"
+                self._status["connected"] = False
+                self._status["last_error"] = error
+                self._status["consecutive_failures"] += 1
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.run_check()
+            self._wake.wait(self.next_delay())
+            self._wake.clear()
+
+
+def stop_monitor(monitor: HealthMonitor):
+    monitor.stop()
+
+
+_monitors = BoundedRegistry("health monitor", stop_monitor)
+
+
+def get_health_monitor(key, name: str, check: callable) -> HealthMonitor:
+    """
+    Returns the health monitor registered for key, starting one if it does not exist yet.
+
+    Never blocks: a new monitor reports the status "unknown" until its thread has run the first check.
+    """
+    return _monitors.get(key, lambda: HealthMonitor(name, check).start())
+
+
+def stop_health_monitor(key):
+    # Stops the monitor of a client that has been closed
+    _monitors.pop(key)
+
+
+def stop_health_monitors():
+    _monitors.clear()
+
+atexit.register(stop_health_monitors)
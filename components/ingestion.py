@@ -0,0 +1,201 @@
+import streamlit as st
+import elasticsearch
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from elasticsearch.helpers import streaming_bulk, scan
+
+session_state = st.session_state
+
+####################################################################################################
+# Bulk Ingestion
+####################################################################################################
+
+# The chunks produced by components.document_processing are streamed into the index with the _bulk
+# API. They are consumed lazily so only one batch is held in memory and in flight at a time, which
+# throttles the parsing of the file to the speed of the cluster.
+bulk_chunk_size = int(os.getenv("INGEST_BULK_CHUNK_SIZE", "500"))
+bulk_max_chunk_bytes = int(os.getenv("INGEST_BULK_MAX_CHUNK_BYTES", str(10 * 1024 * 1024)))
+bulk_max_retries = int(os.getenv("INGEST_BULK_MAX_RETRIES", "5"))
+
+
+@contextmanager
+def bulk_load_profile(es_client: elasticsearch.Elasticsearch, index_name: str, new_index: bool):
+    """
+    Creates a new index with refresh disabled and no replicas for the load, and restores the
+    settings afterwards. Existing indices are loaded with their settings unchanged so searches on
+    them keep seeing fresh data, also when they were asked for as a new index.
+    """
+    if not new_index or es_client.indices.exists(index=index_name):
+        yield
+        return
+    es_client.indices.create(index=index_name, mappings=ingest_mappings)
+    settings = es_client.indices.get_settings(index=index_name, name="index.number_of_replicas,index.refresh_interval")
+    index_settings = settings[index_name]["settings"]["index"]
+    replicas = index_settings.get("number_of_replicas", "1")
+    refresh_interval = index_settings.get("refresh_interval")
+    es_client.indices.put_settings(index=index_name, settings={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+    try:
+        yield
+    finally:
+        es_client.indices.put_settings(index=index_name, settings={"index": {"refresh_interval": refresh_interval, "number_of_replicas": replicas}})
+        es_client.indices.refresh(index=index_name)
+
+
+####################################################################################################
+# Incremental Loading
+####################################################################################################
+
+# Every chunk gets the hash of its content as _id. Chunks already in the index are skipped, and the
+# chunks of the file that are no longer produced are deleted once the load is done.
+ingest_mappings = {
+    "properties": {
+        "source_file": {"type": "keyword"},
+        "content_hash": {"type": "keyword"}
+    }
+}
+
+# Fields describing the position of a chunk in its file, left out of the hash
+position_fields = {"chunk", "pages"}
+
+def content_hash(chunk: dict) -> str:
+    """
+    Returns a stable hash of the content of a chunk. Position fields are left out so identical
+    content keeps its hash when chunks or records before it are added or removed. Untitled records
+    get a title derived from their content in components.document_processing for the same reason.
+    """
+    content = {key: value for key, value in chunk.items() if key not in position_fields}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+def existing_ids(es_client: elasticsearch.Elasticsearch, index_name: str, ids: list) -> set:
+    response = es_client.mget(index=index_name, ids=ids, source=False)
+    return {doc["_id"] for doc in response["docs"] if doc.get("found")}
+
+def new_chunks(es_client: elasticsearch.Elasticsearch, index_name: str, chunks, kept: set, stats: dict, check_existing: bool = True):
+    """
+    Yields (id, chunk) for the chunks that are not in the index yet, checking the ids in batches with _mget.
+
+    The ids of the chunks already in the index are added to kept, the caller adds the ids it indexes.
+    """
+    batch = []
+    produced = set()
+
+    def flush():
+        existing = existing_ids(es_client, index_name, [chunk_id for chunk_id, chunk in batch]) if check_existing else set()
+        for chunk_id, chunk in batch:
+            if chunk_id in existing:
+                stats["unchanged"] += 1
+                kept.add(chunk_id)
+            else:
+                yield chunk_id, chunk
+        batch.clear()
+
+    for chunk in chunks:
+        chunk_id = content_hash(chunk)
+        if chunk_id in produced:
+            stats["duplicates"] += 1
+            continue
+        produced.add(chunk_id)
+        batch.append((chunk_id, dict(chunk, content_hash=chunk_id)))
+        if len(batch) >= bulk_chunk_size:
+            yield from flush()
+    if batch:
+        yield from flush()
+
+def source_file_field(es_client: elasticsearch.Elasticsearch, index_name: str) -> str:
+    # Indices created elsewhere may map source_file as text with a keyword sub field
+    mappings = es_client.indices.get_field_mapping(index=index_name, fields="source_file")
+    for index_mapping in mappings.values():
+        mapping = index_mapping["mappings"].get("source_file", {}).get("mapping", {}).get("source_file", {})
+        if mapping.get("type") == "text" and "keyword" in mapping.get("fields", {}):
+            return "source_file.keyword"
+    return "source_file"
+
+def delete_orphans(es_client: elasticsearch.Elasticsearch, index_name: str, source_file: str, kept: set, stats: dict):
+    """
+    Deletes the chunks of source_file that are not in kept, i.e. were not indexed or found unchanged by this load.
+    """
+    es_client.indices.refresh(index=index_name)
+    query = {"query": {"term": {source_file_field(es_client, index_name): source_file}}}
+    orphans = (
+        {"_op_type": "delete", "_index": index_name, "_id": hit["_id"]}
+        for hit in scan(es_client, index=index_name, query=query, _source=False)
+        if hit["_id"] not in kept
+    )
+    for ok, item in streaming_bulk(es_client, orphans, chunk_size=bulk_chunk_size, raise_on_error=False, raise_on_exception=False):
+        if ok:
+            stats["deleted"] += 1
+        else:
+            stats["failed"] += 1
+
+
+def bulk_actions(chunks, index_name: str):
+    for chunk_id, chunk in chunks:
+        yield {"_op_type": "index", "_index": index_name, "_id": chunk_id, "_source": chunk}
+
+def ingest(es_client: elasticsearch.Elasticsearch, index_name: str, chunks, new_index: bool = False, progress: callable = None, source_file: str = None) -> dict:
+    """
+    Streams chunks into an index with the _bulk API.
+
+    Batches are sent one at a time, rejected (429) documents are retried with an exponential backoff.
+    Chunks already in the index are skipped and, when source_file is given, the chunks of that file
+    that were not produced by this load are deleted. When any chunk failed nothing is deleted, the
+    previous version of its content stays searchable until a load succeeds.
+
+    Parameters:
+    - es_client (Elasticsearch): Client of the cluster to load into.
+    - index_name (str): The index to load into.
+    - chunks: Iterable of documents to index.
+    - new_index (bool): Create the index and use the bulk load profile. Raises ValueError when it exists.
+    - progress (callable): Called with the running stats after each batch.
+    - source_file (str): Name of the file the chunks come from.
+
+    Returns:
+        dict: The number of documents indexed, unchanged, deleted and failed, the errors, the docs/sec
+        and whether the deletion of removed chunks was skipped.
+    """
+    stats = {"indexed": 0, "unchanged": 0, "duplicates": 0, "deleted": 0, "failed": 0, "errors": [], "seconds": 0, "docs_per_second": 0, "orphans_skipped": False}
+    start = time.perf_counter()
+    last_report = 0
+    kept = set()
+    index_existed = es_client.indices.exists(index=index_name)
+    if new_index and index_existed:
+        raise ValueError(f"Index {index_name} already exists, choose Existing to load the file into it")
+    with bulk_load_profile(es_client, index_name, new_index):
+        # Nothing can be unchanged in an index created for this load
+        actions = bulk_actions(new_chunks(es_client, index_name, chunks, kept, stats, check_existing=bool(index_existed)), index_name)
+        for ok, item in streaming_bulk(
+            es_client,
+            actions,
+            chunk_size=bulk_chunk_size,
+            max_chunk_bytes=bulk_max_chunk_bytes,
+            max_retries=bulk_max_retries,
+            initial_backoff=1,
+            max_backoff=30,
+            raise_on_error=False,
+            raise_on_exception=False
+        ):
+            if ok:
+                stats["indexed"] += 1
+                kept.add(item["index"]["_id"])
+            else:
+                stats["failed"] += 1
+                if len(stats["errors"]) < 10:
+                    stats["errors"].append(item)
+            stats["seconds"] = time.perf_counter() - start
+            if progress and stats["seconds"] - last_report >= 0.5:
+                last_report = stats["seconds"]
+                stats["docs_per_second"] = (stats["indexed"] + stats["failed"]) / stats["seconds"]
+                progress(stats)
+        if source_file and index_existed:
+            if stats["failed"]:
+                stats["orphans_skipped"] = True
+            else:
+                delete_orphans(es_client, index_name, source_file, kept, stats)
+    stats["seconds"] = time.perf_counter() - start
+    stats["docs_per_second"] = (stats["indexed"] + stats["failed"]) / stats["seconds"] if stats["seconds"] else 0
+    if progress:
+        progress(stats)
+    return stats
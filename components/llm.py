@@ -2,9 +2,15 @@ import streamlit as st
 import os
 from openai import AzureOpenAI
 from openai import OpenAI
-import json
-import llm_functions as llmfs
-import elasticapm
+import atexit
+import hashlib
+from components.health_monitor import get_health_monitor, stop_health_monitor
+from components.registry import BoundedRegistry
+from components.traffic_replay import wrap_llm_client
+from components.llm_context import reset_context, default_token_budget
+from components.chat import chat_turn, async_chat_turn
+from components.async_runtime import run_sync
+from components.rag_engine import RagSession
 from components.speech import speech_widget # Required to refresh for testing
 
 session_state = st.session_state
@@ -33,22 +39,55 @@ def test_llm_connection():
             session_state["llm_connected"] = False
             return False
 
+# LLM clients are shared by every session using the same endpoint and key, idle ones are closed
+def close_llm_client(entry: tuple):
+    key, llm_client = entry
+    stop_health_monitor(key)
+    llm_client.close()
+
+_llm_client_registry = BoundedRegistry("LLM client", close_llm_client)
+
+def get_pooled_azure_client(azure_openai_key: str, azure_openai_endpoint: str) -> tuple:
+    """
+    Returns the shared Azure OpenAI client and its registry key, creating the client on first use.
+    """
+    api_key_hash = hashlib.sha256(azure_openai_key.encode()).hexdigest() if azure_openai_key else None
+    key = ("azure", azure_openai_endpoint, api_key_hash)
+
+    def create() -> tuple:
+        llm_client = AzureOpenAI(
+            api_key=azure_openai_key,  
+            api_version="2024-02-01",
+            azure_endpoint = azure_openai_endpoint
+        )
+        # Records or replays the traffic when TRAFFIC_MODE is set
+        return key, wrap_llm_client(llm_client)
+
+    return _llm_client_registry.get(key, create)[1], key
+
+atexit.register(_llm_client_registry.clear)
+
+def get_llm_health_monitor(llm_client, key: tuple):
+    # Listing the models is enough to validate the endpoint and key without paying for a completion
+    def check():
+        llm_client.with_options(timeout=10, max_retries=0).models.list()
+    return get_health_monitor(key, "llm", check)
+
 def connect_llm():
     llm_type = session_state.get("llm_type")
     if llm_type == "azure":
         azure_openai_key = session_state.get("azure_openai_key")
-        azure_openai_deployment_name = session_state.get("azure_openai_deployment_name")
         azure_openai_endpoint = session_state.get("azure_openai_endpoint")
-        llm_client = AzureOpenAI(
-            api_key=azure_openai_key,  
-            api_version="2023-10-01-preview",
-            azure_endpoint = azure_openai_endpoint
-        )
+        if not azure_openai_endpoint:
+            session_state["llm_connected"] = False
+            return
+        llm_client, key = get_pooled_azure_client(azure_openai_key, azure_openai_endpoint)
         session_state["llm_client"] = llm_client
-        # Check if the client is connected
-        if "llm_connected" not in session_state:
-            # First time connecting
-            test_llm_connection()
+        # The connection status comes from the background monitor, no request is made here
+        health = get_llm_health_monitor(llm_client, key).snapshot()
+        session_state["llm_health"] = health
+        if health["status"] != "unknown":
+            session_state["llm_connected"] = health["connected"]
         
     elif llm_type == "openai":
         openai_key = session_state.get("openai_key")
@@ -73,6 +112,9 @@ def llm_config_widget(container: st.container):
         system_prompt = st.text_area("System Prompt", key="system_prompt", value=session_state.get("system_prompt", "you are a friendly chatbot"))
         corpus_description = st.text_area("Corpus Description", key="corpus_description", value=session_state.get("corpus_description", "A collection of corporate data"))
         llm_type = st.selection = st.selectbox(label="Select LLM Type",options=llm_typres,key="llm_type")
+        st.checkbox("Stream responses", key="llm_streaming", value=session_state.get("llm_streaming", True))
+        st.checkbox("Overlap searches and function calls (async)", key="llm_async", value=session_state.get("llm_async", False))
+        st.number_input("Context Token Budget", key="context_token_budget", min_value=500, step=500, value=session_state.get("context_token_budget", default_token_budget))
 
 
         if llm_type == "azure":
@@ -93,111 +135,49 @@ def llm_config_widget(container: st.container):
         connection_status_container = st.empty()
         with connection_status_container:
             if "llm_connected" in session_state:
+                llm_health = session_state.get("llm_health") or {}
                 if session_state["llm_connected"]:
                     st.success("Connected to LLM")
                 else:
-                    st.error("Failed to connect to LLM")
+                    st.error(f"Failed to connect to LLM  \n{llm_health.get('last_error') or ''}")
             else:
                 st.warning("Not connected to LLM")
     return
 
 
-@elasticapm.capture_span( "llm_chat")
-def llm_chat(container : st.container):
-
-    llm_client = session_state.get("llm_client")
-
-    user_name = session_state.get("user_name", "alice")
-
-    system_prompt = session_state.get("system_prompt")  
-
-    messages = [{"role": "system", "content": session_state.get("system_prompt")}]
-    last_message = st.session_state.messages[-1]["content"]
-    for message in st.session_state.messages:
-        messages.append({"role": message["role"], "content": message["content"]})
-
-    llm_funct= session_state.get("llm_functions")
-
-    function_definitions = []
-    function_functions = {}
-
-    
-
-    for function in llm_funct:
-        function_definitions.append(function["definition"])
-        function_name = function["definition"]["name"]
-        #print("Function Name")
-        #print(function_name)
-        funct = getattr(getattr(llmfs,function_name),function_name)
-        #print(funct)
-        function_functions[function["definition"]["name"]] = funct
-
-    user_reply = False
-    while user_reply == False:
-        with st.spinner('ok, just a sec ...'):
-            response = llm_client.chat.completions.create(
-                            model=st.session_state.get("azure_openai_deployment_name"),
-                            messages=messages,
-                            stream=False,
-                            functions= function_definitions
-                        )
-        choice = response.choices[0]
-        if choice.finish_reason == "function_call":
-            print("LLM Function Call")
-            function_call = choice.message.function_call
-            function_name = function_call.name
-            function_args = function_call.arguments
-            if isinstance(function_args, str):
-                function_args = json.loads(function_args)
-            print(function_name)
-            print(function_args)
-            function = function_functions[function_name]
+def chat_view_events(container : st.container) -> callable:
+    """
+    Returns an on_event callback for chat_turn that renders the turn into the container.
+    """
+    placeholder = None
 
+    def on_event(event: str, data=None):
+        nonlocal placeholder
+        if event == "completion_start":
             with container:
-                user_update = st.write(f"To help answer your question I'm calling the function {function_name} with the following arguments: {function_args}")
-
-
-            response = function(**function_args)
-            #print("Response:",response)
-            messages.append(
-                {
-                    "role": "assistant",
-                    "content": None,
-                    "function_call": {
-                        "name": function_name,
-                        "arguments": json.dumps(function_args),
-                    },
-                }
-            )
-            messages.append(
-                {
-                    "role": "function", 
-                    "name": function_name, 
-                    "content": f'{{"result": {str(response)} }}'}
-            )
-        else:
-            user_reply = True
-            response = choice.message.content
+                placeholder = st.empty()
+            placeholder.markdown("ok, just a sec ...")
+        elif event == "content":
+            placeholder.markdown(data + "▌")
+        elif event == "completion_end":
+            if data:
+                placeholder.markdown(data)
+            else:
+                placeholder.empty()
+        elif event == "tool_call":
             with container:
-                st.write(response)
-
-    elasticapm.label(es_query=last_message)
-    audit_message = f'User {user_name} asked {last_message} and received {response}'
-    audit_context = {'user.full_name': user_name}
-    audit_context['reply'] = response
-    audit_context['query'] = last_message
-    audit_context['doc_references'] = []
-    results = session_state.get("search_results")
-    if results is not None:
-        for result in results:
-            audit_context['doc_references'].append(result["_source"]["title"])
-    logger = session_state.get("logger_client")
-    logger.info(audit_message,extra=audit_context)
-            
-    return response
+                st.write(f"To help answer your question I'm calling the function {data['name']} with the following arguments: {data['arguments']}")
+    return on_event
+
+def llm_chat(container : st.container):
+    # The turn itself is UI free, this only renders its progress
+    if session_state.get("llm_async"):
+        return run_sync(async_chat_turn, on_event=chat_view_events(container))
+    return chat_turn(chat_view_events(container))
 
 def reset_chat():
     st.session_state.messages = []
+    reset_context()
 
 def submit_audio(container : st.container):
     question = session_state.get("STT_output")
@@ -211,18 +191,13 @@ def submit_chat(chat_container : st.container, prompt : str = None):
     apm_client = session_state.get("apm_client")
     if  apm_client:
         apm_client.begin_transaction(transaction_type="script")
-    # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": prompt})
     with chat_container:
         # Display user message in chat message container
         with st.chat_message("user"):
             st.markdown(prompt)
 
-        response = llm_chat(st.chat_message("assistant"))
-
-        if response:
-            # Add LLM response to chat history
-            st.session_state.messages.append({"role": "assistant", "content": response})
+        # The session adds the question and the reply to the chat history
+        RagSession(st.session_state).chat(prompt, chat_view_events(st.chat_message("assistant")))
     if apm_client:
         apm_client.end_transaction(name="llm_chat", result="success")
     return
@@ -0,0 +1,141 @@
+from components.session import session_state
+import os
+from functools import lru_cache
+
+####################################################################################################
+# Conversation Context
+####################################################################################################
+
+# Keeps the messages sent to the LLM within a token budget. The newest turns are sent as they are,
+# older turns are folded into a running summary and stale function results are cut down first.
+default_token_budget = int(os.getenv("LLM_CONTEXT_TOKEN_BUDGET", "6000"))
+default_tool_result_token_limit = int(os.getenv("LLM_TOOL_RESULT_TOKEN_LIMIT", "1500"))
+message_overhead_tokens = 4
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    # tiktoken is optional, without it the count is estimated from the length of the text
+    _encoding = None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+def message_tokens(message: dict) -> int:
+    tokens = message_overhead_tokens + count_tokens(message.get("content") or "")
+    for tool_call in message.get("tool_calls") or []:
+        tokens += count_tokens(tool_call["function"]["name"]) + count_tokens(tool_call["function"]["arguments"])
+    return tokens
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text)[:max_tokens]) + " ...[truncated]"
+    return text[:max_tokens * 4] + " ...[truncated]"
+
+
+def summarize_messages(llm_client, summary: str, messages: list) -> str:
+    """
+    Folds messages into the running summary of the conversation with one LLM call.
+    """
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    prompt = f"Current summary:\n{summary or 'None'}\n\nNew messages:\n{transcript}"
+    response = llm_client.chat.completions.create(
+        model=session_state.get("azure_openai_deployment_name"),
+        messages=[
+            {"role": "system", "content": "Update the summary of a conversation between a user and an assistant with the new messages. Keep facts, names, document titles and open questions. Reply with the summary only."},
+            {"role": "user", "content": prompt}
+        ],
+        stream=False
+    )
+    return response.choices[0].message.content
+
+
+def build_context(llm_client, system_prompt: str, history: list, token_budget: int = None) -> list:
+    """
+    Returns the messages for a completion: the system prompt, the running summary and the newest turns
+    of history that fit in the token budget.
+
+    Turns that no longer fit are added to the summary held in the session state, which is only
+    extended with turns it does not cover yet.
+    """
+    token_budget = token_budget or session_state.get("context_token_budget", default_token_budget)
+    summary = session_state.get("conversation_summary") or {"upto": 0, "text": ""}
+
+    # Reserve space for the summary so the turns kept do not squeeze it out
+    available = token_budget - count_tokens(system_prompt or "") - message_overhead_tokens - count_tokens(summary["text"])
+    start = len(history)
+    for index in range(len(history) - 1, -1, -1):
+        tokens = message_tokens(history[index])
+        # The newest message is always sent
+        if tokens > available and index < len(history) - 1:
+            break
+        available -= tokens
+        start = index
+
+    if start > summary["upto"]:
+        try:
+            text = summarize_messages(llm_client, summary["text"], history[summary["upto"]:start])
+            summary = {"upto": start, "text": text}
+            session_state["conversation_summary"] = summary
+        except Exception as e:
+            # Without a summary the older turns are dropped
+            print(f"Error summarizing the conversation: {e}")
+    start = max(start, summary["upto"])
+
+    content = system_prompt or ""
+    if summary["text"]:
+        content += f"\n\nSummary of the earlier conversation:\n{summary['text']}"
+    messages = [{"role": "system", "content": content}]
+    for message in history[start:]:
+        messages.append({"role": message["role"], "content": message["content"]})
+    return messages
+
+
+def fit_tool_results(messages: list, token_budget: int = None, tool_result_token_limit: int = None) -> list:
+    """
+    Cuts down function results from earlier rounds of the turn so the messages fit in the budget.
+
+    Results of the latest round are kept whole. Older results are truncated first and dropped if the
+    messages still do not fit.
+    """
+    token_budget = token_budget or session_state.get("context_token_budget", default_token_budget)
+    tool_result_token_limit = tool_result_token_limit or session_state.get("tool_result_token_limit", default_tool_result_token_limit)
+
+    # Tool messages before the last assistant tool call message are stale
+    last_round = len(messages)
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index].get("tool_calls"):
+            last_round = index
+            break
+    stale = [index for index in range(last_round) if messages[index]["role"] == "tool"]
+    if not stale:
+        return messages
+
+    messages = list(messages)
+    total = sum(message_tokens(message) for message in messages)
+    for index in stale:
+        if total <= token_budget:
+            break
+        before = message_tokens(messages[index])
+        messages[index] = dict(messages[index], content=truncate_to_tokens(messages[index]["content"], tool_result_token_limit))
+        total -= before - message_tokens(messages[index])
+    for index in stale:
+        if total <= token_budget:
+            break
+        before = message_tokens(messages[index])
+        messages[index] = dict(messages[index], content='{"result": "dropped to save space"}')
+        total -= before - message_tokens(messages[index])
+    return messages
+
+
+def reset_context():
+    session_state["conversation_summary"] = None
@@ -1,8 +1,110 @@
 import streamlit as st
+from components.session import session_state
 import llm_functions
+import importlib
+import json
+import os
+import threading
+import time
 from pkgutil import iter_modules
 
-session_state = st.session_state
+####################################################################################################
+# LLM Function Registry
+####################################################################################################
+
+# The functions are imported once per process, a module is only reloaded when its file changes
+reload_check_interval = float(os.getenv("LLM_FUNCTIONS_RELOAD_INTERVAL", "2"))
+
+
+class FunctionRegistry:
+    """
+    Process wide registry of the functions in the llm_functions package.
+
+    Each entry holds the function definition and its tool payload, the callable, the optional
+    coroutine variant (a <name>_async function of the module), the source fields it reads from
+    search hits and the JSON of the definition. Modules are reloaded when their file
+    modification time changes.
+    """
+
+    def __init__(self, package, check_interval: float = reload_check_interval):
+        self._package = package
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._functions = {}
+        self._mtimes = {}
+        self._last_check = 0
+
+    def functions(self) -> list:
+        self.refresh()
+        with self._lock:
+            return [self._functions[name] for name in sorted(self._functions)]
+
+    def get(self, name: str) -> dict:
+        self.refresh()
+        with self._lock:
+            return self._functions.get(name)
+
+    def refresh(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_check < self._check_interval:
+            return
+        with self._lock:
+            if not force and now - self._last_check < self._check_interval:
+                return
+            self._last_check = now
+            found = set()
+            for submodule in iter_modules(getattr(self._package, "__path__")):
+                if submodule.ispkg:
+                    continue
+                name = submodule.name
+                path = os.path.join(submodule.module_finder.path, name + ".py")
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                found.add(name)
+                if self._mtimes.get(name) == mtime:
+                    continue
+                try:
+                    self._functions[name] = self._load(name, reload=name in self._mtimes)
+                    self._mtimes[name] = mtime
+                except Exception as e:
+                    print(f"Error loading LLM function {name}: {e}")
+            for name in list(self._functions):
+                if name not in found:
+                    del self._functions[name]
+                    self._mtimes.pop(name, None)
+
+    def _load(self, name: str, reload: bool = False) -> dict:
+        mod = importlib.import_module(f"{self._package.__name__}.{name}")
+        if reload:
+            print(f"Reloading LLM function {name}")
+            mod = importlib.reload(mod)
+        definition = getattr(mod, "definition")
+        func = getattr(mod, name)
+        # Source fields the function reads from the search hits
+        source_fields = getattr(mod, "source_fields", [])
+        return {
+            "name": name,
+            "definition": definition,
+            "function": func,
+            # Used by the async chat turn, which runs the sync function in a worker thread otherwise
+            "async_function": getattr(mod, f"{name}_async", None),
+            "source_fields": source_fields,
+            "schema_json": json.dumps(definition, indent=2),
+            "tool": {"type": "function", "function": definition}
+        }
+
+
+function_registry = FunctionRegistry(llm_functions)
+
+
+def get_enabled_functions() -> list:
+    """
+    Returns the registry entries enabled in this session.
+    """
+    return [function for function in function_registry.functions() if session_state.get("llm_function_"+function["name"], True) != False]
+
 
 def function_select_widget(container : st.container):
     """
@@ -12,35 +114,22 @@ def function_select_widget(container : st.container):
     - container (st.container): Streamlit container to render the widget in.
 
     Returns:
-
+        list: The functions enabled in this session.
     """
 
-    modules = list(iter_modules(getattr(llm_functions,"__path__")))
-
-    available_functions = []
-    for submodule in iter_modules(getattr(llm_functions,"__path__")):
-        if submodule.ispkg:
-            pass
-        else:
-            mod= __import__(f"llm_functions.{submodule.name}",fromlist=["llm_functions"])
-            definition = getattr(mod,"definition")
-            func = getattr(mod,submodule.name)
-            available_functions.append({"name":submodule.name,"definition":definition,"function":func})
+    available_functions = function_registry.functions()
 
     with container:
         for function in available_functions:
             definition_col, enable_col = st.columns([1,1])
             with definition_col:
                 with st.popover(label=function["definition"]["name"]):
-                    st.write(function["definition"])
+                    st.code(function["schema_json"], language="json")
             with enable_col:
                 st.checkbox("Enable", key="llm_function_"+function["name"],value=True)
 
-    for function in available_functions:
-        if session_state.get("llm_function_"+function["name"])== False:
-            available_functions.remove(function)
-    return available_functions
+    return get_enabled_functions()
 
 if __name__ == "__main__":
     st.title("Function Selector")
-    function_select_widget(st.container())
\ No newline at end of file
+    function_select_widget(st.container())
@@ -0,0 +1,115 @@
+# multi_query.py
+
+import os
+import re
+import numpy as np
+
+####################################################################################################
+# Multi Query Retrieval
+####################################################################################################
+
+# A question is searched as several query variants, written by the LLM in its search tool call or
+# derived from the question by the rules below. The ranked lists of the variants, and optionally of a
+# kNN search, are fused with reciprocal rank fusion: a document scores sum(weight / (k + rank)) over
+# the lists it appears in, so documents found by several variants rise to the top.
+default_max_variants = int(os.getenv("MULTI_QUERY_MAX_VARIANTS", "4"))
+# Hits fetched per ranked list, the fused list is cut to num_results
+default_rank_window = int(os.getenv("MULTI_QUERY_RANK_WINDOW", "20"))
+default_rank_constant = int(os.getenv("MULTI_QUERY_RANK_CONSTANT", "60"))
+
+_token_pattern = re.compile(r"\w+")
+_clause_pattern = re.compile(r"\s*(?:,|;|\band\b|\bor\b|\bvs\.?|\bversus\b)\s*", re.IGNORECASE)
+
+stopwords = frozenset("""
+a about an and are as at be by can could did do does for from how i in is it its me my of on or
+should than that the their there these this those to was what when where which who why will with
+would you your please tell explain describe
+""".split())
+
+
+def keywords(text: str) -> list:
+    # The words of a text without stopwords, in order and without repeats
+    seen = set()
+    words = []
+    for word in _token_pattern.findall(text.lower()):
+        if word not in stopwords and word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def expand_query(query: str, max_variants: int = default_max_variants) -> list:
+    """
+    Returns rule based variants of a query, starting with the query itself.
+
+    The variants are, for questions comparing or listing several things, each of its clauses on
+    its own, then the keywords of the query without stopwords. The clauses come first so that none
+    of the compared things is cut by max_variants, the query itself still covers all keywords.
+
+    Parameters:
+    - query (str): The query.
+    - max_variants (int): Maximum number of variants, including the query.
+    """
+    variants = [query]
+    clauses = [clause for clause in _clause_pattern.split(query) if clause and clause.strip()]
+    if len(clauses) > 1:
+        variants.extend(" ".join(keywords(clause)) for clause in clauses)
+    query_keywords = keywords(query)
+    if query_keywords:
+        variants.append(" ".join(query_keywords))
+    return unique_variants(variants)[:max_variants]
+
+
+def unique_variants(variants: list) -> list:
+    # Drops empty variants and repeats that differ only in case and spacing
+    seen = set()
+    unique = []
+    for variant in variants:
+        if not isinstance(variant, str):
+            continue
+        normalized = " ".join(variant.lower().split())
+        if normalized and normalized not in seen:
+            seen.add(normalized)
+            unique.append(variant.strip())
+    return unique
+
+
+def query_variants(query: str, llm_variants: list = None, max_variants: int = default_max_variants) -> list:
+    """
+    Returns the query followed by the variants written by the LLM, or the rule based variants when
+    the LLM gave none.
+    """
+    if llm_variants:
+        return unique_variants([query] + list(llm_variants))[:max_variants]
+    return expand_query(query, max_variants)
+
+
+def reciprocal_rank_fusion(ranked_lists: list, rank_constant: int = default_rank_constant, weights: list = None) -> list:
+    """
+    Fuses ranked lists of document keys with reciprocal rank fusion.
+
+    Ties are broken by the first appearance of a key, i.e. the earlier lists win.
+
+    Parameters:
+    - ranked_lists (list): Lists of hashable document keys, best first.
+    - rank_constant (int): The k of the fusion, higher values flatten the contribution of the top ranks.
+    - weights (list): Weight of each list, 1 by default.
+
+    Returns:
+        list: (key, score) pairs, best first.
+    """
+    lengths = np.array([len(ranked) for ranked in ranked_lists], dtype=np.int64)
+    total = int(lengths.sum())
+    if total == 0:
+        return []
+    # Every key gets a code, the fusion itself runs over the codes of all lists at once
+    codes_by_key = {}
+    codes = np.fromiter((codes_by_key.setdefault(key, len(codes_by_key)) for ranked in ranked_lists for key in ranked), dtype=np.int64, count=total)
+    list_index = np.repeat(np.arange(len(ranked_lists)), lengths)
+    ranks = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths) + 1
+    list_weights = np.ones(len(ranked_lists)) if weights is None else np.asarray(weights, dtype=np.float64)
+    scores = np.bincount(codes, weights=list_weights[list_index] / (rank_constant + ranks), minlength=len(codes_by_key))
+    # Codes are assigned in order of first appearance, so sorting by code breaks the ties
+    order = np.lexsort((np.arange(len(scores)), -scores))
+    keys = list(codes_by_key)
+    return [(keys[code], float(scores[code])) for code in order]
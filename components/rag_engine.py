@@ -0,0 +1,214 @@
+# rag_engine.py
+
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from components.session import use_state
+from components.elasticsearch import search as es_search
+from components.elasticsearch_connection import get_pooled_es_client, es_client_key
+from components.llm_functions import function_registry
+from components.llm_context import reset_context
+from components.chat import chat_turn, async_chat_turn, no_events
+from components.async_runtime import run_sync
+
+####################################################################################################
+# Headless RAG Engine
+####################################################################################################
+
+# The search and chat pipeline without Streamlit. A RagSession holds the explicit state of one user,
+# the RagEngine creates sessions from a shared configuration. Clients come from the process wide
+# registries, so every session with the same credentials shares one connection pool.
+
+
+def default_config() -> dict:
+    """
+    Returns the engine configuration from the environment, with the same defaults as the app.
+    """
+    with open("default_query_body.json") as f:
+        default_query_body = f.read().strip()
+    return {
+        "cloud_id": os.getenv("CLOUD_ID"),
+        "elasticsearch_url": os.getenv("ELASTICSEARCH_URL"),
+        "api_key": os.getenv("ELASTICSEARCH_API_KEY"),
+        "index_name": os.getenv("RAG_INDEX_NAME", "*"),
+        "search_body": default_query_body,
+        "num_results": int(os.getenv("RAG_NUM_RESULTS", "10")),
+        "source_filtering": True,
+        "use_stored_template": False,
+        "llm_type": os.getenv("LLM_TYPE"),
+        "azure_openai_key": os.getenv("AZURE_OPENAI_KEY"),
+        "azure_openai_endpoint": os.getenv("AZURE_OPENAI_ENDPOINT"),
+        "azure_openai_deployment_name": os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+        "system_prompt": os.getenv("RAG_SYSTEM_PROMPT", "you are a friendly chatbot"),
+        "llm_streaming": False,
+        # Runs the chat turn on the asyncio path, overlapping its independent I/O
+        "llm_async": os.getenv("RAG_LLM_ASYNC", "false").lower() == "true",
+        # Names of the enabled LLM functions, None enables all of them
+        "llm_function_names": None,
+        "semantic_cache_enabled": False,
+        "multi_query_enabled": os.getenv("RAG_MULTI_QUERY", "false").lower() == "true",
+        "diversity_enabled": os.getenv("RAG_DIVERSITY", "false").lower() == "true",
+    }
+
+# Settings a client may override per session, credentials and endpoints are fixed by the engine
+session_settings = {
+    "index_name", "search_body", "num_results", "source_filtering", "use_stored_template", "system_prompt",
+    "llm_streaming", "llm_async", "llm_function_names", "context_token_budget", "user_name", "corpus_description",
+    "semantic_cache_enabled", "multi_query_enabled", "multi_query_max_variants", "multi_query_knn_field",
+    "multi_query_knn_model_id", "diversity_enabled", "diversity_lambda", "diversity_over_fetch", "diversity_parent_field",
+    "diversity_max_per_parent", "diversity_vector_field", "diversity_text_field",
+}
+
+
+class RagSession:
+    """
+    The state of one user of the search and chat pipeline.
+
+    The pipeline functions read the state through components.session, activate() makes this
+    session's state the active one. Requests on one session are serialized.
+
+    Parameters:
+    - state (dict): The session state. The Streamlit app passes st.session_state.
+    - session_id (str): Id of the session, generated if not given.
+    """
+
+    def __init__(self, state: dict = None, session_id: str = None):
+        self.id = session_id or uuid.uuid4().hex
+        self.state = state if state is not None else {}
+        self.last_used = time.monotonic()
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def activate(self):
+        with self._lock, use_state(self.state):
+            self.last_used = time.monotonic()
+            yield self.state
+
+    def configure(self, config: dict, es_client, llm_client, logger: logging.Logger = None):
+        state = self.state
+        state.update({key: value for key, value in config.items() if key != "llm_function_names"})
+        state["es_client"] = es_client
+        state["es_client_key"] = es_client_key(config.get("cloud_id"), config.get("elasticsearch_url"), config.get("api_key"))
+        state["llm_client"] = llm_client
+        state["logger_client"] = logger or logging.getLogger("app")
+        state.setdefault("messages", [])
+        names = config.get("llm_function_names")
+        state["llm_functions"] = [function for function in function_registry.functions() if names is None or function["name"] in names]
+
+    def search(self, query: str) -> list:
+        """
+        Runs the configured search and returns the hits. They also become the session's last results.
+        """
+        with self.activate():
+            return es_search(query)
+
+    def chat(self, message: str, on_event: callable = no_events) -> str:
+        """
+        Adds a message to the chat history, answers it and returns the reply.
+        """
+        with self.activate() as state:
+            state["messages"].append({"role": "user", "content": message})
+            try:
+                if state.get("llm_async"):
+                    reply = run_sync(async_chat_turn, on_event=on_event)
+                else:
+                    reply = chat_turn(on_event)
+            except Exception:
+                # A failed turn leaves no unanswered question in the history
+                state["messages"].pop()
+                raise
+            if reply:
+                state["messages"].append({"role": "assistant", "content": reply})
+            return reply
+
+    def reset_chat(self):
+        with self.activate() as state:
+            state["messages"] = []
+            reset_context()
+
+    @property
+    def messages(self) -> list:
+        return list(self.state.get("messages", []))
+
+    @property
+    def search_results(self) -> list:
+        return self.state.get("search_results") or []
+
+
+class RagEngine:
+    """
+    Creates and keeps the headless sessions of a process.
+
+    Sessions idle for longer than session_ttl seconds are dropped, and the least recently used ones
+    once there are more than max_sessions.
+
+    Parameters:
+    - config (dict): Overrides of default_config().
+    - session_ttl (float): Seconds an idle session is kept.
+    - max_sessions (int): Maximum number of sessions kept.
+    """
+
+    def __init__(self, config: dict = None, session_ttl: float = 1800, max_sessions: int = 10000):
+        self.config = default_config()
+        self.config.update(config or {})
+        self.session_ttl = session_ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def es_client(self):
+        return get_pooled_es_client(self.config.get("cloud_id"), self.config.get("elasticsearch_url"), self.config.get("api_key"))
+
+    def llm_client(self):
+        if self.config.get("llm_type") != "azure" or not self.config.get("azure_openai_endpoint"):
+            return None
+        # Imported here, the LLM module holds the Streamlit widgets
+        from components.llm import get_pooled_azure_client
+        llm_client, key = get_pooled_azure_client(self.config.get("azure_openai_key"), self.config.get("azure_openai_endpoint"))
+        return llm_client
+
+    def create_session(self, settings: dict = None) -> RagSession:
+        """
+        Creates a session with the engine configuration and the given session settings.
+        """
+        unknown = set(settings or {}) - session_settings
+        if unknown:
+            raise ValueError(f"Unknown session settings: {', '.join(sorted(unknown))}")
+        config = dict(self.config, **(settings or {}))
+        session = RagSession()
+        session.configure(config, self.es_client(), self.llm_client())
+        with self._lock:
+            self._expire()
+            self._sessions[session.id] = session
+        return session
+
+    def get_session(self, session_id: str) -> RagSession:
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+        if session is not None:
+            # Looking the pooled clients up again keeps them in use, or replaces closed ones
+            session.state["es_client"] = self.es_client()
+            session.state["llm_client"] = self.llm_client()
+        return session
+
+    def close_session(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def session_count(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def _expire(self):
+        now = time.monotonic()
+        for session_id in [session_id for session_id, session in self._sessions.items() if now - session.last_used > self.session_ttl]:
+            del self._sessions[session_id]
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
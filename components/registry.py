@@ -0,0 +1,102 @@
+# registry.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+####################################################################################################
+# Bounded Process Registry
+####################################################################################################
+
+# Clients, health monitors and index catalogs are shared by every session of the process and keyed
+# by their credentials. Every half typed URL or key produces a new key, so the registries keep at
+# most registry_max_size entries and drop the ones no session has used for registry_idle_ttl seconds.
+# Dropped entries are closed so their connections and threads do not outlive them.
+registry_max_size = int(os.getenv("REGISTRY_MAX_SIZE", "16"))
+registry_idle_ttl = float(os.getenv("REGISTRY_IDLE_TTL", "3600"))
+
+
+class BoundedRegistry:
+    """
+    LRU registry of shared objects with an idle timeout.
+
+    Parameters:
+    - name (str): Name of the registry, used for logging.
+    - close (callable): Called with each evicted object, outside of the registry lock.
+    - max_size (int): Maximum number of objects kept.
+    - idle_ttl (float): Seconds after its last use an object is evicted.
+    """
+
+    def __init__(self, name: str, close: callable, max_size: int = None, idle_ttl: float = None):
+        self.name = name
+        self._close = close
+        self._max_size = max_size or registry_max_size
+        self._idle_ttl = idle_ttl or registry_idle_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (object, last used)
+
+    def get(self, key, create: callable = None):
+        """
+        Returns the object registered for key, creating it with create() when it does not exist.
+
+        Returns None when the key is unknown and no create function is given.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value = entry[0]
+            elif create is None:
+                value = None
+            else:
+                value = create()
+            if value is not None:
+                self._entries[key] = (value, now)
+                self._entries.move_to_end(key)
+            evicted = self._take_evicted(now)
+        self._close_all(evicted)
+        return value
+
+    def pop(self, key):
+        # Removes key and closes its object
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._close_all([(key, entry[0])])
+
+    def take_all(self) -> list:
+        # Removes every object and returns them without closing them
+        with self._lock:
+            values = [value for value, _ in self._entries.values()]
+            self._entries.clear()
+        return values
+
+    def clear(self):
+        # Closes every object, used at process shutdown
+        for value in self.take_all():
+            try:
+                self._close(value)
+            except Exception as e:
+                print(e)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _take_evicted(self, now: float) -> list:
+        evicted = []
+        while self._entries:
+            key, (value, last_used) = next(iter(self._entries.items()))
+            if len(self._entries) <= self._max_size and now - last_used < self._idle_ttl:
+                break
+            del self._entries[key]
+            evicted.append((key, value))
+        return evicted
+
+    def _close_all(self, evicted: list):
+        for key, value in evicted:
+            print(f"Closing {self.name} that is no longer used")
+            try:
+                self._close(value)
+            except Exception as e:
+                print(e)
@@ -1,4 +1,6 @@
 import streamlit as st
+from functools import lru_cache
+from string import Formatter
 
 session_state = st.session_state
 
@@ -6,21 +8,112 @@ session_state = st.session_state
 with open("default_md_template.md") as f:
     default_md_template = f.read().strip()
 
+default_page_size = 20
 
 
-def render_document(doc: dict, md_template: str = None):
+class CompiledTemplate:
+    """
+    A display template parsed once into literal text and field lookups.
 
+    Fields can reference nested values with dots, e.g. {author.name}. Missing fields render as an
+    empty string instead of failing the whole document.
+    """
+
+    def __init__(self, md_template: str):
+        self.segments = []
+        for literal_text, field_name, format_spec, conversion in Formatter().parse(md_template):
+            path = tuple(field_name.split(".")) if field_name else None
+            self.segments.append((literal_text, path, format_spec, conversion))
+
+    @staticmethod
+    def lookup(source: dict, path: tuple):
+        value = source
+        for key in path:
+            if isinstance(value, dict):
+                value = value.get(key)
+            elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+                value = value[int(key)]
+            else:
+                return ""
+            if value is None:
+                return ""
+        return value
+
+    def render(self, source: dict) -> str:
+        parts = []
+        for literal_text, path, format_spec, conversion in self.segments:
+            parts.append(literal_text)
+            if path is None:
+                continue
+            value = self.lookup(source, path)
+            if conversion == "r":
+                value = repr(value)
+            elif conversion == "a":
+                value = ascii(value)
+            elif conversion == "s":
+                value = str(value)
+            parts.append(format(value, format_spec) if format_spec else str(value))
+        return "".join(parts)
+
+
+@lru_cache(maxsize=64)
+def compile_template(md_template: str) -> CompiledTemplate:
+    return CompiledTemplate(md_template)
+
+
+def render_document(doc: dict, md_template: str = None) -> str:
+    """
+    Returns the markdown for a document, or None if it can't be rendered.
+    """
     if md_template:
         source = doc["_source"]
         try:
-            doc = md_template.format(**source)
-            st.markdown(doc)
+            return compile_template(md_template).render(source)
         except Exception as e:
             print(e)
             print("Error in writing doc")
             print(source)
+    return None
+
+def set_results_page(page: int):
+    session_state["search_results_page"] = page
 
 def search_results_widget(search_results_container,docs: list[dict], md_template: str = None):
+    """
+    Renders one page of search results as a single markdown block.
+
+    Parameters:
+    - search_results_container (st.container): Streamlit container to render the results in.
+    - docs (list[dict]): The search hits.
+    - md_template (str): Display template for a document.
+    """
+    if not md_template:
+        return
+    try:
+        compile_template(md_template)
+    except ValueError as e:
+        with search_results_container:
+            st.error(f"Invalid document display template: {e}")
+        return
+
+    page_size = session_state.get("results_page_size", default_page_size)
+    n_pages = max(1, -(-len(docs) // page_size))
+    # set_search_results goes back to the first page when a new result set is stored
+    page = min(session_state.get("search_results_page", 0), n_pages - 1)
+
+    rendered = []
+    for doc in docs[page * page_size:(page + 1) * page_size]:
+        markdown = render_document(doc, md_template)
+        if markdown is not None:
+            rendered.append(markdown)
+
     with search_results_container:
-        for doc in docs:
-            render_document(doc, md_template)
+        st.markdown("\n\n".join(rendered))
+        if n_pages > 1:
+            previous_col, page_col, next_col = st.columns([1, 2, 1])
+            with previous_col:
+                st.button("Previous", key="search_results_previous_button", on_click=set_results_page, args=[page - 1], disabled=page == 0)
+            with page_col:
+                st.write(f"Page {page + 1} of {n_pages} ({len(docs)} results)")
+            with next_col:
+                st.button("Next", key="search_results_next_button", on_click=set_results_page, args=[page + 1], disabled=page >= n_pages - 1)
@@ -0,0 +1,245 @@
+from components.session import session_state
+import elasticsearch
+import hashlib
+import os
+import re
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+####################################################################################################
+# Semantic Answer Cache
+####################################################################################################
+
+# Questions and answers from the chat are stored with an embedding of the question. A new question
+# that is close enough to a stored one is answered from the cache without calling the LLM, a less
+# similar one can still seed the LLM with the stored answer. Answers depend on the searched index and
+# the system prompt, so entries are only matched within the same scope.
+default_cache_index = os.getenv("SEMANTIC_CACHE_INDEX", "rag-semantic-cache")
+default_return_threshold = float(os.getenv("SEMANTIC_CACHE_RETURN_THRESHOLD", "0.95"))
+default_seed_threshold = float(os.getenv("SEMANTIC_CACHE_SEED_THRESHOLD", "0.85"))
+embedding_deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+
+_token_pattern = re.compile(r"\w+")
+
+
+class HashingEmbedder:
+    """
+    Deterministic embedder hashing word unigrams and bigrams into a fixed size vector.
+
+    It needs no model, which makes the cache usable and testable without an embedding endpoint.
+    """
+
+    def __init__(self, dims: int = 384):
+        self.dims = dims
+        self.name = f"hashing-{dims}"
+
+    def embed(self, text: str) -> list:
+        vector = np.zeros(self.dims, dtype=np.float32)
+        tokens = _token_pattern.findall(text.lower())
+        features = tokens + [a + " " + b for a, b in zip(tokens, tokens[1:])]
+        for feature in features:
+            digest = hashlib.md5(feature.encode()).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dims
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+
+# Embedding sizes of the deployments, asked once per process
+_embedding_dims = {}
+
+
+class OpenAIEmbedder:
+    """
+    Embedder using an (Azure) OpenAI embedding deployment.
+
+    The size of the embeddings depends on the model, it is read from a first embedding unless given.
+    """
+
+    def __init__(self, llm_client, model: str, dims: int = None):
+        self._llm_client = llm_client
+        self._model = model
+        self._dims = dims
+
+    @property
+    def dims(self) -> int:
+        if self._dims is None:
+            if self._model not in _embedding_dims:
+                _embedding_dims[self._model] = len(self.embed("dimensions"))
+            self._dims = _embedding_dims[self._model]
+        return self._dims
+
+    @property
+    def name(self) -> str:
+        return f"openai-{self._model}-{self.dims}"
+
+    def embed(self, text: str) -> list:
+        return self._llm_client.embeddings.create(model=self._model, input=[text]).data[0].embedding
+
+
+def cache_index_name(index: str, embedder) -> str:
+    # Each embedder gets its own index, the vector mapping depends on its dims
+    return re.sub(r"[^a-z0-9_-]+", "-", f"{index}-{embedder.name}".lower())
+
+
+def cache_scope() -> dict:
+    """
+    Returns the scope of the session's cache entries: the searched index and a hash of the system prompt.
+    """
+    system_prompt = session_state.get("system_prompt") or ""
+    return {
+        "index_name": session_state.get("index_name") or "",
+        "system_prompt_hash": hashlib.sha256(system_prompt.encode()).hexdigest(),
+    }
+
+
+class SemanticAnswerCache:
+    """
+    Question and answer pairs in an Elasticsearch index with a dense vector of the question.
+
+    Parameters:
+    - es_client (Elasticsearch): Client of the cluster holding the cache index.
+    - index (str): Base name of the cache index, the name of the embedder is appended.
+    - embedder: Object with an embed(text) method and dims and name attributes.
+    - scope (dict): Fields stored with every entry, lookups only match entries with the same values.
+    """
+
+    def __init__(self, es_client: elasticsearch.Elasticsearch, index: str, embedder, scope: dict = None):
+        self._es_client = es_client
+        self.base_index = index
+        self.index = cache_index_name(index, embedder)
+        self.embedder = embedder
+        self.scope = scope or {}
+        self._index_ready = False
+
+    def ensure_index(self):
+        if self._index_ready:
+            return
+        if not self._es_client.indices.exists(index=self.index):
+            self._es_client.indices.create(index=self.index, mappings={
+                "properties": {
+                    "@timestamp": {"type": "date"},
+                    "query": {"type": "text"},
+                    "reply": {"type": "text", "index": False},
+                    "doc_references": {"type": "keyword"},
+                    "user": {"type": "keyword"},
+                    "embedder": {"type": "keyword"},
+                    "index_name": {"type": "keyword"},
+                    "system_prompt_hash": {"type": "keyword"},
+                    "cache_hits": {"type": "integer"},
+                    "query_vector": {"type": "dense_vector", "dims": self.embedder.dims, "index": True, "similarity": "cosine"}
+                }
+            })
+        self._index_ready = True
+
+    def lookup(self, query: str, min_similarity: float) -> dict:
+        """
+        Returns the most similar cached entry with a cosine similarity of at least min_similarity,
+        or None. The entry has the _id, similarity, query, reply and doc_references.
+        """
+        self.ensure_index()
+        result = self._es_client.search(
+            index=self.index,
+            knn={
+                "field": "query_vector",
+                "query_vector": self.embedder.embed(query),
+                "k": 1,
+                "num_candidates": 20,
+                "similarity": min_similarity,
+                "filter": [{"term": {"embedder": self.embedder.name}}] + [{"term": {field: value}} for field, value in self.scope.items()]
+            },
+            source=["query", "reply", "doc_references"],
+            size=1
+        )
+        hits = result["hits"]["hits"]
+        if not hits:
+            return None
+        hit = hits[0]
+        # The cosine _score is (1 + cosine) / 2
+        entry = dict(hit["_source"], _id=hit["_id"], similarity=2 * hit["_score"] - 1)
+        return entry
+
+    def store(self, query: str, reply: str, doc_references: list = None, user: str = None):
+        self.ensure_index()
+        self._es_client.index(index=self.index, document={
+            "@timestamp": int(time.time() * 1000),
+            "query": query,
+            "reply": reply,
+            "doc_references": doc_references or [],
+            "user": user,
+            "embedder": self.embedder.name,
+            **self.scope,
+            "cache_hits": 0,
+            "query_vector": self.embedder.embed(query)
+        })
+
+    def record_hit(self, entry_id: str):
+        self._es_client.update(index=self.index, id=entry_id, script={"source": "ctx._source.cache_hits += 1"})
+
+    def browse(self, query: str = None, size: int = 50) -> list:
+        self.ensure_index()
+        if query:
+            body = {"query": {"match": {"query": query}}}
+        else:
+            body = {"query": {"match_all": {}}, "sort": [{"@timestamp": "desc"}]}
+        result = self._es_client.search(index=self.index, size=size, source_excludes=["query_vector"], **body)
+        return result["hits"]["hits"]
+
+    def evict(self, entry_ids: list):
+        for entry_id in entry_ids:
+            self._es_client.delete(index=self.index, id=entry_id, refresh=True)
+
+    def evict_older_than(self, days: float):
+        self.ensure_index()
+        self._es_client.delete_by_query(index=self.index, query={"range": {"@timestamp": {"lt": f"now-{int(days * 24)}h"}}}, refresh=True)
+
+    def clear(self):
+        self.ensure_index()
+        self._es_client.delete_by_query(index=self.index, query={"match_all": {}}, refresh=True)
+
+
+# Cache writes happen after the reply has been shown, off the script thread
+_store_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="semantic-cache")
+
+def get_embedder():
+    llm_client = session_state.get("llm_client")
+    if embedding_deployment and llm_client is not None:
+        return OpenAIEmbedder(llm_client, embedding_deployment)
+    return HashingEmbedder()
+
+def get_semantic_cache() -> SemanticAnswerCache:
+    """
+    Returns the semantic cache of the session, kept on the monitoring cluster when it is connected.
+    Returns None when the cache is disabled or no cluster is available.
+    """
+    if not session_state.get("semantic_cache_enabled", False):
+        return None
+    es_client = session_state.get("monitoring_es_client") or session_state.get("es_client")
+    if es_client is None:
+        return None
+    index = session_state.get("semantic_cache_index", default_cache_index)
+    scope = cache_scope()
+    cache = session_state.get("semantic_cache")
+    if cache is None or cache._es_client is not es_client or cache.base_index != index or cache.scope != scope:
+        cache = SemanticAnswerCache(es_client, index, get_embedder(), scope)
+        session_state["semantic_cache"] = cache
+    return cache
+
+def store_answer(cache: SemanticAnswerCache, query: str, reply: str, doc_references: list = None, user: str = None):
+    def store():
+        try:
+            cache.store(query, reply, doc_references, user)
+        except Exception as e:
+            print(f"Error storing the answer in the semantic cache: {e}")
+    _store_executor.submit(store)
+
+def record_cache_hit(cache: SemanticAnswerCache, entry_id: str):
+    def record():
+        try:
+            cache.record_hit(entry_id)
+        except Exception as e:
+            print(f"Error recording a semantic cache hit: {e}")
+    _store_executor.submit(record)
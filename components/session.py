@@ -0,0 +1,117 @@
+# session.py
+
+import contextvars
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+####################################################################################################
+# Session State
+####################################################################################################
+
+# The search and chat pipeline reads and writes its state through this module's session_state. In
+# the Streamlit app it is the Streamlit session state, a headless RagSession activates its own plain
+# dict for the duration of a request, so the same code serves both.
+_active_state = contextvars.ContextVar("rag_session_state", default=None)
+
+
+class SessionState(MutableMapping):
+    """
+    The state of the active headless session, or st.session_state when none is active.
+    """
+
+    def _target(self):
+        state = _active_state.get()
+        return st.session_state if state is None else state
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+    def __setitem__(self, key, value):
+        self._target()[key] = value
+
+    def __delitem__(self, key):
+        del self._target()[key]
+
+    def __iter__(self):
+        return iter(list(self._target().keys()))
+
+    def __len__(self):
+        return len(self._target())
+
+    def __contains__(self, key):
+        return key in self._target()
+
+    def get(self, key, default=None):
+        return self._target().get(key, default)
+
+    def setdefault(self, key, default=None):
+        return self._target().setdefault(key, default)
+
+
+session_state = SessionState()
+
+
+@contextmanager
+def use_state(state: MutableMapping):
+    """
+    Makes state the session state of the pipeline in the current context.
+    """
+    token = _active_state.set(state)
+    try:
+        yield state
+    finally:
+        _active_state.reset(token)
+
+
+def is_headless() -> bool:
+    return _active_state.get() is not None
+
+
+class ScriptSessionState(MutableMapping):
+    """
+    Mapping over the state of a Streamlit session, for use outside of the script thread.
+    """
+
+    def __init__(self, state):
+        self._state = state
+
+    def __getitem__(self, key):
+        return self._state[key]
+
+    def __setitem__(self, key, value):
+        self._state[key] = value
+
+    def __delitem__(self, key):
+        del self._state[key]
+
+    def __iter__(self):
+        return iter(list(self._state.filtered_state().keys()))
+
+    def __len__(self):
+        return len(self._state.filtered_state())
+
+    def __contains__(self, key):
+        return key in self._state
+
+
+def capture_state() -> MutableMapping:
+    """
+    Returns the current session state in a form that can be activated with use_state in another thread.
+
+    For a Streamlit session this is the state behind st.session_state. Its thread safe wrapper is
+    locked while widget callbacks run, so another thread could not use it while the script waits
+    for it in a callback. The state is therefore used without the lock, which is only safe while
+    the script thread leaves it alone: run_sync blocks the script, and the events it delivers to
+    the script must not touch the state. Multi key updates such as set_search_results are not
+    atomic for a reader on another thread.
+    """
+    state = _active_state.get()
+    # The app activates st.session_state itself, which only works in the script thread
+    if state is not None and state is not st.session_state:
+        return state
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        return ScriptSessionState(ctx.session_state._state)
+    return st.session_state
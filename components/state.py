@@ -1,64 +1,231 @@
 import os
+import json
 import pickle
+import threading
+import time
 import streamlit as st
 import dotenv
+from components.elasticsearch import set_search_results
 
 
 
 # Define the directory where the states will be saved
 states_directory = "./saved-states"
 session_state = st.session_state
-stste={}
+
+# Saved states are small JSON files holding only configuration, grouped in sections that can be
+# loaded on their own. Chat messages and search results are stored in a separate artifacts file
+# that is only read when asked for. index.json lists the states with their size and timestamp.
+state_format_version = 1
+index_file_name = "index.json"
+
+state_sections = {
+    "app": ["app_name", "img_url"],
+    "connection": ["cloud_id", "elasticsearch_url", "api_key"],
+    "llm": ["llm_type", "system_prompt", "corpus_description", "azure_openai_key", "azure_openai_deployment_name",
+            "azure_openai_endpoint", "llm_streaming", "context_token_budget"],
+    "search": ["search_body", "index_pattern", "index_name", "num_results", "search_query", "doc_md_template",
+               "results_page_size", "use_stored_template", "source_filtering", "multi_query_enabled",
+               "multi_query_max_variants", "multi_query_knn_field", "multi_query_knn_model_id", "diversity_enabled",
+               "diversity_lambda", "diversity_over_fetch", "diversity_parent_field", "diversity_max_per_parent",
+               "diversity_vector_field", "diversity_text_field"],
+    "semantic_cache": ["semantic_cache_enabled", "semantic_cache_index", "semantic_cache_return_threshold",
+                       "semantic_cache_seed_threshold"],
+    "monitoring": ["monitoring_cloud_id", "monitoring_elasticsearch_url", "monitoring_api_key", "logs_index_name",
+                   "apm_service_name", "apm_environment", "apm_secret_token", "apm_url", "event_dataset_logs"],
+}
+# Prefixes of keys that belong to a section, e.g. the enabled LLM functions
+state_section_prefixes = {
+    "llm_functions": "llm_function_",
+}
+artifact_keys = ["messages", "search_results", "conversation_summary"]
+
+_index_lock = threading.Lock()
+_index_cache = {"mtime": None, "index": {}}
+
+
+def state_file_name(state_name: str) -> str:
+    return os.path.join(states_directory, f"{state_name}.json")
+
+def artifacts_file_name(state_name: str) -> str:
+    return os.path.join(states_directory, f"{state_name}.artifacts.json")
+
+def collect_sections() -> dict:
+    # Returns the configuration keys of the session grouped by section
+    sections = {}
+    for section, keys in state_sections.items():
+        values = {key: session_state[key] for key in keys if key in session_state}
+        if values:
+            sections[section] = values
+    for section, prefix in state_section_prefixes.items():
+        values = {key: session_state[key] for key in session_state.keys() if key.startswith(prefix)}
+        if values:
+            sections[section] = values
+    return sections
+
+def read_index() -> dict:
+    """
+    Returns the index of saved states, read from disk only when the file has changed.
+    """
+    index_file = os.path.join(states_directory, index_file_name)
+    with _index_lock:
+        try:
+            mtime = os.stat(index_file).st_mtime
+        except OSError:
+            if not os.path.isdir(states_directory):
+                return {}
+            # No index yet, build one from the files in the directory
+            index = rebuild_index()
+            write_index(index)
+            _index_cache["index"] = index
+            _index_cache["mtime"] = os.stat(index_file).st_mtime
+            return dict(index)
+        if _index_cache["mtime"] != mtime:
+            with open(index_file) as f:
+                _index_cache["index"] = json.load(f)
+            _index_cache["mtime"] = mtime
+        return dict(_index_cache["index"])
+
+def write_index(index: dict):
+    index_file = os.path.join(states_directory, index_file_name)
+    temp_file = index_file + ".tmp"
+    with open(temp_file, "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(temp_file, index_file)
+
+def update_index(state_name: str, entry: dict = None):
+    # Adds, replaces or (with no entry) removes a state in the index
+    index = read_index()
+    if entry is None:
+        index.pop(state_name, None)
+    else:
+        index[state_name] = entry
+    write_index(index)
+
+def rebuild_index() -> dict:
+    index = {}
+    for file in os.listdir(states_directory):
+        path = os.path.join(states_directory, file)
+        if file == index_file_name or file.endswith(".artifacts.json"):
+            continue
+        if file.endswith(".json") or file.endswith(".pkl"):
+            state_name = file.rsplit(".", 1)[0]
+            index[state_name] = {
+                "file": file,
+                "size": os.path.getsize(path),
+                "saved_at": os.path.getmtime(path),
+                "version": state_format_version if file.endswith(".json") else 0,
+            }
+    return index
+
 # Function to save the current state
-def save_state(state_name: str, container: st.container):
+def save_state(state_name: str, container: st.container, include_artifacts: bool = False):
     """
-    Saves the session state to a file.
+    Saves the configuration in the session state to a file.
 
     Parameters:
     - state_name (str): The name of the state to be saved.
     - container (st.container): The Streamlit container to display the success message.
+    - include_artifacts (bool): Also save the chat messages and search results to a separate file.
 
     Returns:
     None
     """
 
-    global states_directory, state
     print(f"Saving session state as: {state_name}")
     if state_name:
         session_state["state_name"] = state_name
         state_name = state_name.strip()
         state_name = state_name.replace(" ", "_")
-        state_file = os.path.join(states_directory, f"{state_name}.pkl")
-        with open(state_file, "wb") as f:
-            print(f"Saving session state:\n{session_state}\nTo filename: {state_file}")
-            state = {}
-            for key in session_state.keys():
-                if key.endswith("_client") or key.endswith("_button"):
-                    # Skip these keys as they are not serializable or cause errors
-                    continue
-                else:
-                    state[key] = session_state[key]
-                    #print(f"Key: {key}, Value: {session_state[key]}")
-            pickle.dump(state, f)
+        os.makedirs(states_directory, exist_ok=True)
+        state = {
+            "version": state_format_version,
+            "saved_at": time.time(),
+            "sections": collect_sections(),
+            "has_artifacts": include_artifacts,
+        }
+        state_file = state_file_name(state_name)
+        with open(state_file, "w") as f:
+            json.dump(state, f, default=str)
+        if include_artifacts:
+            artifacts = {key: session_state[key] for key in artifact_keys if key in session_state}
+            with open(artifacts_file_name(state_name), "w") as f:
+                json.dump(artifacts, f, default=str)
+        elif os.path.exists(artifacts_file_name(state_name)):
+            os.remove(artifacts_file_name(state_name))
+        update_index(state_name, {
+            "file": os.path.basename(state_file),
+            "size": os.path.getsize(state_file),
+            "saved_at": state["saved_at"],
+            "version": state_format_version,
+            "sections": sorted(state["sections"].keys()),
+            "has_artifacts": include_artifacts,
+        })
 
         with container:
             st.success("State saved successfully!")
 
 def get_states():
-    state_files = os.listdir(states_directory)
-    # Get filenames without the extension
-    state_names = [file.split(".")[0] for file in state_files]
-    return state_names
+    return sorted(read_index().keys())
+
+def load_legacy_state(state_file: str) -> dict:
+    # States saved before the JSON format, only the configuration keys are kept
+    with open(state_file, "rb") as f:
+        state = pickle.load(f)
+    known_keys = {key for keys in state_sections.values() for key in keys}
+    prefixes = tuple(state_section_prefixes.values())
+    return {key: value for key, value in state.items() if key in known_keys or key.startswith(prefixes)}
+
+def read_state_values(state_name: str, sections: list = None, include_artifacts: bool = False) -> dict:
+    # Reads the values of a saved state, raises ValueError when the state cannot be loaded
+    entry = read_index().get(state_name, {})
+    state_file = os.path.join(states_directory, entry.get("file", f"{state_name}.json"))
+    if not os.path.exists(state_file):
+        raise ValueError(f"Saved state {state_name} not found")
+    if state_file.endswith(".pkl"):
+        return load_legacy_state(state_file)
+    with open(state_file) as f:
+        state = json.load(f)
+    if state.get("version") != state_format_version:
+        raise ValueError(f"Saved state {state_name} has the unsupported version {state.get('version')}")
+    values = {}
+    for section, section_values in state["sections"].items():
+        if sections is None or section in sections:
+            values.update(section_values)
+    if include_artifacts and state.get("has_artifacts"):
+        with open(artifacts_file_name(state_name)) as f:
+            values.update(json.load(f))
+    return values
 
 # Function to load a state
-def load_state(state_name,container :st.container = None):
+def load_state(state_name,container :st.container = None, sections: list = None, include_artifacts: bool = False):
+    """
+    Loads a saved state into the session state.
+
+    States that cannot be loaded, e.g. a ?state= link to a state saved by an older version, show an
+    error and leave the session unchanged.
+
+    Parameters:
+    - state_name (str): The name of the state to load.
+    - container (st.container): The Streamlit container to display the success message.
+    - sections (list): The configuration sections to load, all of them if None.
+    - include_artifacts (bool): Also load the saved chat messages and search results.
+    """
     print(f"Loading state:{state_name}")
     if state_name:
-        state_file = os.path.join(states_directory, f"{state_name}.pkl")
-        with open(state_file, "rb") as f:
-            state = pickle.load(f)
-        for key in state.keys():
-            session_state[key] = state[key]
+        try:
+            values = read_state_values(state_name, sections, include_artifacts)
+        except ValueError as e:
+            print(e)
+            (container or st).error(f"Could not load the state: {e}")
+            return
+        search_results = values.pop("search_results", None)
+        for key in values.keys():
+            session_state[key] = values[key]
+        if search_results is not None:
+            # Rebuilds the lookup index of get_content as well
+            set_search_results(search_results)
+        session_state["state_name"] = state_name
         if container:
             with container:
                 st.success("State loaded successfully!")
@@ -67,8 +234,13 @@ def load_state(state_name,container :st.container = None):
 # Function to delete a state
 def delete_state(state_name : str, container : st.container):
     if state_name:
-        state_file = os.path.join(states_directory, f"{state_name}.pkl")
-        os.remove(state_file)
+        entry = read_index().get(state_name, {})
+        state_file = os.path.join(states_directory, entry.get("file", f"{state_name}.json"))
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        if os.path.exists(artifacts_file_name(state_name)):
+            os.remove(artifacts_file_name(state_name))
+        update_index(state_name)
         with container:
             st.success("State deleted successfully!")
 
@@ -76,12 +248,19 @@ def delete_state(state_name : str, container : st.container):
 def delete_all_states(container : st.container):
     state_files = os.listdir(states_directory)
     for file in state_files:
-        if file.endswith(".pkl"):
+        if file.endswith(".pkl") or file.endswith(".json"):
             state_file = os.path.join(states_directory, file)
             os.remove(state_file)
     with container:
         st.success("All states deleted successfully!")
 
+def format_state(state_name: str) -> str:
+    entry = read_index().get(state_name)
+    if entry is None:
+        return state_name
+    saved_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["saved_at"]))
+    return f"{state_name} ({entry['size'] / 1024:.1f}kb, {saved_at})"
+
 # Main function
 def saved_state_widget(container: st.container):
     """
@@ -109,15 +288,18 @@ def saved_state_widget(container: st.container):
 
         with save_col:
             st.write(" ") # Fix the vertical alignment
-            save_button = st.button("Save",key="save_state_button", on_click=save_state, args=[name,container])
+            include_artifacts = st.checkbox("Include chat and results", key="state_include_artifacts")
+            save_button = st.button("Save",key="save_state_button", on_click=save_state, args=[name,container,include_artifacts])
 
         st.markdown("Saved States")
-        existing_state = st.selectbox(options=get_states(), label="Saved States")
+        existing_state = st.selectbox(options=get_states(), label="Saved States", format_func=format_state)
+        saved_sections = read_index().get(existing_state, {}).get("sections") or list(state_sections) + list(state_section_prefixes)
+        load_sections = st.multiselect("Sections to load", options=saved_sections, default=saved_sections)
 
         load_col, delete_col, delete_all_col = st.columns(3)
 
         with load_col:
-            load_button = st.button("Load", on_click=load_state, args=[existing_state,container])
+            load_button = st.button("Load", on_click=load_state, args=[existing_state,container,load_sections,include_artifacts])
 
         with delete_col:
             delete_button = st.button("Delete", on_click=delete_state, args=[existing_state,container])
@@ -130,4 +312,4 @@ def saved_state_widget(container: st.container):
 if __name__ == "__main__":
     dotenv.load_dotenv(override=True)
     st.text_input(value="",key="test", label="Test state here:")
-    saved_state_widget(st.container())
\ No newline at end of file
+    saved_state_widget(st.container())
@@ -0,0 +1,345 @@
+# traffic_replay.py
+
+import atexit
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from elastic_transport import Urllib3HttpNode, ApiResponseMeta, HttpHeaders, ConnectionError as TransportConnectionError
+from elastic_transport._node._base import NodeApiResponse
+
+####################################################################################################
+# Record and Replay of Elasticsearch and LLM Traffic
+####################################################################################################
+
+# With TRAFFIC_MODE=record every request made by the Elasticsearch and LLM clients is written with
+# its response to the TRAFFIC_STORE file. With TRAFFIC_MODE=replay the responses are served from the
+# file without any network call, so sessions can be profiled offline and reproducibly.
+#
+# Responses to the same request are replayed in the recorded order. A request that was not recorded
+# exactly fails, so a replay never silently serves the results of another query or prompt. Endpoints
+# whose requests cannot repeat, e.g. log bulks with new timestamps, can be listed in
+# TRAFFIC_REPLAY_FALLBACK ("POST /_bulk", or "all") to get the next recorded response of the endpoint
+# instead. Exact hits, fallbacks and misses are counted and reported when the process exits.
+#
+# TRAFFIC_REPLAY_LATENCY is "recorded" to wait as long as the recorded request took, "none", or a
+# synthetic latency in milliseconds.
+default_store_path = "recordings/traffic.jsonl.gz"
+
+
+def request_key(*parts) -> str:
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else json.dumps(part, sort_keys=True, default=str).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class TrafficStore:
+    """
+    Request and response pairs in a gzipped JSON lines file.
+
+    Response bodies are stored once by their hash, requests reference them, so the repeated
+    responses of health checks and cached searches take no extra space.
+
+    Parameters:
+    - path (str): The store file.
+    - mode (str): "record" appends to the file, "replay" reads it.
+    - replay_latency (str): "recorded", "none" or a latency in milliseconds.
+    - fallback_routes (list): Routes that may be served a response recorded for another request of
+      the route when a request was not recorded exactly, "all" for every route.
+    """
+
+    def __init__(self, path: str, mode: str, replay_latency: str = "recorded", fallback_routes: list = None):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown traffic mode {mode}")
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.fallback_routes = set(fallback_routes or [])
+        self._lock = threading.Lock()
+        self._blobs = {}
+        self._by_key = {}
+        self._by_route = {}
+        self._stats = {"exact": 0, "fallback": 0, "missed": 0}
+        self._file = None
+        if mode == "record":
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            self._file = gzip.open(path, "at", encoding="utf-8")
+            atexit.register(self.close)
+        else:
+            self._load()
+            atexit.register(self.report)
+
+    def _load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["type"] == "blob":
+                    self._blobs[entry["hash"]] = entry["data"]
+                    continue
+                self._by_key.setdefault((entry["service"], entry["key"]), deque()).append(entry)
+                self._by_route.setdefault((entry["service"], entry["route"]), deque()).append(entry)
+        print(f"Replaying {sum(len(entries) for entries in self._by_key.values())} recorded requests from {self.path}")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _write(self, entry: dict):
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def record(self, service: str, route: str, key: str, response, elapsed: float, **fields):
+        """
+        Appends a request with its response. The response must be JSON serializable.
+        """
+        data = json.dumps(response, separators=(",", ":"), default=str)
+        blob = hashlib.sha1(data.encode()).hexdigest()
+        with self._lock:
+            if self._file is None:
+                return
+            if blob not in self._blobs:
+                self._blobs[blob] = True
+                self._write({"type": "blob", "hash": blob, "data": data})
+            self._write(dict(fields, type="request", service=service, route=route, key=key, blob=blob, elapsed=round(elapsed, 6)))
+            self._file.flush()
+
+    def lookup(self, service: str, route: str, key: str) -> tuple:
+        """
+        Returns the recorded (entry, response) for a request or (None, None).
+
+        Each recorded response is served once, the last one of a request is kept for repeats. Only
+        the fallback routes are served another request's response of the route.
+        """
+        with self._lock:
+            entries = self._by_key.get((service, key))
+            outcome = "exact"
+            if not entries and ("all" in self.fallback_routes or route in self.fallback_routes):
+                entries = self._by_route.get((service, route))
+                outcome = "fallback"
+            if not entries:
+                self._stats["missed"] += 1
+                print(f"Traffic replay: no recorded response for {service} {route}")
+                return None, None
+            self._stats[outcome] += 1
+            entry = entries.popleft() if len(entries) > 1 else entries[0]
+            return entry, json.loads(self._blobs[entry["blob"]])
+
+    def stats(self) -> dict:
+        """
+        Returns the number of requests replayed exactly, replayed from a fallback and missed.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def report(self):
+        stats = self.stats()
+        print(f"Traffic replay: {stats['exact']} exact, {stats['fallback']} fallback, {stats['missed']} missed")
+
+    def delay(self, recorded_seconds: float) -> float:
+        # Seconds to wait before replaying a response
+        if self.replay_latency == "none":
+            return 0
+        if self.replay_latency == "recorded":
+            return recorded_seconds
+        return float(self.replay_latency) / 1000
+
+    def wait(self, recorded_seconds: float):
+        seconds = self.delay(recorded_seconds)
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+_traffic_store = None
+_traffic_store_lock = threading.Lock()
+
+def get_traffic_store() -> TrafficStore:
+    """
+    Returns the process wide traffic store configured by TRAFFIC_MODE, or None when it is off.
+
+    The environment is read on first use so settings from a .env file apply.
+    """
+    global _traffic_store
+    mode = os.getenv("TRAFFIC_MODE", "").lower()
+    if mode not in ("record", "replay"):
+        return None
+    with _traffic_store_lock:
+        if _traffic_store is None:
+            _traffic_store = TrafficStore(
+                os.getenv("TRAFFIC_STORE", default_store_path),
+                mode,
+                os.getenv("TRAFFIC_REPLAY_LATENCY", "recorded").lower(),
+                [route.strip() for route in os.getenv("TRAFFIC_REPLAY_FALLBACK", "").split(",") if route.strip()]
+            )
+    return _traffic_store
+
+
+####################################################################################################
+# Elasticsearch
+####################################################################################################
+
+# The client is given a node class that records or replays at the HTTP level, so the helpers
+# (bulk, scan) and the response objects behave exactly as with a live cluster.
+
+def es_route(method: str, target: str) -> str:
+    # The endpoint of a request without the query string and document ids
+    path = target.split("?", 1)[0]
+    parts = [part for part in path.split("/") if part]
+    api = [part for part in parts if part.startswith("_")]
+    return f"{method} /{'/'.join(api)}" if api else f"{method} /{'index' if parts else ''}"
+
+
+class TrafficNode(Urllib3HttpNode):
+    """
+    Elasticsearch node recording its requests, or serving them from the store without a connection.
+    """
+
+    def perform_request(self, method: str, target: str, body: bytes = None, headers: HttpHeaders = None, **kwargs) -> NodeApiResponse:
+        store = get_traffic_store()
+        route = es_route(method, target)
+        key = request_key(method, target, body or b"")
+        if store.mode == "replay":
+            entry, response = store.lookup("elasticsearch", route, key)
+            if entry is None:
+                raise TransportConnectionError(f"No recorded response for {method} {target}")
+            store.wait(entry["elapsed"])
+            meta = ApiResponseMeta(status=response["status"], http_version="1.1", headers=HttpHeaders(response["headers"]), duration=entry["elapsed"], node=self.config)
+            return NodeApiResponse(meta, base64.b64decode(response["body"]))
+        start = time.perf_counter()
+        result = super().perform_request(method, target, body=body, headers=headers, **kwargs)
+        store.record(
+            "elasticsearch", route, key,
+            {"status": result.meta.status, "headers": dict(result.meta.headers), "body": base64.b64encode(result.body).decode()},
+            time.perf_counter() - start,
+            method=method, target=target
+        )
+        return result
+
+
+def es_client_options() -> dict:
+    """
+    Returns the extra Elasticsearch client arguments for the traffic mode.
+    """
+    if get_traffic_store() is None:
+        return {}
+    return {"node_class": TrafficNode}
+
+
+####################################################################################################
+# LLM
+####################################################################################################
+
+# The LLM client is wrapped at the method level, responses are stored as the dumps of the response
+# models and rebuilt on replay. Streamed completions keep the arrival time of every chunk so the time
+# to first token is replayed as well.
+
+class _Namespace:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class TrafficLLMClient:
+    """
+    Wraps an OpenAI or Azure OpenAI client, recording or replaying chat completions, embeddings and
+    the model list. Every other attribute is passed through to the wrapped client.
+    """
+
+    def __init__(self, llm_client, store: TrafficStore):
+        self._llm_client = llm_client
+        self._store = store
+        self.chat = _Namespace(completions=_Namespace(create=self._create_completion))
+        self.embeddings = _Namespace(create=self._create_embedding)
+        self.models = _Namespace(list=self._list_models)
+
+    def __getattr__(self, name: str):
+        return getattr(self._llm_client, name)
+
+    def with_options(self, **kwargs):
+        if self._store.mode == "replay":
+            return self
+        return TrafficLLMClient(self._llm_client.with_options(**kwargs), self._store)
+
+    def _replay(self, route: str, key: str) -> tuple:
+        entry, response = self._store.lookup("llm", route, key)
+        if entry is None:
+            raise ConnectionError(f"No recorded response for {route}")
+        return entry, response
+
+    def _create_completion(self, **kwargs):
+        from openai.types.chat import ChatCompletion, ChatCompletionChunk
+        route = "chat.completions.stream" if kwargs.get("stream") else "chat.completions"
+        key = request_key(route, kwargs)
+        if self._store.mode == "replay":
+            entry, response = self._replay(route, key)
+            if not kwargs.get("stream"):
+                self._store.wait(entry["elapsed"])
+                return ChatCompletion.model_validate(response)
+            return self._replay_stream(entry, response, ChatCompletionChunk)
+        start = time.perf_counter()
+        result = self._llm_client.chat.completions.create(**kwargs)
+        if not kwargs.get("stream"):
+            self._store.record("llm", route, key, result.model_dump(mode="json"), time.perf_counter() - start)
+            return result
+        return self._record_stream(route, key, result, start)
+
+    def _record_stream(self, route: str, key: str, stream, start: float):
+        chunks = []
+        for chunk in stream:
+            chunks.append([round(time.perf_counter() - start, 6), chunk.model_dump(mode="json")])
+            yield chunk
+        self._store.record("llm", route, key, chunks, time.perf_counter() - start)
+
+    def _replay_stream(self, entry: dict, chunks: list, chunk_model):
+        if self._store.replay_latency == "recorded":
+            start = time.perf_counter()
+            for offset, chunk in chunks:
+                remaining = offset - (time.perf_counter() - start)
+                if remaining > 0:
+                    time.sleep(remaining)
+                yield chunk_model.model_validate(chunk)
+            return
+        # A synthetic latency delays the first chunk, the rest follow without delay
+        self._store.wait(entry["elapsed"])
+        for offset, chunk in chunks:
+            yield chunk_model.model_validate(chunk)
+
+    def _create_embedding(self, **kwargs):
+        from openai.types import CreateEmbeddingResponse
+        key = request_key("embeddings", kwargs)
+        if self._store.mode == "replay":
+            entry, response = self._replay("embeddings", key)
+            self._store.wait(entry["elapsed"])
+            return CreateEmbeddingResponse.model_validate(response)
+        start = time.perf_counter()
+        result = self._llm_client.embeddings.create(**kwargs)
+        self._store.record("llm", "embeddings", key, result.model_dump(mode="json"), time.perf_counter() - start)
+        return result
+
+    def _list_models(self, **kwargs):
+        from openai.types import Model
+        key = request_key("models.list", kwargs)
+        if self._store.mode == "replay":
+            entry, response = self._replay("models.list", key)
+            self._store.wait(entry["elapsed"])
+            return [Model.model_validate(model) for model in response]
+        start = time.perf_counter()
+        models = list(self._llm_client.models.list(**kwargs))
+        self._store.record("llm", "models.list", key, [model.model_dump(mode="json") for model in models], time.perf_counter() - start)
+        return models
+
+
+def wrap_llm_client(llm_client):
+    """
+    Returns the LLM client wrapped for the traffic mode, or the client itself when it is off.
+    """
+    store = get_traffic_store()
+    if store is None:
+        return llm_client
+    return TrafficLLMClient(llm_client, store)
@@ -1,30 +1,47 @@
-import streamlit as st
 import elasticapm
-
-session_state = st.session_state
+from components.elasticsearch import get_search_results_index, get_document_sources, fetch_documents_by_title
 
 definition = {
     "name": "get_content",
-    "description": "Get the content of a document from the elasticsearch index using the title",
+    "description": "Get the content of one or more documents from the elasticsearch index using their titles. Request several documents in one call by passing a list of titles",
     "parameters": {
     "type": "object",
     "properties": {
         "title": {
         "type": "string",
         "description": "The title of the document to get the content for"
+        },
+        "titles": {
+        "type": "array",
+        "items": {"type": "string"},
+        "description": "The titles of the documents to get the content for"
         }
-    },
-    "required": ["title"]
+    }
     }
 }
 
+# Documents are looked up by title, the full content is fetched when a document is requested
+source_fields = ["title"]
+
 @elasticapm.capture_span("bm25_search")
-def get_content(title: str):
+def get_content(title: str = None, titles: list = None):
+
+    requested = list(titles or [])
+    if title is not None and title not in requested:
+        requested.insert(0, title)
+    if not requested:
+        return "No title given"
+
+    # Look the titles up in the last result set, then fetch the rest from the index in one request
+    by_title = get_search_results_index()["by_title"]
+    hits = {title: by_title[title] for title in requested if title in by_title}
+    missing = [title for title in requested if title not in hits]
+    if missing:
+        hits.update(fetch_documents_by_title(missing))
 
-    results = session_state.get("search_results")
+    found = [title for title in requested if title in hits]
+    sources = dict(zip(found, get_document_sources([hits[title] for title in found])))
 
-    if results is None:
-        return "No results found"
-    for result in results:
-        if result["_source"]["title"] == title:
-            return result["_source"]
\ No newline at end of file
+    if len(requested) == 1:
+        return sources.get(requested[0]) or "No results found"
+    return {title: sources.get(title) or "No results found" for title in requested}
@@ -1,11 +1,9 @@
-import streamlit as st
+from components.session import session_state
 import elasticapm
 # Add the parent directory to the path
 import sys
 sys.path.append("..")
-from components.elasticsearch import search as es_search
-
-session_state = st.session_state
+from components.elasticsearch import search as es_search, async_search as es_async_search
 
 
 if "corpus_description" in session_state and session_state["corpus_description"] is not None:
@@ -22,22 +20,43 @@ definition = {
         "query_text": {
             "type": "string",
             "description": "The query text to search for. This should be an expansive set of keywords to find the best document, for example including synonymns"
+        },
+        "query_variants": {
+            "type": "array",
+            "items": {"type": "string"},
+            "description": "Optional alternative phrasings of the query, e.g. with synonyms or one per aspect of the question. They are searched together with the query text."
         }
         },
         "required": ["query_text"]
     }
 }
 
+# The titles are returned to the LLM
+source_fields = ["title"]
+
 @elasticapm.capture_span("bm25_search")
-def search(query_text: str):
+def search(query_text: str, query_variants: list = None):
 
     print("Searching for: ", query_text )
 
 
-    search_results = es_search(query_text)
+    # The variants are only searched when multi query retrieval is enabled
+    search_results = es_search(query_text, query_variants)
 
     #print("Search results: ", search_results)
+    # es_search already stored the results in the session
     session_state["search_query"] = query_text
-    session_state["search_results"] = search_results
     titles = [result["_source"]["title"] for result in search_results]  
     return titles
+
+
+@elasticapm.async_capture_span("bm25_search")
+async def search_async(query_text: str, query_variants: list = None):
+
+    print("Searching for: ", query_text )
+
+    search_results = await es_async_search(query_text, query_variants)
+
+    session_state["search_query"] = query_text
+    titles = [result["_source"]["title"] for result in search_results]
+    return titles
@@ -1,8 +1,49 @@
 import streamlit as st
-from components.elasticsearch import index_selector_widget
+from components.elasticsearch import index_selector_widget, invalidate_search_cache, get_index_catalog
+from components.ingestion import ingest
+from components.document_processing import process_file, chunkers
 
 session_state = st.session_state
 
+default_chunk_characters = 2000
+default_chunk_overlap = 200
+
+def run_ingestion(uploaded_file, index_name: str, new_index: bool, chunker: str, chunk_characters: int, chunk_overlap: int):
+    es_client = session_state.get("es_client")
+    if es_client is None:
+        st.error("Not connected to Elastic")
+        return
+    progress_bar = st.progress(0.0, text="Indexing ...")
+    status = st.empty()
+    file_progress = {"fraction": 0.0}
+
+    def progress(stats: dict):
+        progress_bar.progress(file_progress["fraction"], text=f"Indexing ... {stats['indexed']:,} chunks")
+        status.write(f"{stats['docs_per_second']:,.0f} docs/sec, {stats['unchanged']:,} unchanged, {stats['failed']:,} failed")
+
+    # The file is parsed and chunked in worker processes as the bulk requests consume the chunks
+    chunks = process_file(uploaded_file, uploaded_file.name, chunker, chunk_characters, chunk_overlap, progress=file_progress)
+    try:
+        stats = ingest(es_client, index_name, chunks, new_index=new_index, progress=progress, source_file=uploaded_file.name)
+    except ValueError as e:
+        st.error(str(e))
+        return
+
+    # Searches on the index must not be served from the cache
+    invalidate_search_cache(index_name)
+    catalog = get_index_catalog()
+    if catalog:
+        catalog.request_refresh()
+
+    progress_bar.progress(1.0, text="Done")
+    st.success(f"Indexed {stats['indexed']:,} chunks in {stats['seconds']:.1f}s ({stats['docs_per_second']:,.0f} docs/sec)")
+    st.write(f"{stats['unchanged']:,} chunks unchanged, {stats['deleted']:,} removed chunks deleted, {stats['duplicates']:,} duplicate chunks skipped")
+    if stats["failed"]:
+        st.error(f"{stats['failed']:,} chunks failed")
+        if stats["orphans_skipped"]:
+            st.warning("Chunks removed from the file were not deleted because some chunks failed, index the file again to remove them")
+        st.write(stats["errors"])
+
 def main():
     st.title("Upload a File")
 
@@ -10,13 +51,24 @@ def main():
     index_container = st.container()
     if new_or_existing == "New":
         index_name = st.text_input("Index Name")
+        catalog = get_index_catalog()
+        if index_name and catalog and catalog.metadata(index_name) is not None:
+            st.warning(f"Index {index_name} already exists, choose Existing to load the file into it")
     else:
         index_name=index_selector_widget(index_container, prefix="upload_")
+    chunker_col, chunk_col, overlap_col = st.columns(3)
+    with chunker_col:
+        chunker = st.selectbox("Chunking", options=list(chunkers.keys()), format_func=lambda name: {"fixed": "Fixed size", "sentence": "Sentences", "heading": "Headings"}[name])
+    with chunk_col:
+        chunk_characters = st.number_input("Chunk Size (characters)", min_value=100, value=default_chunk_characters)
+    with overlap_col:
+        chunk_overlap = st.number_input("Chunk Overlap (characters)", min_value=0, value=default_chunk_overlap)
     uploaded_file = st.file_uploader("Choose a file")
     if uploaded_file is not None:
         file_details = {"FileName":uploaded_file.name,"FileType":uploaded_file.type,"FileSize":uploaded_file.size}
         st.write(file_details)
-        st.write(uploaded_file)
+        if st.button("Index File", disabled=not index_name):
+            run_ingestion(uploaded_file, index_name, new_or_existing == "New", chunker, chunk_characters, chunk_overlap)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,78 @@
 import streamlit as st
+import time
+from components.semantic_cache import get_semantic_cache, default_cache_index, default_return_threshold, default_seed_threshold
 
 session_state = st.session_state 
 
 st.title("Semantic Logging")
 st.markdown("Find semantically similar, previous Qs and As")
-st.markdown("Coming soon...")
\ No newline at end of file
+
+def main():
+    settings_col, status_col = st.columns(2)
+    # Widget state is dropped when another page is shown, the settings are copied to plain keys
+    # so the chat on the main page keeps using them
+    with settings_col:
+        session_state["semantic_cache_enabled"] = st.checkbox("Answer from the semantic cache", value=session_state.get("semantic_cache_enabled", False))
+        session_state["semantic_cache_index"] = st.text_input("Cache Index Name", value=session_state.get("semantic_cache_index", default_cache_index))
+        session_state["semantic_cache_return_threshold"] = st.slider("Return cached answer above similarity", min_value=0.5, max_value=1.0, step=0.01, value=session_state.get("semantic_cache_return_threshold", default_return_threshold))
+        session_state["semantic_cache_seed_threshold"] = st.slider("Seed the LLM with a cached answer above similarity", min_value=0.5, max_value=1.0, step=0.01, value=session_state.get("semantic_cache_seed_threshold", default_seed_threshold))
+
+    cache = get_semantic_cache()
+    with status_col:
+        if cache is None:
+            st.warning("The semantic cache is disabled or no cluster is connected")
+            return
+        st.write(f"Index: {cache.index}  \nEmbedder: {cache.embedder.name}")
+
+    st.subheader("Find similar questions")
+    question = st.text_input("Question", key="semantic_cache_question")
+    if question:
+        try:
+            entry = cache.lookup(question, min_similarity=session_state.get("semantic_cache_seed_threshold", default_seed_threshold))
+        except Exception as e:
+            st.error(f"Error searching the cache: {e}")
+            entry = None
+        if entry is None:
+            st.info("No cached answer above the seed threshold")
+        else:
+            st.write(f"**{entry['query']}** (similarity {entry['similarity']:.3f})")
+            st.markdown(entry["reply"])
+
+    st.subheader("Cache entries")
+    filter_text = st.text_input("Filter", key="semantic_cache_filter")
+    try:
+        entries = cache.browse(filter_text)
+    except Exception as e:
+        st.error(f"Error reading the cache: {e}")
+        return
+    rows = []
+    for entry in entries:
+        source = entry["_source"]
+        rows.append({
+            "evict": False,
+            "id": entry["_id"],
+            "query": source.get("query"),
+            "reply": source.get("reply"),
+            "hits": source.get("cache_hits", 0),
+            "user": source.get("user"),
+            "index": source.get("index_name"),
+            "saved": time.strftime("%Y-%m-%d %H:%M", time.localtime(source.get("@timestamp", 0) / 1000)),
+        })
+    edited = st.data_editor(rows, key="semantic_cache_entries", disabled=["id", "query", "reply", "hits", "user", "index", "saved"], use_container_width=True)
+
+    evict_col, older_col, clear_col = st.columns(3)
+    with evict_col:
+        if st.button("Evict selected", key="semantic_cache_evict_button"):
+            cache.evict([row["id"] for row in edited if row["evict"]])
+            st.rerun()
+    with older_col:
+        days = st.number_input("Older than (days)", min_value=1, value=30, key="semantic_cache_evict_days")
+        if st.button("Evict old entries", key="semantic_cache_evict_old_button"):
+            cache.evict_older_than(days)
+            st.rerun()
+    with clear_col:
+        if st.button("Clear cache", key="semantic_cache_clear_button"):
+            cache.clear()
+            st.rerun()
+
+main()
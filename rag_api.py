@@ -0,0 +1,206 @@
+# rag_api.py
+#
+# JSON HTTP API over the headless RAG engine, for programmatic clients.
+#
+#   python rag_api.py --port 8000
+#
+# The connection settings come from the environment (and .env) like the defaults of the app.
+#
+#   POST   /sessions                  {settings}            -> {"session_id"}
+#   GET    /sessions/<id>                                    -> {"session_id", "messages"}
+#   DELETE /sessions/<id>
+#   POST   /sessions/<id>/search      {"query"}             -> {"hits"}
+#   POST   /sessions/<id>/chat        {"message"}           -> {"reply", "tool_calls"}
+#   POST   /sessions/<id>/reset
+#   POST   /search                    {"query", settings}   -> {"hits"}            (no session kept)
+#   POST   /chat                      {"message", settings} -> {"reply", "tool_calls"}
+#   GET    /health
+#
+# Settings are the per session settings of components.rag_engine, e.g. index_name or num_results.
+# When RAG_API_KEY is set, requests need an "Authorization: Bearer <key>" header.
+
+import argparse
+import dotenv
+import hmac
+import json
+import os
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+dotenv.load_dotenv()
+
+from components.rag_engine import RagEngine
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def session_or_404(engine: RagEngine, session_id: str):
+    session = engine.get_session(session_id)
+    if session is None:
+        raise ApiError(404, f"Unknown session {session_id}")
+    return session
+
+
+def required(body: dict, field: str) -> str:
+    value = body.get(field)
+    if not isinstance(value, str) or not value:
+        raise ApiError(400, f"Missing {field}")
+    return value
+
+
+def settings_from(body: dict, *request_fields) -> dict:
+    return {key: value for key, value in body.items() if key not in request_fields}
+
+
+def chat_response(session, message: str) -> dict:
+    tool_calls = []
+
+    def on_event(event: str, data=None):
+        if event == "tool_call":
+            tool_calls.append(data)
+
+    reply = session.chat(message, on_event)
+    return {"reply": reply, "tool_calls": tool_calls}
+
+
+def make_routes(engine: RagEngine) -> list:
+    # (method, path pattern, handler(match, body) -> (status, response))
+    def create_session(match, body):
+        try:
+            session = engine.create_session(body)
+        except ValueError as e:
+            raise ApiError(400, str(e))
+        return 201, {"session_id": session.id}
+
+    def get_session(match, body):
+        session = session_or_404(engine, match["id"])
+        return 200, {"session_id": session.id, "messages": session.messages}
+
+    def delete_session(match, body):
+        if not engine.close_session(match["id"]):
+            raise ApiError(404, f"Unknown session {match['id']}")
+        return 200, {"deleted": True}
+
+    def session_search(match, body):
+        return 200, {"hits": session_or_404(engine, match["id"]).search(required(body, "query"))}
+
+    def session_chat(match, body):
+        return 200, chat_response(session_or_404(engine, match["id"]), required(body, "message"))
+
+    def session_reset(match, body):
+        session_or_404(engine, match["id"]).reset_chat()
+        return 200, {"reset": True}
+
+    def one_shot(settings: dict):
+        try:
+            return engine.create_session(settings)
+        except ValueError as e:
+            raise ApiError(400, str(e))
+
+    def search(match, body):
+        query = required(body, "query")
+        session = one_shot(settings_from(body, "query"))
+        try:
+            return 200, {"hits": session.search(query)}
+        finally:
+            engine.close_session(session.id)
+
+    def chat(match, body):
+        message = required(body, "message")
+        session = one_shot(settings_from(body, "message"))
+        try:
+            return 200, chat_response(session, message)
+        finally:
+            engine.close_session(session.id)
+
+    def health(match, body):
+        return 200, {"status": "ok", "sessions": engine.session_count()}
+
+    return [
+        ("GET", r"/health", health),
+        ("POST", r"/sessions", create_session),
+        ("GET", r"/sessions/(?P<id>[0-9a-f]+)", get_session),
+        ("DELETE", r"/sessions/(?P<id>[0-9a-f]+)", delete_session),
+        ("POST", r"/sessions/(?P<id>[0-9a-f]+)/search", session_search),
+        ("POST", r"/sessions/(?P<id>[0-9a-f]+)/chat", session_chat),
+        ("POST", r"/sessions/(?P<id>[0-9a-f]+)/reset", session_reset),
+        ("POST", r"/search", search),
+        ("POST", r"/chat", chat),
+    ]
+
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Bursts of clients would be reset with the default backlog of 5
+    request_queue_size = 128
+
+
+def make_handler(engine: RagEngine, api_key: str = None):
+    routes = [(method, re.compile(pattern + r"/?$"), handler) for method, pattern, handler in make_routes(engine)]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status: int, response: dict):
+            data = json.dumps(response, default=str).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _handle(self):
+            try:
+                if api_key and not hmac.compare_digest(self.headers.get("Authorization", ""), f"Bearer {api_key}"):
+                    raise ApiError(401, "Unauthorized")
+                path = self.path.split("?", 1)[0]
+                for method, pattern, handler in routes:
+                    match = pattern.match(path)
+                    if match and method == self.command:
+                        break
+                else:
+                    raise ApiError(404, f"No route for {self.command} {path}")
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length)) if length else {}
+                except json.JSONDecodeError as e:
+                    raise ApiError(400, f"Invalid JSON: {e}")
+                if not isinstance(body, dict):
+                    raise ApiError(400, "The body must be a JSON object")
+                status, response = handler(match, body)
+            except ApiError as e:
+                status, response = e.status, {"error": str(e)}
+            except Exception as e:
+                print(f"Error handling {self.command} {self.path}: {e}")
+                status, response = 500, {"error": str(e)}
+            self._send(status, response)
+
+        do_GET = do_POST = do_DELETE = _handle
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON HTTP API for search and chat")
+    parser.add_argument("--host", default=os.getenv("RAG_API_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("RAG_API_PORT", "8000")))
+    parser.add_argument("--session-ttl", type=float, default=float(os.getenv("RAG_API_SESSION_TTL", "1800")), help="Seconds an idle session is kept")
+    args = parser.parse_args()
+
+    engine = RagEngine(session_ttl=args.session_ttl)
+    server = ApiServer((args.host, args.port), make_handler(engine, os.getenv("RAG_API_KEY")))
+    print(f"Serving the RAG API on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+from streamlit.testing.v1 import AppTest
+
+
+def tool_call_app():
+    import streamlit as st
+    from components.chat import run_tool_calls
+    from components.session import session_state
+
+    def lookup(name: str) -> str:
+        return f"{name} for {session_state['user_name']}"
+
+    def on_submit():
+        tool_calls = [{"id": str(n), "name": "lookup", "parsed_arguments": {"name": f"call {n}"}} for n in range(3)]
+        st.session_state["results"] = run_tool_calls(tool_calls, {"lookup": lookup})
+
+    st.session_state.setdefault("user_name", "tester")
+    st.chat_input("Question", key="question", on_submit=on_submit)
+
+
+def test_tool_calls_run_concurrently_in_a_widget_callback():
+    # The script thread holds the session state lock while on_submit runs, the workers must not wait for it
+    app = AppTest.from_function(tool_call_app, default_timeout=10)
+    app.run()
+    app.chat_input[0].set_value("question").run()
+    assert not app.exception
+    assert app.session_state["results"] == ["call 0 for tester", "call 1 for tester", "call 2 for tester"]
+
+
+def test_tool_call_errors_are_returned_as_results():
+    from components.chat import run_tool_calls
+
+    def fail():
+        raise RuntimeError("boom")
+
+    tool_calls = [{"id": "1", "name": "fail", "parsed_arguments": {}}, {"id": "2", "name": "missing", "parsed_arguments": {}}]
+    assert run_tool_calls(tool_calls, {"fail": fail}) == ["Error: boom", "Unknown function missing"]
@@ -0,0 +1,44 @@
+import csv
+import io
+
+import pytest
+
+from components import document_processing
+
+
+@pytest.fixture
+def small_ranges(monkeypatch):
+    # Many ranges from a small file, so boundaries fall inside records
+    monkeypatch.setattr(document_processing, "range_bytes", 200)
+
+
+def quoted_csv(n_rows: int) -> bytes:
+    # Every field is quoted and holds line breaks, some also escaped quotes and commas
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["name", "notes\nmore"])
+    for number in range(n_rows):
+        writer.writerow([f'line one {number}\nline two {number}"', f'x,"y"\n{number}'])
+    return buffer.getvalue().encode()
+
+
+def test_csv_ranges_end_on_record_boundaries(small_ranges, tmp_path):
+    path = tmp_path / "records.csv"
+    path.write_bytes(quoted_csv(50))
+    data = path.read_bytes()
+    header_end = document_processing.csv_record_end(data, 0)
+    ranges = list(document_processing.csv_ranges(str(path), header_end))
+    assert len(ranges) > 1
+    rows = []
+    for start, end in ranges:
+        # Each range parses on its own into whole records
+        rows += list(csv.reader(io.StringIO(data[start:end].decode(), newline="")))
+    assert rows == [[f'line one {number}\nline two {number}"', f'x,"y"\n{number}'] for number in range(50)]
+
+
+def test_csv_records_with_line_breaks_are_not_split(small_ranges):
+    chunks = list(document_processing.process_file(io.BytesIO(quoted_csv(50)), "records.csv", workers=0))
+    assert len(chunks) == 50
+    for number, chunk in enumerate(chunks):
+        assert chunk["name"] == f'line one {number}\nline two {number}"'
+        assert chunk["notes\nmore"] == f'x,"y"\n{number}'
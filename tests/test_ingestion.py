@@ -0,0 +1,63 @@
+import io
+import json
+
+from benchmarks.fakes import FakeElasticsearch
+from components.document_processing import process_file
+from components.ingestion import ingest
+
+index_name = "docs"
+file_name = "records.ndjson"
+
+
+def load(es_client: FakeElasticsearch, texts: list, new_index: bool = False) -> dict:
+    data = "\n".join(json.dumps({"title": text, "text": text}) for text in texts).encode()
+    chunks = process_file(io.BytesIO(data), file_name, workers=0)
+    return ingest(es_client, index_name, chunks, new_index=new_index, source_file=file_name)
+
+
+def test_ids_are_stable_when_records_move():
+    es_client = FakeElasticsearch([])
+    texts = [f"record {number}" for number in range(5)]
+    stats = load(es_client, texts, new_index=True)
+    assert stats["indexed"] == 5
+    before = dict(es_client.documents[index_name])
+
+    # A record inserted at the top moves every other record down
+    stats = load(es_client, ["new first record"] + texts)
+    assert (stats["indexed"], stats["unchanged"], stats["deleted"], stats["failed"]) == (1, 5, 0, 0)
+    assert set(before) < set(es_client.documents[index_name])
+    assert len(es_client.documents[index_name]) == 6
+
+
+def test_removed_records_are_deleted():
+    es_client = FakeElasticsearch([])
+    texts = [f"record {number}" for number in range(5)]
+    load(es_client, texts, new_index=True)
+    stats = load(es_client, texts[1:])
+    assert (stats["indexed"], stats["unchanged"], stats["deleted"]) == (0, 4, 1)
+    assert sorted(doc["text"] for doc in es_client.documents[index_name].values()) == texts[1:]
+
+
+def test_old_chunks_survive_a_failed_bulk():
+    es_client = FakeElasticsearch([])
+    texts = [f"record {number}" for number in range(5)]
+    load(es_client, texts, new_index=True)
+
+    es_client.reject = lambda op_type, action, source: source and source["text"] == "changed record 2" and {"type": "mapper_parsing_exception"}
+    stats = load(es_client, texts[:2] + ["changed record 2"] + texts[3:])
+    assert stats["failed"] == 1
+    assert stats["orphans_skipped"]
+    assert stats["deleted"] == 0
+    # The previous version of the changed record stays searchable
+    assert sorted(doc["text"] for doc in es_client.documents[index_name].values()) == texts
+
+
+def test_new_index_that_exists_is_refused():
+    es_client = FakeElasticsearch([])
+    load(es_client, ["record"], new_index=True)
+    try:
+        load(es_client, ["record"], new_index=True)
+    except ValueError as e:
+        assert index_name in str(e)
+    else:
+        raise AssertionError("Loading into an existing index as a new index must fail")
@@ -0,0 +1,77 @@
+import hashlib
+
+import numpy as np
+import pytest
+
+from benchmarks.fakes import FakeElasticsearch
+from components.chat import lookup_cached_answer
+from components.semantic_cache import HashingEmbedder, SemanticAnswerCache, get_semantic_cache
+from components.session import use_state
+
+question = "How do I configure index lifecycle management in Elasticsearch?"
+# Shares most words with the question, its similarity is between the seed and return thresholds
+close_question = "How do I configure index lifecycle management in Kibana?"
+
+
+@pytest.fixture
+def state():
+    return {
+        "semantic_cache_enabled": True,
+        "semantic_cache_seed_threshold": 0.85,
+        "semantic_cache_return_threshold": 0.95,
+        "es_client": FakeElasticsearch([]),
+        "index_name": "docs",
+        "system_prompt": "Answer from the documents.",
+    }
+
+
+def store(state: dict, query: str, reply: str):
+    with use_state(state):
+        get_semantic_cache().store(query, reply, ["ILM guide"], "tester")
+
+
+def lookup(state: dict, query: str) -> tuple:
+    with use_state(state):
+        return lookup_cached_answer([{"role": "user", "content": query}])
+
+
+def test_same_question_is_returned_from_the_cache(state):
+    store(state, question, "Create a policy and attach it to an index template.")
+    cache, entry, cache_hit = lookup(state, question.rstrip("?"))
+    assert cache_hit
+    assert entry["reply"] == "Create a policy and attach it to an index template."
+    assert entry["doc_references"] == ["ILM guide"]
+    assert entry["similarity"] == pytest.approx(1.0, abs=1e-5)
+
+
+def test_question_below_the_return_threshold_only_seeds_the_llm(state):
+    store(state, question, "Create a policy and attach it to an index template.")
+    cache, entry, cache_hit = lookup(state, close_question)
+    assert entry is not None
+    assert 0.85 <= entry["similarity"] < 0.95
+    assert not cache_hit
+
+
+def test_unrelated_question_misses(state):
+    store(state, question, "Create a policy and attach it to an index template.")
+    cache, entry, cache_hit = lookup(state, "What is the capital of France?")
+    assert entry is None
+    assert not cache_hit
+
+
+@pytest.mark.parametrize("scope_change", [{"index_name": "other-docs"}, {"system_prompt": "Answer in French."}])
+def test_entries_are_only_matched_within_their_scope(state, scope_change):
+    store(state, question, "Create a policy and attach it to an index template.")
+    cache, entry, cache_hit = lookup(dict(state, **scope_change), question)
+    assert entry is None
+    assert cache.scope["system_prompt_hash"] == hashlib.sha256(dict(state, **scope_change)["system_prompt"].encode()).hexdigest()
+
+
+def test_score_is_converted_back_to_the_cosine_similarity():
+    embedder = HashingEmbedder()
+    cache = SemanticAnswerCache(FakeElasticsearch([]), "rag-semantic-cache", embedder)
+    cache.store(question, "reply")
+    entry = cache.lookup(close_question, -1)
+    cosine = float(np.dot(embedder.embed(question), embedder.embed(close_question)))
+    assert entry["similarity"] == pytest.approx(cosine, abs=1e-5)
+    assert cache.index == "rag-semantic-cache-hashing-384"
@@ -1,25 +1,166 @@
 ### WARNING This is not reccomended for production use ###
 
 from elasticsearch import Elasticsearch
+import atexit
 import logging
+import queue
+import threading
+import time
 from logging import StreamHandler
 
 # This is a custom logging handler that will send logs directly to elasticsearch
+# Records are queued by emit and shipped with the _bulk API by a background thread so the caller never
+# waits for the monitoring cluster.
 class ElasticHandler(StreamHandler):
-    def __init__(self, level,es_client: Elasticsearch, index: str):
+    def __init__(self, level, es_client: Elasticsearch, index: str, batch_size: int = 500, flush_interval: float = 2.0,
+                 max_queue_size: int = 10000, overflow_policy: str = "drop", block_timeout: float = 1.0):
+        """
+        Parameters:
+        - level: Logging level of the handler.
+        - es_client (Elasticsearch): Client for the monitoring cluster.
+        - index (str): Index or data stream the logs are written to.
+        - batch_size (int): Number of records that triggers a flush.
+        - flush_interval (float): Maximum seconds a record waits in the queue before it is shipped.
+        - max_queue_size (int): Maximum number of records waiting to be shipped.
+        - overflow_policy (str): "drop" discards new records when the queue is full, "block" waits up to block_timeout for space.
+        - block_timeout (float): Seconds to wait for space in the queue with the "block" policy before the record is dropped.
+        """
         StreamHandler.__init__(self)
+        self.setLevel(level)
+        if overflow_policy not in ("drop", "block"):
+            raise ValueError(f"Unknown overflow policy {overflow_policy}")
         self._es_client = es_client
         self._index = index
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._overflow_policy = overflow_policy
+        self._block_timeout = block_timeout
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._flush_requested = threading.Event()
+        self._stopped = threading.Event()
+        self._counters_lock = threading.Lock()
+        self._counters = {"shipped": 0, "dropped": 0, "failed": 0}
+        self._flusher = threading.Thread(target=self._run, name=f"elastic-log-shipper-{index}", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
     def emit(self, record):
-      msg = self.format(record)
-      #print(msg)
-      #print(self._index)
-      #print(self._es_client)
-      result=self._es_client.index(index=self._index, document=msg)
-      #print(result)
-      if result.get("result") != "created":
-        print("Error sending log to elasticsearch")
-        print(result)
+        try:
+            msg = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            if self._overflow_policy == "block":
+                self._queue.put(msg, timeout=self._block_timeout)
+            else:
+                self._queue.put_nowait(msg)
+        except queue.Full:
+            self._count("dropped")
+            return
+        if self._queue.qsize() >= self._batch_size:
+            self._flush_requested.set()
+
+    def stats(self) -> dict:
+        """
+        Returns the number of records shipped, dropped, failed and currently queued.
+        """
+        with self._counters_lock:
+            stats = dict(self._counters)
+        stats["queued"] = self._queue.qsize()
+        return stats
+
+    def flush(self):
+        # Ask the shipper to send what is queued now
+        self._flush_requested.set()
+
+    def close(self):
+        # Stop the shipper and send everything still queued
+        if not self._stopped.is_set():
+            self._stopped.set()
+            self._flush_requested.set()
+            self._flusher.join(timeout=10)
+            atexit.unregister(self.close)
+        StreamHandler.close(self)
+
+    def _count(self, counter: str, n: int = 1):
+        with self._counters_lock:
+            self._counters[counter] += n
+
+    def _take_batch(self) -> list:
+        batch = []
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _ship(self, batch: list):
+        operations = []
+        for msg in batch:
+            operations.append({"create": {"_index": self._index}})
+            operations.append(msg)
+        try:
+            result = self._es_client.bulk(operations=operations)
+        except Exception as e:
+            print("Error sending logs to elasticsearch")
+            print(e)
+            self._count("failed", len(batch))
+            return
+        failed = 0
+        if result.get("errors"):
+            for item in result["items"]:
+                if "error" in item.get("create", {}):
+                    failed += 1
+            print(f"Error sending {failed} logs to elasticsearch")
+        self._count("failed", failed)
+        self._count("shipped", len(batch) - failed)
+
+    def _run(self):
+        deadline = time.monotonic() + self._flush_interval
+        while True:
+            self._flush_requested.wait(max(0, deadline - time.monotonic()))
+            self._flush_requested.clear()
+            stopping = self._stopped.is_set()
+            batch = self._take_batch()
+            while batch:
+                self._ship(batch)
+                if len(batch) < self._batch_size:
+                    break
+                batch = self._take_batch()
+            deadline = time.monotonic() + self._flush_interval
+            if stopping:
+                return
+
+
+# The app logger ships to one monitoring cluster at a time, so one handler is kept and reruns reuse its
+# shipper thread. It is keyed by the credentials of the client, a handler for other credentials or
+# another index replaces it and the replaced handler is closed, which ships what it still holds.
+_handlers = {}
+_handlers_lock = threading.Lock()
+
+def get_elastic_handler(level, es_client: Elasticsearch, index: str, client_key: tuple = None, **kwargs) -> ElasticHandler:
+    """
+    Returns the shared handler for the client and index, closing the handler it replaces.
+
+    Parameters:
+    - client_key (tuple): Key of the client's credentials, e.g. es_client_key of the monitoring connection.
+    """
+    key = (client_key, index)
+    with _handlers_lock:
+        handler = _handlers.get(key)
+        replaced = []
+        # A pooled client that was closed and created again gets a new handler as well
+        if handler is None or handler._es_client is not es_client:
+            replaced = list(_handlers.values())
+            _handlers.clear()
+            handler = ElasticHandler(level, es_client, index, **kwargs)
+            _handlers[key] = handler
+    for replaced_handler in replaced:
+        # Closing waits for the last batch to be shipped, which the render should not wait for
+        threading.Thread(target=replaced_handler.close, name="elastic-log-shipper-close", daemon=True).start()
+    return handler
 
 # This is a custom logging filter that will add the event.dataset field to the log record as it's madatory
 class SystemLogFilter(logging.Filter):
@@ -32,4 +173,4 @@ class SystemLogFilter(logging.Filter):
         else:
           if not hasattr(record.extra,'event.dataset'):
             record.extra["event.dataset"]= self.EVENT_DATASET_LOGS
-        return True
\ No newline at end of file
+        return True